@@ -1,10 +1,16 @@
 import json
+import sys
 from collections import defaultdict
 
 import requests
 from bs4 import BeautifulSoup
 from pyprojroot import here
 
+sys.path.append(str(here() / "b1_rag_fns"))
+
+from b16_manifest import Manifest, content_hash
+
+fp_data = here() / "data"
 base_url = "https://rstats.ai/videos"
 
 response = requests.get(base_url)
@@ -15,9 +21,25 @@ script_tag = soup.find(
 )
 my_data = json.loads(script_tag.text)["x"]["tag"]["attribs"]["data"]
 my_data = [dict(zip(my_data.keys(), values)) for values in zip(*my_data.values())]
-dcr_data = []
-# Create a defaultdict to keep track of counts for each year
+
+# Talks from earlier runs, matched by video, keep their IDs and whatever the
+# later stages added to them (transcripts, written abstracts)
+try:
+    with open(fp_data / "rgov_talks.json", "r") as f:
+        old_talks = {vid["VideoURL"]: vid for vid in json.load(f)}
+except FileNotFoundError:
+    old_talks = {}
+manifest = Manifest.load(fp_data)
+
+# Create a defaultdict to keep track of counts for each year.  New talks are
+# numbered after the ones already kept from that year.
 year_counter = defaultdict(int)
+for vid in old_talks.values():
+    year, count = vid["id0"].rsplit("_", 1)
+    year_counter[year] = max(year_counter[year], int(count))
+
+dcr_data = []
+n_new, n_changed = 0, 0
 
 # List of keys you want to keep
 keys_to_keep = ["Year", "Speaker", "Title", "Abstract", "VideoURL"]
@@ -26,11 +48,30 @@ for vid in my_data:
         if vid["Type"] != "Highlights":
             if vid["VideoURL"]:
                 my_vid = {key: vid[key] for key in keys_to_keep if key in vid}
-                year = str(vid["Year"])  # Ensure the Year is a string
-                year_counter[year] += 1  # Increment the count for the current year
-                my_vid["id0"] = f"{year}_{year_counter[year]:02d}"  # Format the id0
+                scrape_hash = content_hash(my_vid)
+                old_vid = old_talks.get(my_vid["VideoURL"])
+                if old_vid is None:
+                    year = str(vid["Year"])  # Ensure the Year is a string
+                    year_counter[year] += 1  # Increment the count for the current year
+                    my_vid["id0"] = f"{year}_{year_counter[year]:02d}"  # Format the id0
+                    n_new += 1
+                elif manifest.is_current(old_vid["id0"], "scrape", scrape_hash):
+                    my_vid = old_vid
+                else:
+                    if my_vid.get("Abstract"):
+                        # A listed abstract replaces the one a4_post_process wrote
+                        manifest.forget(old_vid["id0"], "abstract")
+                    else:
+                        my_vid["Abstract"] = old_vid.get("Abstract", "")
+                    my_vid = {**old_vid, **my_vid}
+                    n_changed += 1
+                manifest.mark(my_vid["id0"], "scrape", scrape_hash)
                 dcr_data.append(my_vid)
 
 
-with open(here() / "data" / "rgov_talks.json", "w") as f:
+with open(fp_data / "rgov_talks.json", "w") as f:
     json.dump(dcr_data, f)
+
+manifest.prune({vid["id0"] for vid in dcr_data})
+manifest.save()
+print(f"{len(dcr_data)} talks: {n_new} new, {n_changed} changed")
@@ -1,11 +1,21 @@
 import asyncio
 import json
+import sys
+from pathlib import Path
 
 import yt_dlp as youtube_dl
 from pyprojroot import here
 
+sys.path.append(str(here() / "b1_rag_fns"))
 
-async def download_audio_yt_dl(vid: dict, output_path: str):
+from b16_manifest import Manifest, content_hash
+
+
+def audio_path(fp_audio: Path, vid: dict) -> Path:
+    return fp_audio / f"vid_{vid['id0']}.mp3"
+
+
+async def download_audio_yt_dl(vid: dict, output_path: str) -> bool:
     video_url = vid["VideoURL"]
     filename = f"vid_{vid['id0']}"
     ydl_opts = {
@@ -23,8 +33,10 @@ async def download_audio_yt_dl(vid: dict, output_path: str):
 
     try:
         await asyncio.to_thread(youtube_dl.YoutubeDL(ydl_opts).download, [video_url])
+        return True
     except Exception as e:
         print(f"Failed to download {video_url}: {e}")
+        return False
 
 
 async def main():
@@ -40,8 +52,29 @@ async def main():
     fp_audio = fp_data / "audio"
     fp_audio.mkdir(exist_ok=True)
 
-    tasks = [download_audio_yt_dl(vid, str(fp_audio)) for vid in dcr_data]
-    await asyncio.gather(*tasks)
+    # Only download new talks, and talks whose video has moved
+    manifest = Manifest.load(fp_data)
+    to_download = []
+    for vid in dcr_data:
+        url_hash = content_hash(vid["VideoURL"])
+        recorded = manifest.get(vid["id0"], "download")
+        if recorded is None and audio_path(fp_audio, vid).exists():
+            # Downloaded before there was a manifest
+            manifest.mark(vid["id0"], "download", url_hash)
+        elif recorded != url_hash:
+            to_download.append(vid)
+    print(f"Downloading {len(to_download)} of {len(dcr_data)} talks")
+    for vid in to_download:
+        # yt-dlp skips files that already exist
+        audio_path(fp_audio, vid).unlink(missing_ok=True)
+
+    tasks = [download_audio_yt_dl(vid, str(fp_audio)) for vid in to_download]
+    downloaded = await asyncio.gather(*tasks)
+
+    for vid, ok in zip(to_download, downloaded):
+        if ok:
+            manifest.mark(vid["id0"], "download", content_hash(vid["VideoURL"]))
+    manifest.save()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,107 @@
 import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
 
+import torch
 import whisper
 from pyprojroot import here
 from tqdm import tqdm
 
+sys.path.append(str(here() / "b1_rag_fns"))
+
+from b16_manifest import Manifest, file_hash
+
+# Transcription runs on a pool of processes, each with its own model on
+# WHISPER_THREADS cores.  Whisper gains little from more than a few threads, so
+# many narrow workers use a big machine far better than one wide one.
+WHISPER_MODEL = os.getenv("RGOV_WHISPER_MODEL", "base.en")
+WHISPER_THREADS = int(os.getenv("RGOV_WHISPER_THREADS", "2"))
+WHISPER_WORKERS = int(
+    os.getenv(
+        "RGOV_WHISPER_WORKERS", str(max(1, (os.cpu_count() or 1) // WHISPER_THREADS))
+    )
+)
+
+# Each worker's model
+_model = None
+
+
+def init_worker(model_name: str, n_threads: int) -> None:
+    """
+    Load the model in a worker process.
+
+    Args:
+        model_name (str): The Whisper model.
+        n_threads (int): The CPU threads the worker may use.
+    """
+    global _model
+    torch.set_num_threads(n_threads)
+    _model = whisper.load_model(model_name, device="cpu")
+
+
+def transcribe_1(id0: str, file_path: str) -> tuple[str, str, float, float]:
+    """
+    Transcribe one talk in a worker process.
+
+    Args:
+        id0 (str): The talk ID.
+        file_path (str): The talk's audio.
+
+    Returns:
+        tuple[str, str, float, float]: The talk ID, the transcript, the length of
+            the audio and the seconds spent transcribing it.
+    """
+    audio = whisper.load_audio(file_path)
+    start = time.perf_counter()
+    result = _model.transcribe(audio, fp16=False)
+    audio_secs = len(audio) / whisper.audio.SAMPLE_RATE
+    return id0, result["text"].strip(), audio_secs, time.perf_counter() - start
+
+
+def save_checkpoint(
+    fp_checkpoints: Path, id0: str, transcript: str, audio_hash: str
+) -> None:
+    """
+    Save one finished transcript, so an interrupted run can pick up from it.
+
+    Args:
+        fp_checkpoints (Path): The checkpoint directory.
+        id0 (str): The talk ID.
+        transcript (str): The transcript.
+        audio_hash (str): The hash of the audio it was transcribed from.
+    """
+    tmp_path = fp_checkpoints / f"{id0}.json.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"transcript": transcript, "audio_hash": audio_hash}, f)
+    os.replace(tmp_path, fp_checkpoints / f"{id0}.json")
+
+
+def load_checkpoint(fp_checkpoints: Path, id0: str, audio_hash: str) -> str | None:
+    """
+    Load a transcript saved by an earlier, interrupted run.
+
+    Args:
+        fp_checkpoints (Path): The checkpoint directory.
+        id0 (str): The talk ID.
+        audio_hash (str): The hash of the talk's audio now.
+
+    Returns:
+        str | None: The transcript, or None if there is none for this audio.
+    """
+    try:
+        with open(fp_checkpoints / f"{id0}.json", "r") as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return None
+    if checkpoint["audio_hash"] != audio_hash:
+        return None
+    return checkpoint["transcript"]
+
+
 if __name__ == "__main__":
     fp_data = here() / "data"
 
@@ -11,16 +109,101 @@ if __name__ == "__main__":
         dcr_data = json.load(f)
 
     fp_audio = fp_data / "audio"
+    fp_checkpoints = fp_data / "transcripts"
+    fp_checkpoints.mkdir(exist_ok=True)
+
+    # Transcripts from the last run, which may not have reached rgov_talks.json
+    try:
+        with open(fp_data / "rgov_talks_v2a.json", "r") as f:
+            old_transcripts = {
+                vid["id0"]: vid.get("transcript") for vid in json.load(f)
+            }
+    except FileNotFoundError:
+        old_transcripts = {}
+
+    # Only transcribe talks whose audio is new or changed.  Talks whose audio
+    # was deleted after transcribing keep their transcript.
+    manifest = Manifest.load(fp_data)
+    to_transcribe = []
+    n_resumed = 0
+    for vid in dcr_data:
+        old_transcript = old_transcripts.get(vid["id0"])
+        file_path = fp_audio / f"vid_{vid['id0']}.mp3"
+        if not file_path.exists():
+            if old_transcript:
+                vid["transcript"] = old_transcript
+            elif not vid.get("transcript"):
+                print(f"{vid['id0']} has no audio")
+            continue
+
+        audio_hash = file_hash(file_path)
+        if manifest.is_current(vid["id0"], "transcribe", audio_hash):
+            if old_transcript:
+                vid["transcript"] = old_transcript
+            if vid.get("transcript"):
+                continue
+        elif vid.get("transcript") and manifest.get(vid["id0"], "transcribe") is None:
+            # Transcribed before there was a manifest
+            manifest.mark(vid["id0"], "transcribe", audio_hash)
+            continue
+
+        # Finished by a run that stopped before writing its results
+        checkpoint = load_checkpoint(fp_checkpoints, vid["id0"], audio_hash)
+        if checkpoint is not None:
+            vid["transcript"] = checkpoint
+            manifest.mark(vid["id0"], "transcribe", audio_hash)
+            n_resumed += 1
+            continue
+        to_transcribe.append((vid, file_path, audio_hash))
+    print(
+        f"Transcribing {len(to_transcribe)} of {len(dcr_data)} talks "
+        f"({n_resumed} resumed from checkpoints)"
+    )
+
+    # Longest first, so no worker is left with a long talk at the end
+    to_transcribe.sort(key=lambda item: item[1].stat().st_size, reverse=True)
+    talks_by_id = {
+        vid["id0"]: (vid, audio_hash) for vid, _, audio_hash in to_transcribe
+    }
 
-    model = whisper.load_model("base.en")
+    total_audio_secs, total_busy_secs = 0.0, 0.0
+    start = time.perf_counter()
+    if to_transcribe:
+        n_workers = min(WHISPER_WORKERS, len(to_transcribe))
+        print(f"{n_workers} workers with {WHISPER_THREADS} threads each")
+        # Spawn rather than fork, so no worker inherits torch's thread pools
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(WHISPER_MODEL, WHISPER_THREADS),
+        ) as pool:
+            futures = {
+                pool.submit(transcribe_1, vid["id0"], str(file_path)): vid["id0"]
+                for vid, file_path, _ in to_transcribe
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                try:
+                    id0, transcript, audio_secs, busy_secs = future.result()
+                except Exception as e:
+                    print(f"{futures[future]} failed with {e}")
+                    continue
+                vid, audio_hash = talks_by_id[id0]
+                vid["transcript"] = transcript
+                save_checkpoint(fp_checkpoints, id0, transcript, audio_hash)
+                manifest.mark(id0, "transcribe", audio_hash)
+                total_audio_secs += audio_secs
+                total_busy_secs += busy_secs
+    wall_secs = time.perf_counter() - start
 
-    for vid in tqdm(dcr_data):
-        file_path = str(fp_audio / f"vid_{vid['id0']}.mp3")
-        try:
-            result = model.transcribe(file_path)
-            vid["transcript"] = result["text"].strip()
-        except Exception as e:
-            print(f"{vid['id0']} failed with {e}")
+    if total_audio_secs:
+        print(
+            f"Transcribed {total_audio_secs / 3600:.2f} h of audio in "
+            f"{wall_secs / 60:.1f} min: "
+            f"{total_audio_secs / wall_secs:.1f} audio-seconds per second, "
+            f"{total_audio_secs / total_busy_secs:.1f} per worker"
+        )
 
     with open(fp_data / "rgov_talks_v2a.json", "w") as f:
         json.dump(dcr_data, f)
+    manifest.save()
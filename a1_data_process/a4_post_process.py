@@ -1,10 +1,15 @@
 import json
 import os
+import sys
 
 from dotenv import load_dotenv
 from openai import OpenAI
 from pyprojroot import here
 
+sys.path.append(str(here() / "b1_rag_fns"))
+
+from b16_manifest import Manifest, content_hash
+
 # from pathlib import Path
 # import shutil
 
@@ -44,12 +49,30 @@ if __name__ == "__main__":
     with open(fp_data / "rgov_talks_v2a.json", "r") as f:
         dcr_data = json.load(f)
 
+    # Abstracts written by the last run, which may not have reached
+    # rgov_talks.json
+    try:
+        with open(fp_data / "rgov_talks_v3.json", "r") as f:
+            old_abstracts = {vid["id0"]: vid["Abstract"] for vid in json.load(f)}
+    except FileNotFoundError:
+        old_abstracts = {}
+
+    # Write abstracts for talks listed without one, and rewrite the ones written
+    # here before when the transcript has changed since
+    manifest = Manifest.load(fp_data)
     for vid in dcr_data:
-        if not vid["Abstract"]:
+        transcript_hash = content_hash(vid["transcript"])
+        written = manifest.get(vid["id0"], "abstract") is not None
+        is_current = manifest.is_current(vid["id0"], "abstract", transcript_hash)
+        if written and is_current:
+            vid["Abstract"] = old_abstracts.get(vid["id0"]) or vid["Abstract"]
+        if not vid["Abstract"] or (written and not is_current):
             print(vid["id0"])
             vid["Abstract"] = make_abstract(vid["transcript"], oai_client)
+            manifest.mark(vid["id0"], "abstract", transcript_hash)
 
     with open(fp_data / "rgov_talks_v3.json", "w") as f:
         json.dump(dcr_data, f)
+    manifest.save()
 
     # shutil.rmtree(fp_audio)
@@ -1,13 +1,139 @@
 import json
 import os
+import sys
+from pathlib import Path
 
-# from pathlib import Path
 # import shutil
 import numpy as np
 from dotenv import load_dotenv
 from openai import OpenAI
 from pyprojroot import here
 
+sys.path.append(str(here() / "b1_rag_fns"))
+
+from b12_retrievers import array_hash, quantize_binary, quantize_int8
+from b14_embedders import EMBEDDER, get_embedder
+from b16_manifest import Manifest, content_hash
+
+# Compact copies of the embeddings to write as well, e.g. "int8,binary"
+QUANTIZE = [kind for kind in os.getenv("RGOV_QUANTIZE", "").split(",") if kind]
+
+
+def save_embeds_npy(
+    fp_data: Path,
+    all_embeds: np.ndarray,
+    ids: list[str],
+    model_name: str,
+    quantized: dict[str, str] | None = None,
+) -> None:
+    """
+    Save the embeddings as float32 embeds.npy plus an embeds_meta.json header.
+
+    Args:
+        fp_data (Path): The data directory.
+        all_embeds (np.ndarray): The embeddings, one row per talk.
+        ids (list[str]): The id0 of the talk in each row.
+        model_name (str): The embedding model that produced the rows.
+        quantized (dict[str, str] | None): The hash of each quantized copy
+            `save_embeds_quantized` wrote for these rows, by file name.
+    """
+    embeds32 = np.ascontiguousarray(all_embeds, dtype=np.float32)
+    embeds_meta = {
+        "model": model_name,
+        "dim": int(embeds32.shape[1]),
+        "dtype": "float32",
+        "ids": ids,
+        # Ties the header to this exact matrix, so a reader that catches the
+        # new matrix with the old header (or the reverse) can tell
+        "hash": array_hash(embeds32),
+        # The apps only use the quantized copies listed here, and only while
+        # their hashes match
+        "quantized": quantized or {},
+    }
+
+    # Write then rename, so a running app never maps a half-written file.  The
+    # header goes last: it is what makes the new matrix current.
+    tmp_npy = fp_data / "embeds.npy.tmp"
+    with open(tmp_npy, "wb") as f:
+        np.save(f, embeds32)
+    os.replace(tmp_npy, fp_data / "embeds.npy")
+
+    tmp_meta = fp_data / "embeds_meta.json.tmp"
+    with open(tmp_meta, "w") as f:
+        json.dump(embeds_meta, f)
+    os.replace(tmp_meta, fp_data / "embeds_meta.json")
+
+
+def load_embeds_by_id(fp_data: Path, model_name: str) -> dict[str, np.ndarray]:
+    """
+    Load the embeddings saved by the last run, to reuse the unchanged ones.
+
+    Args:
+        fp_data (Path): The data directory.
+        model_name (str): The embedding model of this run.
+
+    Returns:
+        dict[str, np.ndarray]: The embedding of each talk, keyed by id0.  Empty
+            when there are none, or another model made them.
+    """
+    try:
+        with open(fp_data / "embeds_meta.json", "r") as f:
+            embeds_meta = json.load(f)
+        embeds = np.load(fp_data / "embeds.npy")
+    except FileNotFoundError:
+        return {}
+    if embeds_meta.get("model") != model_name:
+        return {}
+    return dict(zip(embeds_meta["ids"], embeds))
+
+
+def save_embeds_quantized(
+    fp_data: Path, all_embeds: np.ndarray, kinds: list[str]
+) -> dict[str, str]:
+    """
+    Save quantized copies of the embeddings next to embeds.npy.
+
+    "int8" writes embeds_int8.npy and the per-dimension embeds_int8_scales.npy
+    (a quarter of the float32 size), and "binary" writes the packed sign bits
+    as embeds_binary.npy (a thirty-second).  Rows are in the same order as
+    embeds.npy, and unit-norm before quantizing.  The apps load these instead
+    of quantizing embeds.npy themselves (RGOV_RETRIEVER=int8 or binary).
+
+    Call this before `save_embeds_npy`, and pass it the hashes returned, so the
+    header only lists copies that are already in place.
+
+    Args:
+        fp_data (Path): The data directory.
+        all_embeds (np.ndarray): The embeddings, one row per talk.
+        kinds (list[str]): Which of "int8" and "binary" to write.
+
+    Returns:
+        dict[str, str]: The `array_hash` of each file written, by file name.
+    """
+    embeds32 = np.ascontiguousarray(all_embeds, dtype=np.float32)
+    embeds32 /= np.linalg.norm(embeds32, axis=1, keepdims=True)
+
+    arrays = {}
+    for kind in kinds:
+        if kind == "int8":
+            arrays["embeds_int8"], arrays["embeds_int8_scales"] = quantize_int8(
+                embeds32
+            )
+        elif kind == "binary":
+            arrays["embeds_binary"] = quantize_binary(embeds32)
+        else:
+            raise ValueError(f"Unknown quantization {kind!r}; use int8 or binary")
+
+    hashes = {}
+    for name, array in arrays.items():
+        tmp_npy = fp_data / f"{name}.npy.tmp"
+        with open(tmp_npy, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_npy, fp_data / f"{name}.npy")
+        hashes[f"{name}.npy"] = array_hash(array)
+    return hashes
+
+
 if __name__ == "__main__":
     load_dotenv()
     oai_api_key = os.getenv("OPENAI_API_KEY")
@@ -19,11 +145,38 @@ if __name__ == "__main__":
     with open(fp_data / "rgov_talks.json", "r") as f:
         dcr_data = json.load(f)
 
-    all_abstracts = [vid["Abstract"] for vid in dcr_data]
-    all_embeds_responses = oai_client.embeddings.create(
-        input=all_abstracts, model="text-embedding-3-small"
-    )
-    all_embeds = np.stack([ee.embedding for ee in all_embeds_responses.data])
+    embed_model = "text-embedding-3-small"
+    if EMBEDDER == "local":
+        # The apps must then embed questions locally too (RGOV_EMBEDDER=local)
+        embedder = get_embedder()
+        embed_model = embedder.model_name
+
+    # Only embed the abstracts that are new or changed (or all of them when the
+    # model has), and reuse the rest from the last run
+    manifest = Manifest.load(fp_data)
+    old_embeds = load_embeds_by_id(fp_data, embed_model)
+    embed_hashes = {
+        vid["id0"]: content_hash(embed_model, vid["Abstract"]) for vid in dcr_data
+    }
+    to_embed = [
+        vid
+        for vid in dcr_data
+        if vid["id0"] not in old_embeds
+        or not manifest.is_current(vid["id0"], "embed", embed_hashes[vid["id0"]])
+    ]
+    print(f"Embedding {len(to_embed)} of {len(dcr_data)} abstracts")
+
+    new_abstracts = [vid["Abstract"] for vid in to_embed]
+    new_embeds = []
+    if new_abstracts and EMBEDDER == "local":
+        new_embeds = embedder.embed(new_abstracts)
+    elif new_abstracts:
+        all_embeds_responses = oai_client.embeddings.create(
+            input=new_abstracts, model=embed_model
+        )
+        new_embeds = [ee.embedding for ee in all_embeds_responses.data]
+    old_embeds.update(zip([vid["id0"] for vid in to_embed], new_embeds))
+    all_embeds = np.stack([old_embeds[vid["id0"]] for vid in dcr_data])
 
     np.savetxt(
         fp_data / "embeds.csv",
@@ -31,3 +184,20 @@ if __name__ == "__main__":
         delimiter=",",
         fmt="%0.16f",
     )
+
+    quantized = {}
+    if QUANTIZE:
+        quantized = save_embeds_quantized(fp_data, all_embeds, QUANTIZE)
+
+    # Compact binary copy that the apps memory-map instead of parsing the CSV
+    save_embeds_npy(
+        fp_data,
+        all_embeds,
+        ids=[vid["id0"] for vid in dcr_data],
+        model_name=embed_model,
+        quantized=quantized,
+    )
+
+    for id0, embed_hash in embed_hashes.items():
+        manifest.mark(id0, "embed", embed_hash)
+    manifest.save()
@@ -0,0 +1,168 @@
+import json
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+from dotenv import load_dotenv
+from openai import OpenAI
+from pyprojroot import here
+
+sys.path.append(str(here() / "b1_rag_fns"))
+
+from b12_retrievers import array_hash
+from b14_embedders import EMBEDDER, get_embedder
+from b16_manifest import Manifest, content_hash
+from b6_chunks import CHUNK_CHARS, OVERLAP_CHARS, split_transcript
+
+# Chunks sent per embeddings request
+BATCH_SIZE = 256
+
+
+def embed_in_batches(
+    texts: list[str], oai_client: OpenAI, model_name: str, batch_size: int = BATCH_SIZE
+) -> np.ndarray:
+    """
+    Embed texts with one API request per batch.
+
+    Args:
+        texts (list[str]): The texts to embed.
+        oai_client (OpenAI): The OpenAI client.
+        model_name (str): The embedding model.
+        batch_size (int): How many texts to send per request.
+
+    Returns:
+        np.ndarray: The float32 embeddings, one row per text.
+    """
+    all_embeds = []
+    for i in range(0, len(texts), batch_size):
+        batch_response = oai_client.embeddings.create(
+            input=texts[i : i + batch_size], model=model_name
+        )
+        batch_data = sorted(batch_response.data, key=lambda ee: ee.index)
+        all_embeds.extend(ee.embedding for ee in batch_data)
+        print(f"Embedded {min(i + batch_size, len(texts))}/{len(texts)} chunks")
+    return np.asarray(all_embeds, dtype=np.float32)
+
+
+def load_chunks_by_id(
+    fp_data: Path, model_name: str
+) -> dict[str, tuple[list[tuple[int, int]], list[np.ndarray]]]:
+    """
+    Load the chunks saved by the last run, to reuse the unchanged ones.
+
+    Args:
+        fp_data (Path): The data directory.
+        model_name (str): The embedding model of this run.
+
+    Returns:
+        dict[str, tuple[list[tuple[int, int]], list[np.ndarray]]]: For each talk
+            with chunks, keyed by id0, their (start, end) offsets and embeddings.
+            Empty when there are none, or another model made them.
+    """
+    try:
+        with open(fp_data / "chunks_meta.json", "r") as f:
+            chunks_meta = json.load(f)
+        embeds = np.load(fp_data / "chunks.npy")
+    except FileNotFoundError:
+        return {}
+    if chunks_meta.get("model") != model_name:
+        return {}
+
+    chunks_by_id = {}
+    for id0, start, end, row in zip(
+        chunks_meta["ids"], chunks_meta["starts"], chunks_meta["ends"], embeds
+    ):
+        spans, rows = chunks_by_id.setdefault(id0, ([], []))
+        spans.append((start, end))
+        rows.append(row)
+    return chunks_by_id
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    oai_api_key = os.getenv("OPENAI_API_KEY")
+    oai_client = OpenAI(api_key=oai_api_key)
+
+    fp_data = here() / "data"
+    embed_model = "text-embedding-3-small"
+
+    with open(fp_data / "rgov_talks.json", "r") as f:
+        dcr_data = json.load(f)
+
+    if EMBEDDER == "local":
+        embedder = get_embedder()
+        embed_model = embedder.model_name
+
+    # Only chunk and embed the transcripts that are new or changed (or all of
+    # them when the model or chunking has), and reuse the rest from the last run
+    manifest = Manifest.load(fp_data)
+    old_chunks = load_chunks_by_id(fp_data, embed_model)
+    chunk_hashes = {
+        vid["id0"]: content_hash(
+            embed_model, CHUNK_CHARS, OVERLAP_CHARS, vid.get("transcript") or ""
+        )
+        for vid in dcr_data
+    }
+
+    # Overlapping windows over each transcript, kept as offsets into it
+    new_ids, new_spans, chunk_texts = [], [], []
+    n_stale = 0
+    for vid in dcr_data:
+        transcript = vid.get("transcript") or ""
+        if manifest.is_current(vid["id0"], "chunks", chunk_hashes[vid["id0"]]) and (
+            vid["id0"] in old_chunks or not transcript
+        ):
+            continue
+        n_stale += 1
+        old_chunks.pop(vid["id0"], None)
+        for start, end in split_transcript(transcript):
+            new_ids.append(vid["id0"])
+            new_spans.append((start, end))
+            chunk_texts.append(transcript[start:end])
+    print(f"Chunking {n_stale} of {len(dcr_data)} transcripts")
+
+    if chunk_texts and EMBEDDER == "local":
+        new_embeds = embedder.embed(chunk_texts)
+    elif chunk_texts:
+        new_embeds = embed_in_batches(chunk_texts, oai_client, embed_model)
+    for i, id0 in enumerate(new_ids):
+        spans, rows = old_chunks.setdefault(id0, ([], []))
+        spans.append(new_spans[i])
+        rows.append(new_embeds[i])
+
+    # Chunks stay in talk order
+    chunk_ids, chunk_starts, chunk_ends, all_rows = [], [], [], []
+    for vid in dcr_data:
+        spans, rows = old_chunks.get(vid["id0"], ([], []))
+        chunk_ids.extend([vid["id0"]] * len(spans))
+        chunk_starts.extend(int(start) for start, _ in spans)
+        chunk_ends.extend(int(end) for _, end in spans)
+        all_rows.extend(rows)
+    chunk_embeds = np.asarray(all_rows, dtype=np.float32)
+
+    # As in a5_embed: the matrix first, then the header that points at it
+    tmp_npy = fp_data / "chunks.npy.tmp"
+    with open(tmp_npy, "wb") as f:
+        np.save(f, chunk_embeds)
+    os.replace(tmp_npy, fp_data / "chunks.npy")
+
+    chunks_meta = {
+        "model": embed_model,
+        "dim": int(chunk_embeds.shape[1]),
+        "dtype": "float32",
+        "chunk_chars": CHUNK_CHARS,
+        "overlap_chars": OVERLAP_CHARS,
+        "ids": chunk_ids,
+        "starts": chunk_starts,
+        "ends": chunk_ends,
+        "hash": array_hash(chunk_embeds),
+    }
+    tmp_meta = fp_data / "chunks_meta.json.tmp"
+    with open(tmp_meta, "w") as f:
+        json.dump(chunks_meta, f)
+    os.replace(tmp_meta, fp_data / "chunks_meta.json")
+
+    for id0, chunk_hash in chunk_hashes.items():
+        manifest.mark(id0, "chunks", chunk_hash)
+    manifest.save()
@@ -0,0 +1,313 @@
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# List prices in US dollars per million tokens.  Dated snapshots such as
+# "gpt-4o-2024-08-06" are priced by the longest name they start with.
+# RGOV_MODEL_PRICES can name a JSON file of the same shape to add models or
+# update prices without a code change.
+MODEL_PRICES: dict[str, dict[str, float]] = {
+    "gpt-4o-mini": {"prompt": 0.15, "completion": 0.60},
+    "gpt-4o": {"prompt": 5.00, "completion": 15.00},
+    "gpt-4-turbo": {"prompt": 10.00, "completion": 30.00},
+    "gpt-3.5-turbo": {"prompt": 0.50, "completion": 1.50},
+    "text-embedding-3-small": {"prompt": 0.02, "completion": 0.0},
+    "text-embedding-3-large": {"prompt": 0.13, "completion": 0.0},
+    "text-embedding-ada-002": {"prompt": 0.10, "completion": 0.0},
+    # Embedding models run in-process by b14_embedders
+    "local:": {"prompt": 0.0, "completion": 0.0},
+}
+MODEL_PRICES_PATH = os.getenv("RGOV_MODEL_PRICES")
+if MODEL_PRICES_PATH:
+    with open(MODEL_PRICES_PATH) as f:
+        MODEL_PRICES.update(json.load(f))
+
+
+def get_prices(model_name: str) -> dict[str, float] | None:
+    """
+    Look up the per-million-token prices of a model.
+
+    Args:
+        model_name (str): The model.
+
+    Returns:
+        dict[str, float] | None: The "prompt" and "completion" prices in dollars,
+            or None if the model is not in the price table.
+    """
+    matches = [name for name in MODEL_PRICES if model_name.startswith(name)]
+    if not matches:
+        return None
+    return MODEL_PRICES[max(matches, key=len)]
+
+
+def calc_cost(
+    prompt_tokens: int,
+    completion_tokens: int,
+    embedding_tokens: int,
+    model_name: str = "gpt-4o",
+    embed_model_name: str = "text-embedding-3-small",
+) -> float:
+    """
+    Calculate the cost in cents based on the number of prompt, completion, and embedding tokens.
+
+    Args:
+        prompt_tokens (int): The number of tokens in the prompt.
+        completion_tokens (int): The number of tokens in the completion.
+        embedding_tokens (int): The number of tokens in the embedding.
+        model_name (str): The chat model.
+        embed_model_name (str): The embedding model.
+
+    Returns:
+        float: The cost in cents.
+    """
+    chat_prices = get_prices(model_name)
+    embed_prices = get_prices(embed_model_name)
+    for name, prices in ((model_name, chat_prices), (embed_model_name, embed_prices)):
+        if prices is None:
+            raise ValueError(f"No price is known for model {name!r}")
+
+    prompt_cost = prompt_tokens * chat_prices["prompt"]
+    completion_cost = completion_tokens * chat_prices["completion"]
+    embedding_cost = embedding_tokens * embed_prices["prompt"]
+
+    # Dollars per million tokens to cents
+    cost_cents = (prompt_cost + completion_cost + embedding_cost) / 10_000
+
+    return cost_cents
+
+
+@dataclass
+class Usage:
+    """
+    The tokens one question used, and what they cost.
+
+    When the answer is streamed, the completion counts are filled in once the
+    stream has been read to the end.
+
+    Attributes:
+        model_name (str): The chat model.
+        embed_model_name (str): The embedding model.
+        prompt_tokens (int): Prompt tokens billed for the completion.
+        completion_tokens (int): Completion tokens billed.
+        embedding_tokens (int): Tokens billed for embedding the question; 0 when
+            the embedding came from the cache.
+        answer_cached (bool): Whether the answer came from a cache, so no
+            completion was requested.
+        complete (bool): Whether the counts are final.
+    """
+
+    model_name: str
+    embed_model_name: str = "text-embedding-3-small"
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    embedding_tokens: int = 0
+    answer_cached: bool = False
+    complete: bool = False
+
+    def add_completion(self, completion_info: dict) -> None:
+        """
+        Take the token counts from a completion's `completion_info`.
+
+        Args:
+            completion_info (dict): As filled in by `do_1_query`.
+        """
+        if completion_info.get("cached"):
+            self.answer_cached = True
+        usage = completion_info.get("usage") or {}
+        self.prompt_tokens += usage.get("prompt_tokens", 0)
+        self.completion_tokens += usage.get("completion_tokens", 0)
+
+    @property
+    def prices(self) -> dict[str, dict[str, float] | None]:
+        """The price table entries used for the chat and embedding models."""
+        return {
+            "chat": get_prices(self.model_name),
+            "embedding": get_prices(self.embed_model_name),
+        }
+
+    @property
+    def cost_cents(self) -> float | None:
+        """The cost in cents, or None if a model has no known price."""
+        try:
+            return calc_cost(
+                self.prompt_tokens,
+                self.completion_tokens,
+                self.embedding_tokens,
+                model_name=self.model_name,
+                embed_model_name=self.embed_model_name,
+            )
+        except ValueError:
+            return None
+
+    def to_dict(self) -> dict:
+        """
+        Get the usage, cost and prices as plain data, e.g. for logging.
+
+        Returns:
+            dict: The fields plus "cost_cents" and "prices".
+        """
+        return {
+            "model_name": self.model_name,
+            "embed_model_name": self.embed_model_name,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "embedding_tokens": self.embedding_tokens,
+            "answer_cached": self.answer_cached,
+            "complete": self.complete,
+            "cost_cents": self.cost_cents,
+            "prices": self.prices,
+        }
+
+
+@dataclass
+class RagResult:
+    """
+    The answer to one question, with what it took to produce.
+
+    Unpacks as `(response, retrieved_docs)`, like the tuple `do_rag` used to return.
+
+    Attributes:
+        response (str | Iterator[str] | AsyncIterator[str]): The answer, or an
+            iterator over its pieces when streaming.
+        retrieved_docs (list[dict]): The retrieved documents.
+        usage (Usage): Token counts and cost.  Final once the stream is read.
+        timings (dict[str, float]): Seconds spent in each stage.
+    """
+
+    response: str | Iterator[str] | AsyncIterator[str]
+    retrieved_docs: list[dict]
+    usage: Usage
+    timings: dict[str, float] = field(default_factory=dict)
+
+    def __iter__(self):
+        return iter((self.response, self.retrieved_docs))
+
+
+class UsageTotals:
+    """
+    Thread-safe running totals of token usage and cost, e.g. for one session.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.cached_answers = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.embedding_tokens = 0
+        self.cost_cents = 0.0
+        self.unpriced_requests = 0
+
+    def add(self, usage: Usage) -> None:
+        """
+        Count one question's usage.
+
+        Args:
+            usage (Usage): The usage.
+        """
+        cost_cents = usage.cost_cents
+        with self._lock:
+            self.requests += 1
+            self.cached_answers += usage.answer_cached
+            self.prompt_tokens += usage.prompt_tokens
+            self.completion_tokens += usage.completion_tokens
+            self.embedding_tokens += usage.embedding_tokens
+            if cost_cents is None:
+                self.unpriced_requests += 1
+            else:
+                self.cost_cents += cost_cents
+
+    def snapshot(self) -> dict[str, int | float]:
+        """
+        Get the totals so far.
+
+        Returns:
+            dict[str, int | float]: The request count, cached answers, token
+                counts, cost in cents, and requests with an unknown price.
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "cached_answers": self.cached_answers,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "embedding_tokens": self.embedding_tokens,
+                "cost_cents": self.cost_cents,
+                "unpriced_requests": self.unpriced_requests,
+            }
+
+
+_usage_totals: UsageTotals | None = None
+_usage_totals_lock = threading.Lock()
+
+
+def get_usage_totals() -> UsageTotals:
+    """
+    Get the usage totals for every session in this process.
+
+    Returns:
+        UsageTotals: The process-wide usage totals.
+    """
+    global _usage_totals
+    if _usage_totals is None:
+        with _usage_totals_lock:
+            if _usage_totals is None:
+                _usage_totals = UsageTotals()
+    return _usage_totals
+
+
+def record_usage(usage: Usage, session_usage: UsageTotals | None = None) -> None:
+    """
+    Mark a question's usage final and add it to the process (and session) totals.
+
+    Args:
+        usage (Usage): The usage.
+        session_usage (UsageTotals | None): The caller's own totals, if any.
+    """
+    usage.complete = True
+    get_usage_totals().add(usage)
+    if session_usage is not None:
+        session_usage.add(usage)
+    logger.debug(f"Usage: {usage.to_dict()}")
+
+
+def call_when_done(pieces: Iterator[str], fn: Callable[[], None]) -> Iterator[str]:
+    """
+    Pass a stream through, calling `fn` once it ends or is closed.
+
+    Args:
+        pieces (Iterator[str]): The stream.
+        fn (Callable[[], None]): Called with no arguments at the end.
+
+    Yields:
+        str: The pieces of the stream.
+    """
+    try:
+        yield from pieces
+    finally:
+        fn()
+
+
+async def acall_when_done(
+    pieces: AsyncIterator[str], fn: Callable[[], None]
+) -> AsyncIterator[str]:
+    """
+    Pass an async stream through, calling `fn` once it ends or is closed.
+
+    Args:
+        pieces (AsyncIterator[str]): The stream.
+        fn (Callable[[], None]): Called with no arguments at the end.
+
+    Yields:
+        str: The pieces of the stream.
+    """
+    try:
+        async for piece in pieces:
+            yield piece
+    finally:
+        fn()
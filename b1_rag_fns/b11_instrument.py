@@ -0,0 +1,438 @@
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Iterator
+
+import numpy as np
+
+# Write every span and measurement to this JSON-lines file.  Without it,
+# instrumentation is off unless an app installs its own with `set_instrument`.
+TRACE_PATH = os.getenv("RGOV_TRACE_PATH")
+
+# How many recent spans and values per histogram the in-process collector keeps
+COLLECTOR_SAMPLES = int(os.getenv("RGOV_COLLECTOR_SAMPLES", "10000"))
+
+# The span that is open in the current thread or task
+_current_span: contextvars.ContextVar["Span | None"] = contextvars.ContextVar(
+    "rgov_current_span", default=None
+)
+_span_ids = itertools.count(1)
+
+
+class Span:
+    """
+    A timed stage of the pipeline.  Use as a context manager.
+
+    The duration is always measured, so callers can read it back, but the span
+    is only passed to the instrument (and given ids) when instrumentation is on.
+
+    Attributes:
+        name (str): The stage.
+        attrs (dict): Extra fields to export with the span.
+        duration (float | None): Seconds the span was open, once it has closed.
+        trace_id (int | None): The id of the outermost span it is nested in.
+        span_id (int | None): Its own id.
+        parent_id (int | None): The id of the span it is nested in.
+    """
+
+    __slots__ = (
+        "instrument",
+        "name",
+        "attrs",
+        "start",
+        "wall_start",
+        "duration",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "_token",
+    )
+
+    def __init__(self, instrument: "Instrument", name: str, attrs: dict) -> None:
+        self.instrument = instrument
+        self.name = name
+        self.attrs = attrs
+        self.duration = None
+        self.trace_id = self.span_id = self.parent_id = None
+        self._token = None
+
+    def __enter__(self) -> "Span":
+        if self.instrument.enabled:
+            parent = _current_span.get()
+            self.span_id = next(_span_ids)
+            if parent is None:
+                self.trace_id = self.span_id
+            else:
+                self.trace_id, self.parent_id = parent.trace_id, parent.span_id
+            self._token = _current_span.set(self)
+            self.wall_start = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.duration = time.perf_counter() - self.start
+        if self._token is not None:
+            _current_span.reset(self._token)
+            if exc_type is not None:
+                self.attrs["error"] = exc_type.__name__
+            self.instrument.on_span(self)
+
+    def to_dict(self) -> dict:
+        """
+        Get the span as plain data.
+
+        Returns:
+            dict: The span's fields.
+        """
+        return {
+            "type": "span",
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.wall_start,
+            "duration": self.duration,
+            **self.attrs,
+        }
+
+
+def current_trace_id() -> int | None:
+    """
+    Get the trace id of the span open in this thread or task, if there is one.
+    """
+    span = _current_span.get()
+    return None if span is None else span.trace_id
+
+
+class Instrument:
+    """
+    Receives the spans and measurements of the pipeline.
+
+    This base class discards everything and is the default.  Subclasses set
+    `enabled` and override `on_span` and `on_value`.
+    """
+
+    enabled = False
+
+    def span(self, name: str, **attrs) -> Span:
+        """
+        Start timing a stage.
+
+        Args:
+            name (str): The stage.
+            **attrs: Extra fields to export with the span.
+
+        Returns:
+            Span: The span, to be used as a context manager.
+        """
+        return Span(self, name, attrs)
+
+    def record(self, name: str, value: float, trace_id: int | None = None, **attrs):
+        """
+        Add a value to a histogram.
+
+        Args:
+            name (str): The histogram.
+            value (float): The value.
+            trace_id (int | None): The trace it belongs to.  Defaults to the
+                trace of the open span.
+            **attrs: Extra fields to export with the value.
+        """
+        if self.enabled:
+            if trace_id is None:
+                trace_id = current_trace_id()
+            self.on_value(name, value, trace_id, attrs)
+
+    def on_span(self, span: Span) -> None:
+        pass
+
+    def on_value(
+        self, name: str, value: float, trace_id: int | None, attrs: dict
+    ) -> None:
+        pass
+
+
+class Collector(Instrument):
+    """
+    Keeps recent spans and histogram values in memory and summarizes them.
+
+    Span durations go into a histogram named after the span.
+    """
+
+    enabled = True
+
+    def __init__(self, max_samples: int = COLLECTOR_SAMPLES) -> None:
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._spans = deque(maxlen=max_samples)
+        self._histograms: dict[str, deque] = {}
+
+    def on_span(self, span: Span) -> None:
+        with self._lock:
+            self._spans.append(span.to_dict())
+            self._add(span.name, span.duration)
+
+    def on_value(
+        self, name: str, value: float, trace_id: int | None, attrs: dict
+    ) -> None:
+        with self._lock:
+            self._add(name, value)
+
+    def _add(self, name: str, value: float) -> None:
+        values = self._histograms.get(name)
+        if values is None:
+            values = self._histograms[name] = deque(maxlen=self.max_samples)
+        values.append(value)
+
+    def spans(self) -> list[dict]:
+        """
+        Get the recent spans, oldest first.
+
+        Returns:
+            list[dict]: The spans as plain data.
+        """
+        with self._lock:
+            return list(self._spans)
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """
+        Summarize each histogram.
+
+        Returns:
+            dict[str, dict[str, float]]: For each histogram, the count, mean,
+                median, 95th and 99th percentiles and maximum.
+        """
+        with self._lock:
+            histograms = {
+                name: list(values) for name, values in self._histograms.items()
+            }
+
+        summary = {}
+        for name, values in histograms.items():
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            summary[name] = {
+                "count": len(values),
+                "mean": float(np.mean(values)),
+                "p50": float(p50),
+                "p95": float(p95),
+                "p99": float(p99),
+                "max": float(np.max(values)),
+            }
+        return summary
+
+    def clear(self) -> None:
+        """Forget everything collected so far."""
+        with self._lock:
+            self._spans.clear()
+            self._histograms.clear()
+
+
+class JsonLinesExporter(Instrument):
+    """
+    Appends each span and measurement to a file as one line of JSON.
+    """
+
+    enabled = True
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def on_span(self, span: Span) -> None:
+        self._write(span.to_dict())
+
+    def on_value(
+        self, name: str, value: float, trace_id: int | None, attrs: dict
+    ) -> None:
+        self._write(
+            {
+                "type": "value",
+                "name": name,
+                "trace_id": trace_id,
+                "time": time.time(),
+                "value": value,
+                **attrs,
+            }
+        )
+
+    def _write(self, event: dict) -> None:
+        line = json.dumps(event, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class Tee(Instrument):
+    """
+    Sends everything to several instruments, e.g. a collector and an exporter.
+    """
+
+    enabled = True
+
+    def __init__(self, *instruments: Instrument) -> None:
+        self.instruments = [inst for inst in instruments if inst.enabled]
+
+    def on_span(self, span: Span) -> None:
+        for inst in self.instruments:
+            inst.on_span(span)
+
+    def on_value(
+        self, name: str, value: float, trace_id: int | None, attrs: dict
+    ) -> None:
+        for inst in self.instruments:
+            inst.on_value(name, value, trace_id, attrs)
+
+
+_instrument: Instrument = JsonLinesExporter(TRACE_PATH) if TRACE_PATH else Instrument()
+
+
+def get_instrument() -> Instrument:
+    """
+    Get the instrument the pipeline reports to.
+
+    Returns:
+        Instrument: The process-wide instrument.
+    """
+    return _instrument
+
+
+def set_instrument(instrument: Instrument | None) -> None:
+    """
+    Replace the process-wide instrument.
+
+    Args:
+        instrument (Instrument | None): The new instrument.  None turns
+            instrumentation off.
+    """
+    global _instrument
+    _instrument = Instrument() if instrument is None else instrument
+
+
+def record_generation(
+    instrument: Instrument,
+    start: float,
+    first_token_at: float | None,
+    n_pieces: int,
+    completion_info: dict | None,
+    trace_id: int | None,
+    **attrs,
+) -> None:
+    """
+    Record how long a completion took and how fast its tokens came.
+
+    Args:
+        instrument (Instrument): Where to record.
+        start (float): `time.perf_counter()` when the request was sent.
+        first_token_at (float | None): `time.perf_counter()` when the first
+            text arrived, for a stream.
+        n_pieces (int): How many pieces of text arrived, used as the token
+            count if the API did not report one.
+        completion_info (dict | None): As filled in by `do_1_query`.
+        trace_id (int | None): The trace the completion belongs to.
+        **attrs: Extra fields to export with each value.
+    """
+    end = time.perf_counter()
+    instrument.record("generation", end - start, trace_id=trace_id, **attrs)
+    if first_token_at is None:
+        first_token_at = start
+    else:
+        instrument.record("ttft", first_token_at - start, trace_id=trace_id, **attrs)
+
+    usage = (completion_info or {}).get("usage") or {}
+    n_tokens = usage.get("completion_tokens", n_pieces)
+    if n_tokens and end > first_token_at:
+        instrument.record(
+            "tokens_per_sec",
+            n_tokens / (end - first_token_at),
+            trace_id=trace_id,
+            **attrs,
+        )
+
+
+def measure_stream(
+    pieces: Iterator[str], start: float, completion_info: dict | None = None, **attrs
+) -> Iterator[str]:
+    """
+    Pass a streamed answer through, recording time to first token, total
+    generation time and tokens per second.
+
+    Args:
+        pieces (Iterator[str]): The stream.
+        start (float): `time.perf_counter()` when the request was sent.
+        completion_info (dict | None): Filled in by the stream, for the token count.
+        **attrs: Extra fields to export with each value.
+
+    Returns:
+        Iterator[str]: The pieces of the stream.
+    """
+    instrument = get_instrument()
+    if not instrument.enabled:
+        return pieces
+    # The stream is read after the caller's spans have closed, so take the
+    # trace id now
+    return _measure_stream(
+        pieces, instrument, start, current_trace_id(), completion_info, attrs
+    )
+
+
+def _measure_stream(pieces, instrument, start, trace_id, completion_info, attrs):
+    first_token_at = None
+    n_pieces = 0
+    for piece in pieces:
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+        n_pieces += 1
+        yield piece
+    record_generation(
+        instrument, start, first_token_at, n_pieces, completion_info, trace_id, **attrs
+    )
+
+
+def ameasure_stream(
+    pieces: AsyncIterator[str],
+    start: float,
+    completion_info: dict | None = None,
+    **attrs,
+) -> AsyncIterator[str]:
+    """
+    Like `measure_stream`, for an async stream.
+
+    Args:
+        pieces (AsyncIterator[str]): The stream.
+        start (float): `time.perf_counter()` when the request was sent.
+        completion_info (dict | None): Filled in by the stream, for the token count.
+        **attrs: Extra fields to export with each value.
+
+    Returns:
+        AsyncIterator[str]: The pieces of the stream.
+    """
+    instrument = get_instrument()
+    if not instrument.enabled:
+        return pieces
+    return _ameasure_stream(
+        pieces, instrument, start, current_trace_id(), completion_info, attrs
+    )
+
+
+async def _ameasure_stream(
+    pieces, instrument, start, trace_id, completion_info, attrs
+):
+    first_token_at = None
+    n_pieces = 0
+    async for piece in pieces:
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+        n_pieces += 1
+        yield piece
+    record_generation(
+        instrument, start, first_token_at, n_pieces, completion_info, trace_id, **attrs
+    )
@@ -0,0 +1,635 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Which retriever to use for embedding matrices of at least ANN_MIN_ROWS rows.
+# Smaller matrices are always searched exactly, which is faster at that size.
+RETRIEVER = os.getenv("RGOV_RETRIEVER", "exact")
+ANN_MIN_ROWS = int(os.getenv("RGOV_ANN_MIN_ROWS", "50000"))
+
+# IVF settings.  More probes raise recall at the cost of latency.  Without an
+# explicit list count, 4 * sqrt(rows) is used.
+IVF_NPROBE = int(os.getenv("RGOV_IVF_NPROBE", "8"))
+IVF_N_LISTS = int(os.getenv("RGOV_IVF_N_LISTS", "0")) or None
+
+# Where built indexes are kept, keyed by a fingerprint of the data they index
+INDEX_DIR = Path(
+    os.getenv(
+        "RGOV_INDEX_DIR", Path(tempfile.gettempdir()) / "rgov_cache" / "indexes"
+    )
+)
+
+# Chunk candidates fetched per talk wanted, when talks are ranked by their best
+# chunk through an approximate index
+ANN_CANDIDATES = int(os.getenv("RGOV_ANN_CANDIDATES", "8"))
+
+# Quantized retrievers score every row on compact codes, then re-rank this many
+# candidates per result with the float32 rows.  Binary codes are coarser, so
+# they need more candidates for the same recall.
+INT8_RERANK = int(os.getenv("RGOV_INT8_RERANK", "4"))
+BINARY_RERANK = int(os.getenv("RGOV_BINARY_RERANK", "100"))
+
+# Rows scored per matrix product while building, to bound the temporary memory
+BUILD_BLOCK_ROWS = 16384
+
+# Bytes of codes decoded at a time when scanning quantized rows, small enough
+# for the decoded block to stay in cache
+SCAN_BLOCK_BYTES = 1 << 18
+
+if hasattr(np, "bitwise_count"):
+    popcount = np.bitwise_count
+else:  # NumPy < 2.0
+    _POPCOUNTS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def popcount(words: np.ndarray) -> np.ndarray:
+        return _POPCOUNTS[words.view(np.uint8)]
+
+
+def top_k_indices(scores: np.ndarray, top_k: int | None) -> np.ndarray:
+    """
+    Get the indices of the highest scores, best first.
+
+    Only the best `top_k` are sorted, so this is O(N + k log k) rather than
+    O(N log N).
+
+    Args:
+        scores (np.ndarray): The scores to rank.
+        top_k (int | None): How many indices to return.  None returns all of them.
+
+    Returns:
+        np.ndarray: The indices of the `top_k` highest scores, in descending order.
+    """
+    neg_scores = -scores
+    if top_k is None or top_k >= len(scores):
+        return np.argsort(neg_scores)
+    if top_k <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    best = np.argpartition(neg_scores, top_k - 1)[:top_k]
+    return best[np.argsort(neg_scores[best])]
+
+
+class Retriever:
+    """
+    Finds the rows of an embedding matrix most similar to a query.
+
+    Rows and queries are unit-norm, so similarity is the dot product.
+    """
+
+    name = "base"
+
+    def search(self, embed_q: np.ndarray, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the rows most similar to a query.
+
+        Args:
+            embed_q (np.ndarray): The unit-norm query embedding.
+            top_k (int): How many rows to return.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The row indices and their scores,
+                best first.
+        """
+        raise NotImplementedError
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory the retriever needs resident to answer queries quickly.  Rows read
+        only to re-rank a few candidates are not counted, since those can stay
+        memory-mapped on disk.
+        """
+        raise NotImplementedError
+
+
+class ExactRetriever(Retriever):
+    """
+    Scores every row.  The reference the approximate retrievers are measured against.
+    """
+
+    name = "exact"
+
+    def __init__(self, embeds: np.ndarray):
+        self.embeds = embeds
+
+    def search(self, embed_q: np.ndarray, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        scores = self.embeds @ np.asarray(embed_q, dtype=self.embeds.dtype)
+        best = top_k_indices(scores, top_k)
+        return best, scores[best]
+
+    @property
+    def nbytes(self) -> int:
+        return self.embeds.nbytes
+
+
+def spherical_kmeans(
+    embeds: np.ndarray,
+    n_lists: int,
+    n_iter: int = 10,
+    sample_size: int | None = None,
+    seed: int = 18,
+) -> np.ndarray:
+    """
+    Cluster unit-norm rows by cosine similarity.
+
+    Args:
+        embeds (np.ndarray): The rows to cluster.
+        n_lists (int): The number of clusters.
+        n_iter (int): The number of refinement passes.
+        sample_size (int | None): Train on this many random rows.  Defaults to
+            64 per cluster.
+        seed (int): The random seed.
+
+    Returns:
+        np.ndarray: The unit-norm float32 centroids, one per row.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = embeds.shape[0]
+    sample_size = min(n_rows, sample_size or 64 * n_lists)
+    # Sorted, so reading a memory-mapped matrix moves forward through the file
+    sample_rows = np.sort(rng.choice(n_rows, sample_size, replace=False))
+    sample = np.asarray(embeds[sample_rows], dtype=np.float32)
+
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = assign_lists(sample, centroids)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=n_lists)
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[filled]
+        centroids[filled] = np.add.reduceat(sample[order], starts, axis=0)
+
+        # Restart empty clusters from random rows
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = sample[rng.choice(sample_size, len(empty))]
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+
+    return centroids
+
+
+def assign_lists(embeds: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """
+    Find the most similar centroid of each row.
+
+    Args:
+        embeds (np.ndarray): The rows.
+        centroids (np.ndarray): The centroids.
+
+    Returns:
+        np.ndarray: The centroid index of each row.
+    """
+    assign = np.empty(embeds.shape[0], dtype=np.int32)
+    for start in range(0, embeds.shape[0], BUILD_BLOCK_ROWS):
+        block = np.asarray(embeds[start : start + BUILD_BLOCK_ROWS], dtype=np.float32)
+        assign[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assign
+
+
+class IVFRetriever(Retriever):
+    """
+    Inverted-file index: rows are grouped by their nearest k-means centroid, and a
+    query only scores the rows of the `nprobe` centroids most similar to it.
+
+    Each group's rows are stored together, so a probe reads one contiguous block.
+
+    Attributes:
+        centroids (np.ndarray): The unit-norm centroids.
+        list_offsets (np.ndarray): Where each centroid's rows begin, plus the
+            total number of rows.
+        list_rows (np.ndarray): The original row index of each stored row.
+        list_embeds (np.ndarray): The rows, grouped by centroid.
+        nprobe (int): How many centroids each query probes.
+    """
+
+    name = "ivf"
+    FILES = ("centroids", "list_offsets", "list_rows", "list_embeds")
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        list_offsets: np.ndarray,
+        list_rows: np.ndarray,
+        list_embeds: np.ndarray,
+        nprobe: int = IVF_NPROBE,
+    ):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.list_embeds = list_embeds
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(
+        cls,
+        embeds: np.ndarray,
+        n_lists: int | None = IVF_N_LISTS,
+        nprobe: int = IVF_NPROBE,
+        n_iter: int = 10,
+        seed: int = 18,
+    ) -> "IVFRetriever":
+        """
+        Cluster the rows and group them by cluster.
+
+        Args:
+            embeds (np.ndarray): The unit-norm rows to index.
+            n_lists (int | None): The number of clusters.  Defaults to
+                4 * sqrt(rows).
+            nprobe (int): How many clusters each query probes.
+            n_iter (int): k-means refinement passes.
+            seed (int): The random seed.
+
+        Returns:
+            IVFRetriever: The index.
+        """
+        n_rows = embeds.shape[0]
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(n_rows))
+        n_lists = max(1, min(n_lists, n_rows))
+
+        centroids = spherical_kmeans(embeds, n_lists, n_iter=n_iter, seed=seed)
+        assign = assign_lists(embeds, centroids)
+        list_rows = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=n_lists)
+        list_offsets = np.concatenate(([0], np.cumsum(counts)))
+
+        list_embeds = np.empty(embeds.shape, dtype=np.float32)
+        for start in range(0, n_rows, BUILD_BLOCK_ROWS):
+            rows = list_rows[start : start + BUILD_BLOCK_ROWS]
+            list_embeds[start : start + len(rows)] = embeds[rows]
+
+        return cls(centroids, list_offsets, list_rows, list_embeds, nprobe=nprobe)
+
+    def search(self, embed_q: np.ndarray, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        embed_q = np.asarray(embed_q, dtype=np.float32)
+        probes = top_k_indices(self.centroids @ embed_q, self.nprobe)
+        starts = self.list_offsets[probes]
+        ends = self.list_offsets[probes + 1]
+
+        scores = np.empty(int((ends - starts).sum()), dtype=np.float32)
+        rows = np.empty(len(scores), dtype=self.list_rows.dtype)
+        pos = 0
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            n = end - start
+            np.matmul(self.list_embeds[start:end], embed_q, out=scores[pos : pos + n])
+            rows[pos : pos + n] = self.list_rows[start:end]
+            pos += n
+
+        best = top_k_indices(scores, top_k)
+        return rows[best], scores[best]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in self.FILES)
+
+    def save(self, path: str | os.PathLike) -> None:
+        """
+        Write the index to a directory, replacing any index already there.
+
+        Args:
+            path (str | os.PathLike): The directory.
+        """
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.mkdir(parents=True, exist_ok=True)
+        for name in self.FILES:
+            np.save(tmp_path / f"{name}.npy", getattr(self, name))
+        with open(tmp_path / "ivf_meta.json", "w") as f:
+            json.dump({"n_lists": len(self.centroids), "nprobe": self.nprobe}, f)
+
+        if path.exists():
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(
+        cls, path: str | os.PathLike, nprobe: int | None = None
+    ) -> "IVFRetriever":
+        """
+        Memory-map an index written by `save`.
+
+        Args:
+            path (str | os.PathLike): The directory.
+            nprobe (int | None): Override the saved number of probes.
+
+        Returns:
+            IVFRetriever: The index.
+        """
+        path = Path(path)
+        with open(path / "ivf_meta.json") as f:
+            meta = json.load(f)
+        arrays = {
+            name: np.load(path / f"{name}.npy", mmap_mode="r") for name in cls.FILES
+        }
+        # The centroids and offsets are read on every query, so keep them in memory
+        arrays["centroids"] = np.array(arrays["centroids"])
+        arrays["list_offsets"] = np.array(arrays["list_offsets"])
+        return cls(**arrays, nprobe=nprobe or meta["nprobe"])
+
+
+def quantize_int8(
+    embeds: np.ndarray, scales: np.ndarray | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Quantize rows to int8, with one symmetric scale per dimension.
+
+    Args:
+        embeds (np.ndarray): The rows.
+        scales (np.ndarray | None): The scale of each dimension.  Defaults to
+            each dimension's largest magnitude over 127.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The int8 codes, one row per row, and the
+            float32 scales.  A row is approximately `codes * scales`.
+    """
+    n_rows = embeds.shape[0]
+    if scales is None:
+        max_abs = np.zeros(embeds.shape[1], dtype=np.float32)
+        for start in range(0, n_rows, BUILD_BLOCK_ROWS):
+            block = np.abs(embeds[start : start + BUILD_BLOCK_ROWS])
+            np.maximum(max_abs, block.max(axis=0), out=max_abs)
+        scales = np.where(max_abs > 0, max_abs / 127, 1).astype(np.float32)
+
+    codes = np.empty(embeds.shape, dtype=np.int8)
+    for start in range(0, n_rows, BUILD_BLOCK_ROWS):
+        block = np.asarray(embeds[start : start + BUILD_BLOCK_ROWS], dtype=np.float32)
+        codes[start : start + len(block)] = np.clip(
+            np.rint(block / scales), -127, 127
+        )
+    return codes, scales
+
+
+def quantize_binary(embeds: np.ndarray) -> np.ndarray:
+    """
+    Quantize rows to one sign bit per dimension.
+
+    Rows are padded to a whole number of 64-bit words, so they can be compared a
+    word at a time.
+
+    Args:
+        embeds (np.ndarray): The rows.
+
+    Returns:
+        np.ndarray: The packed bits, as uint64 words, one row per row.
+    """
+    n_rows, dim = embeds.shape
+    n_words = -(-dim // 64)
+    bits = np.zeros((n_rows, 8 * n_words), dtype=np.uint8)
+    for start in range(0, n_rows, BUILD_BLOCK_ROWS):
+        block = np.asarray(embeds[start : start + BUILD_BLOCK_ROWS]) > 0
+        bits[start : start + len(block), : -(-dim // 8)] = np.packbits(block, axis=1)
+    return bits.view(np.uint64)
+
+
+class QuantizedRetriever(Retriever):
+    """
+    Scores every row on compact codes, then re-ranks the best candidates with
+    their float32 rows.
+
+    Only the codes are read on every query.  The float32 matrix is read a few
+    rows at a time, so it can stay memory-mapped.
+
+    Attributes:
+        embeds (np.ndarray): The float32 rows, for re-ranking.
+        rerank (int): Candidates re-ranked per result.
+    """
+
+    def __init__(self, embeds: np.ndarray, rerank: int):
+        self.embeds = embeds
+        self.rerank = rerank
+
+    def scan(self, embed_q: np.ndarray) -> np.ndarray:
+        """
+        Score every row on its codes.
+
+        Args:
+            embed_q (np.ndarray): The float32 unit-norm query embedding.
+
+        Returns:
+            np.ndarray: The approximate score of each row.  Higher is more similar.
+        """
+        raise NotImplementedError
+
+    def search(self, embed_q: np.ndarray, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        embed_q = np.asarray(embed_q, dtype=np.float32)
+        candidates = top_k_indices(self.scan(embed_q), top_k * self.rerank)
+        # In row order, so a memory-mapped matrix is read front to back
+        candidates.sort()
+        scores = self.embeds[candidates] @ embed_q
+        best = top_k_indices(scores, top_k)
+        return candidates[best], scores[best]
+
+
+class Int8Retriever(QuantizedRetriever):
+    """
+    Scores rows on int8 codes: a quarter of the float32 memory.
+
+    Attributes:
+        codes (np.ndarray): The int8 codes.
+        scales (np.ndarray): The scale of each dimension.
+    """
+
+    name = "int8"
+
+    def __init__(
+        self,
+        embeds: np.ndarray,
+        codes: np.ndarray | None = None,
+        scales: np.ndarray | None = None,
+        rerank: int = INT8_RERANK,
+    ):
+        super().__init__(embeds, rerank)
+        if codes is None:
+            codes, scales = quantize_int8(embeds, scales)
+        self.codes = codes
+        self.scales = scales
+        self.block_rows = max(1, SCAN_BLOCK_BYTES // codes.shape[1])
+
+    def scan(self, embed_q: np.ndarray) -> np.ndarray:
+        # Folding the scales into the query leaves a plain product with the codes
+        embed_q = embed_q * self.scales
+        n_rows = self.codes.shape[0]
+        scores = np.empty(n_rows, dtype=np.float32)
+        decoded = np.empty((self.block_rows, self.codes.shape[1]), dtype=np.float32)
+        for start in range(0, n_rows, self.block_rows):
+            block = self.codes[start : start + self.block_rows]
+            n = len(block)
+            np.copyto(decoded[:n], block, casting="unsafe")
+            np.matmul(decoded[:n], embed_q, out=scores[start : start + n])
+        return scores
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scales.nbytes
+
+
+class BinaryRetriever(QuantizedRetriever):
+    """
+    Scores rows by the Hamming distance between sign bits: a thirty-second of the
+    float32 memory.
+
+    Attributes:
+        bits (np.ndarray): The packed sign bits.
+    """
+
+    name = "binary"
+
+    def __init__(
+        self,
+        embeds: np.ndarray,
+        bits: np.ndarray | None = None,
+        rerank: int = BINARY_RERANK,
+    ):
+        super().__init__(embeds, rerank)
+        self.bits = quantize_binary(embeds) if bits is None else bits
+        self.block_rows = max(1, SCAN_BLOCK_BYTES // self.bits[0].nbytes)
+
+    def scan(self, embed_q: np.ndarray) -> np.ndarray:
+        q_bits = quantize_binary(embed_q[None, :])[0]
+        n_rows = self.bits.shape[0]
+        scores = np.empty(n_rows, dtype=np.int32)
+        for start in range(0, n_rows, self.block_rows):
+            block = self.bits[start : start + self.block_rows]
+            distances = popcount(block ^ q_bits).sum(axis=1, dtype=np.int32)
+            np.negative(distances, out=scores[start : start + len(block)])
+        return scores
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+
+
+def array_hash(embeds: np.ndarray) -> str:
+    """
+    Hash every row of a matrix, a block at a time so a memory-mapped matrix is
+    never copied whole.
+
+    Args:
+        embeds (np.ndarray): The matrix.
+
+    Returns:
+        str: A hex digest that changes whenever any element, the shape or the
+            dtype does.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((embeds.shape, str(embeds.dtype))).encode())
+    for start in range(0, embeds.shape[0], BUILD_BLOCK_ROWS):
+        block = np.ascontiguousarray(embeds[start : start + BUILD_BLOCK_ROWS])
+        digest.update(block.data)
+    return digest.hexdigest()
+
+
+def fingerprint(embeds: np.ndarray, *params) -> str:
+    """
+    Identify an index by every row of the matrix it indexes, so changing any
+    one row (say, re-embedding one abstract) builds a new index.
+
+    Args:
+        embeds (np.ndarray): The matrix.
+        *params: Build settings that also distinguish the index.
+
+    Returns:
+        str: A short hex digest.
+    """
+    digest = hashlib.sha1(repr((array_hash(embeds), params)).encode())
+    return digest.hexdigest()[:16]
+
+
+def load_or_build_ivf(
+    embeds: np.ndarray,
+    index_dir: str | os.PathLike = INDEX_DIR,
+    n_lists: int | None = IVF_N_LISTS,
+    nprobe: int = IVF_NPROBE,
+) -> IVFRetriever:
+    """
+    Load the IVF index of a matrix from `index_dir`, building and saving it first
+    if there is none.
+
+    Args:
+        embeds (np.ndarray): The unit-norm rows to index.
+        index_dir (str | os.PathLike): Where indexes are kept.
+        n_lists (int | None): The number of clusters, for a new index.
+        nprobe (int): How many clusters each query probes.
+
+    Returns:
+        IVFRetriever: The index.
+    """
+    path = Path(index_dir) / f"ivf-{fingerprint(embeds, n_lists)}"
+    if (path / "ivf_meta.json").exists():
+        return IVFRetriever.load(path, nprobe=nprobe)
+
+    logger.info(f"Building an IVF index over {embeds.shape[0]} rows")
+    retriever = IVFRetriever.build(embeds, n_lists=n_lists, nprobe=nprobe)
+    try:
+        retriever.save(path)
+    except OSError as e:
+        logger.warning(f"Could not save the IVF index to {path}: {e}")
+    return retriever
+
+
+# Retrievers by name, each built from a unit-norm embedding matrix
+RETRIEVERS = {
+    "exact": ExactRetriever,
+    "ivf": load_or_build_ivf,
+    "int8": Int8Retriever,
+    "binary": BinaryRetriever,
+}
+
+
+def make_retriever(
+    embeds: np.ndarray,
+    name: str = RETRIEVER,
+    min_rows: int = ANN_MIN_ROWS,
+    **saved: np.ndarray,
+) -> Retriever | None:
+    """
+    Build the configured retriever for an embedding matrix.
+
+    Args:
+        embeds (np.ndarray): The unit-norm rows.
+        name (str): A key of `RETRIEVERS`.
+        min_rows (int): Below this many rows, use exact search.
+        **saved (np.ndarray): Codes already computed for this retriever, such as
+            `codes` and `scales` for int8 or `bits` for binary, so they are not
+            computed again.
+
+    Returns:
+        Retriever | None: The retriever, or None for the default exact search.
+    """
+    if name == "exact" or embeds.shape[0] < min_rows:
+        return None
+    if name not in RETRIEVERS:
+        raise ValueError(f"Unknown retriever {name!r}; choose from {list(RETRIEVERS)}")
+    return RETRIEVERS[name](embeds, **saved)
+
+
+def recall_at_k(
+    retriever: Retriever, reference: Retriever, queries: np.ndarray, k: int
+) -> float:
+    """
+    Measure how many of the true top-k rows a retriever finds.
+
+    Args:
+        retriever (Retriever): The retriever to measure.
+        reference (Retriever): The exact retriever.
+        queries (np.ndarray): Unit-norm queries, one per row.
+        k (int): How many rows to compare.
+
+    Returns:
+        float: The mean fraction of the reference's top k that the retriever
+            also returned.
+    """
+    found = 0
+    for embed_q in queries:
+        rows, _ = retriever.search(embed_q, k)
+        true_rows, _ = reference.search(embed_q, k)
+        found += len(np.intersect1d(rows, true_rows))
+    return found / (k * len(queries))
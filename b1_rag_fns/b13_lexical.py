@@ -0,0 +1,258 @@
+import os
+import re
+from collections import Counter
+from dataclasses import dataclass
+
+import numpy as np
+from b12_retrievers import top_k_indices
+
+# How lexical (BM25) scores are combined with the dense scores to rank talks:
+# "weighted" adds up to LEXICAL_WEIGHT for a talk matching every query term,
+# "rrf" ranks by reciprocal rank fusion, and "none" skips the lexical index
+# altogether.  Either way limit_docs still filters on the dense score.
+FUSION = os.getenv("RGOV_FUSION", "weighted")
+LEXICAL_WEIGHT = float(os.getenv("RGOV_LEXICAL_WEIGHT", "0.3"))
+RRF_K = 60
+
+# Candidates taken from each ranking per result wanted, before fusing
+HYBRID_CANDIDATES = 4
+
+# Fields indexed, and how much a term in each counts.  Titles and speaker names
+# are short, so a match there says more than one in the transcript.
+FIELD_WEIGHTS = {"Title": 3.0, "Speaker": 3.0, "Abstract": 1.0, "transcript": 1.0}
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Package names like data.table or snake_case functions stay one token
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[._][a-z0-9]+)*")
+
+# Common English words, plus words nearly every question to this app contains
+STOPWORDS = frozenset(
+    "a about an and are as at be but by can did do does for from had has have how "
+    "i in is it its me my of on or so than that the their them there these they "
+    "this to was we were what when where which who why will with you your "
+    "said say talk talked talks tell".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Split text into lowercase search terms, dropping stopwords.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        list[str]: The terms, in order.
+    """
+    return [term for term in TOKEN_RE.findall(text.lower()) if term not in STOPWORDS]
+
+
+@dataclass(frozen=True)
+class BM25Index:
+    """
+    Inverted index of the talks, scored with BM25.
+
+    Postings are stored term by term: the talks containing the t-th term are
+    `doc_ids[term_offsets[t]:term_offsets[t + 1]]`.  Each posting's weight
+    already includes the term's IDF and its talk's length normalization, so a
+    query only sums weights.
+
+    Attributes:
+        vocab (dict[str, int]): The index of each term.
+        term_offsets (np.ndarray): Where each term's postings begin, plus the
+            total number of postings.
+        doc_ids (np.ndarray): The corpus row of each posting.
+        weights (np.ndarray): The BM25 weight of each posting.
+        max_weights (np.ndarray): The most any posting of each term could weigh,
+            to put query scores on a 0-1 scale.
+        n_docs (int): The number of talks.
+    """
+
+    vocab: dict[str, int]
+    term_offsets: np.ndarray
+    doc_ids: np.ndarray
+    weights: np.ndarray
+    max_weights: np.ndarray
+    n_docs: int
+
+    @classmethod
+    def from_talks(
+        cls,
+        talk_info: list[dict],
+        field_weights: dict[str, float] = FIELD_WEIGHTS,
+        k1: float = BM25_K1,
+        b: float = BM25_B,
+    ) -> "BM25Index":
+        """
+        Index the talks.
+
+        Args:
+            talk_info (list[dict]): The talk info, one entry per corpus row.
+            field_weights (dict[str, float]): The fields to index and how much a
+                term in each counts.
+            k1 (float): BM25 term frequency saturation.
+            b (float): BM25 length normalization.
+
+        Returns:
+            BM25Index: The index.
+        """
+        vocab: dict[str, int] = {}
+        term_ids, doc_ids, term_freqs = [], [], []
+        doc_lens = np.zeros(len(talk_info), dtype=np.float32)
+        for row, talk in enumerate(talk_info):
+            counts = Counter()
+            for field, field_weight in field_weights.items():
+                for term in tokenize(str(talk.get(field) or "")):
+                    counts[term] += field_weight
+            for term, freq in counts.items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                doc_ids.append(row)
+                term_freqs.append(freq)
+            doc_lens[row] = sum(counts.values())
+
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        doc_ids = np.asarray(doc_ids, dtype=np.int32)
+        term_freqs = np.asarray(term_freqs, dtype=np.float32)
+
+        # Group the postings term by term.  Stable, so each term's talks stay in
+        # row order.
+        order = np.argsort(term_ids, kind="stable")
+        term_ids = term_ids[order]
+        doc_ids, term_freqs = doc_ids[order], term_freqs[order]
+        doc_freqs = np.bincount(term_ids, minlength=len(vocab))
+        term_offsets = np.concatenate(([0], np.cumsum(doc_freqs)))
+
+        n_docs = len(talk_info)
+        idf = np.log1p((n_docs - doc_freqs + 0.5) / (doc_freqs + 0.5))
+        avg_len = max(float(doc_lens.mean()), 1.0) if n_docs else 1.0
+        length_norm = k1 * (1 - b + b * doc_lens[doc_ids] / avg_len)
+        weights = idf[term_ids] * term_freqs * (k1 + 1) / (term_freqs + length_norm)
+
+        return cls(
+            vocab=vocab,
+            term_offsets=term_offsets,
+            doc_ids=doc_ids,
+            weights=weights.astype(np.float32),
+            max_weights=(idf * (k1 + 1)).astype(np.float32),
+            n_docs=n_docs,
+        )
+
+    def score(self, query: str) -> np.ndarray:
+        """
+        Score every talk against a query.
+
+        Args:
+            query (str): The query text.
+
+        Returns:
+            np.ndarray: The BM25 score of each corpus row.  Zero where no query
+                term appears.
+        """
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for t in self.query_terms(query):
+            lo, hi = self.term_offsets[t], self.term_offsets[t + 1]
+            # A term lists each talk once, so the fancy-indexed add is safe
+            scores[self.doc_ids[lo:hi]] += self.weights[lo:hi]
+        return scores
+
+    def max_score(self, query: str) -> float:
+        """
+        Get the score a talk would get by matching every query term as well as
+        possible.
+
+        Args:
+            query (str): The query text.
+
+        Returns:
+            float: The bound, or 0 if no query term is indexed.
+        """
+        return float(sum(self.max_weights[t] for t in self.query_terms(query)))
+
+    def query_terms(self, query: str) -> list[int]:
+        """The indices of the distinct query terms that are in the index."""
+        terms = {self.vocab.get(term) for term in tokenize(query)}
+        terms.discard(None)
+        return sorted(terms)
+
+    @property
+    def nbytes(self) -> int:
+        arrays = (self.term_offsets, self.doc_ids, self.weights, self.max_weights)
+        return sum(array.nbytes for array in arrays)
+
+
+def ranks(scores: np.ndarray) -> np.ndarray:
+    """The 1-based rank of each score, highest first."""
+    ranked = np.empty(len(scores), dtype=np.float32)
+    ranked[np.argsort(-scores, kind="stable")] = np.arange(1, len(scores) + 1)
+    return ranked
+
+
+def fuse(
+    vids: list[dict],
+    lexical_scores: np.ndarray,
+    top_k: int,
+    max_lexical: float | None = None,
+    method: str = FUSION,
+    weight: float = LEXICAL_WEIGHT,
+) -> list[dict]:
+    """
+    Rank candidate talks by their dense and lexical scores together.
+
+    Args:
+        vids (list[dict]): The candidates, each with its dense "score".
+        lexical_scores (np.ndarray): The BM25 score of each candidate.
+        top_k (int): How many talks to return.
+        max_lexical (float | None): The best possible BM25 score for the query,
+            from `BM25Index.max_score`.  Defaults to the best candidate's.
+        method (str): "weighted" or "rrf".
+        weight (float): For "weighted", what a perfect lexical match adds.
+
+    Returns:
+        list[dict]: The best `top_k` candidates, best first, each with the
+            "fused_score" they were ranked by, "lexical_score" and
+            "dense_score".  "score" stays the dense (cosine) score.
+    """
+    dense_scores = np.array([vid["score"] for vid in vids], dtype=np.float32)
+    lexical_scores = np.asarray(lexical_scores, dtype=np.float32)
+
+    if method == "rrf":
+        fused = 1 / (RRF_K + ranks(dense_scores))
+        # Talks with no query term get no lexical rank
+        fused += np.where(lexical_scores > 0, 1 / (RRF_K + ranks(lexical_scores)), 0)
+    elif method == "weighted":
+        if max_lexical is None:
+            max_lexical = float(lexical_scores.max(initial=0))
+        fused = dense_scores
+        if max_lexical > 0:
+            fused = dense_scores + weight * lexical_scores / max_lexical
+    else:
+        raise ValueError(f"Unknown fusion {method!r}; use weighted or rrf")
+
+    fused_vids = []
+    for i in top_k_indices(fused, top_k).tolist():
+        vid = {
+            **vids[i],
+            "dense_score": float(dense_scores[i]),
+            "lexical_score": float(lexical_scores[i]),
+            "fused_score": float(fused[i]),
+        }
+        fused_vids.append(vid)
+    return fused_vids
+
+
+def lexical_candidates(lexical_scores: np.ndarray, n_candidates: int) -> np.ndarray:
+    """
+    Get the rows with the best lexical scores, leaving out rows with none.
+
+    Args:
+        lexical_scores (np.ndarray): The BM25 score of every corpus row.
+        n_candidates (int): How many rows to take at most.
+
+    Returns:
+        np.ndarray: The rows, best first.
+    """
+    rows = top_k_indices(lexical_scores, n_candidates)
+    return rows[lexical_scores[rows] > 0]
+
@@ -0,0 +1,277 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from b4_http_client import OPENAI_BASE_URL, ahttp_post, http_post, make_headers
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # only needed for the local embedder
+    SentenceTransformer = None
+
+logger = logging.getLogger(__name__)
+
+# Which embedder turns questions (and, in a5_embed, talks) into vectors:
+# "openai" or "local".  The corpus must be embedded by the same one.
+EMBEDDER = os.getenv("RGOV_EMBEDDER", "openai")
+OPENAI_EMBED_MODEL = os.getenv("RGOV_OPENAI_EMBED_MODEL", "text-embedding-3-small")
+
+# The local embedder runs a sentence-transformers model on the CPU, with
+# PyTorch or (backend "onnx") ONNX Runtime.  Its batches run on a small thread
+# pool, which also caps how many inferences run at once.
+LOCAL_EMBED_MODEL = os.getenv(
+    "RGOV_LOCAL_EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2"
+)
+LOCAL_EMBED_BACKEND = os.getenv("RGOV_LOCAL_EMBED_BACKEND", "torch")
+LOCAL_EMBED_BATCH_SIZE = int(os.getenv("RGOV_LOCAL_EMBED_BATCH_SIZE", "32"))
+LOCAL_EMBED_THREADS = int(os.getenv("RGOV_LOCAL_EMBED_THREADS", "2"))
+
+# Local model names are recorded with this prefix, so they are priced at zero
+# and never mistaken for an API model
+LOCAL_PREFIX = "local:"
+
+# The embeddings endpoint accepts at most this many inputs per request
+EMBED_BATCH_SIZE = 2048
+
+
+class Embedder:
+    """
+    Turns texts into embedding vectors.
+
+    Attributes:
+        model_name (str): The model, as recorded in embeds_meta.json.  Queries
+            can only be scored against a corpus embedded by the same model.
+    """
+
+    model_name = "base"
+
+    def embed(
+        self,
+        texts: list[str],
+        oai_api_key: str | None = None,
+        usage: dict[str, int] | None = None,
+    ) -> np.ndarray:
+        """
+        Embed texts.
+
+        Args:
+            texts (list[str]): The texts.
+            oai_api_key (str | None): The OpenAI API key, for API embedders.
+            usage (dict[str, int] | None): If given, filled with the token counts
+                the API reported.
+
+        Returns:
+            np.ndarray: The float32 embeddings, one row per text.
+        """
+        raise NotImplementedError
+
+    async def aembed(
+        self,
+        texts: list[str],
+        oai_api_key: str | None = None,
+        usage: dict[str, int] | None = None,
+    ) -> np.ndarray:
+        """
+        Embed texts without blocking the event loop.  See `embed`.
+        """
+        return await asyncio.to_thread(self.embed, texts, oai_api_key, usage)
+
+    def warm_up(self) -> None:
+        """
+        Do any slow one-time setup now rather than on the first question.
+        """
+
+
+class OpenAIEmbedder(Embedder):
+    """
+    Embeds texts with the OpenAI embeddings endpoint.
+    """
+
+    def __init__(self, model_name: str = OPENAI_EMBED_MODEL):
+        self.model_name = model_name
+
+    def _payloads(self, texts: list[str]):
+        for i in range(0, len(texts), EMBED_BATCH_SIZE):
+            batch = texts[i : i + EMBED_BATCH_SIZE]
+            yield json.dumps({"input": batch, "model": self.model_name})
+
+    @staticmethod
+    def _read(response_json: dict, rows: list, usage: dict[str, int] | None) -> None:
+        data = sorted(response_json["data"], key=lambda item: item["index"])
+        rows.extend(item["embedding"] for item in data)
+        if usage is not None:
+            for name, count in (response_json.get("usage") or {}).items():
+                usage[name] = usage.get(name, 0) + count
+
+    def embed(
+        self,
+        texts: list[str],
+        oai_api_key: str | None = None,
+        usage: dict[str, int] | None = None,
+    ) -> np.ndarray:
+        rows = []
+        for payload in self._payloads(texts):
+            response = http_post(
+                f"{OPENAI_BASE_URL}/embeddings",
+                headers=make_headers(oai_api_key),
+                data=payload,
+            )
+            response.raise_for_status()
+            self._read(response.json(), rows, usage)
+        return np.asarray(rows, dtype=np.float32)
+
+    async def aembed(
+        self,
+        texts: list[str],
+        oai_api_key: str | None = None,
+        usage: dict[str, int] | None = None,
+    ) -> np.ndarray:
+        rows = []
+        for payload in self._payloads(texts):
+            response = await ahttp_post(
+                f"{OPENAI_BASE_URL}/embeddings",
+                headers=make_headers(oai_api_key),
+                content=payload,
+            )
+            response.raise_for_status()
+            self._read(response.json(), rows, usage)
+        return np.asarray(rows, dtype=np.float32)
+
+
+class LocalEmbedder(Embedder):
+    """
+    Embeds texts on this machine with a sentence-transformers model.
+
+    The model loads on first use, or in `warm_up`.  Texts are split into
+    batches that run on a thread pool, so one large request uses several cores
+    and many small ones never run more than `n_threads` inferences at once.
+    """
+
+    def __init__(
+        self,
+        model_name: str = LOCAL_EMBED_MODEL,
+        backend: str = LOCAL_EMBED_BACKEND,
+        batch_size: int = LOCAL_EMBED_BATCH_SIZE,
+        n_threads: int = LOCAL_EMBED_THREADS,
+    ):
+        if SentenceTransformer is None:
+            raise ImportError(
+                "The local embedder needs sentence-transformers: "
+                "pip install sentence-transformers (plus onnxruntime for onnx)"
+            )
+        self.hub_name = model_name.removeprefix(LOCAL_PREFIX)
+        self.model_name = LOCAL_PREFIX + self.hub_name
+        self.backend = backend
+        self.batch_size = batch_size
+        self._pool = ThreadPoolExecutor(
+            max_workers=n_threads, thread_name_prefix="rgov-embed"
+        )
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._warm = False
+
+    def _get_model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    logger.info(f"Loading local embedding model {self.hub_name}")
+                    self._model = SentenceTransformer(
+                        self.hub_name, device="cpu", backend=self.backend
+                    )
+        return self._model
+
+    def _encode(self, batch: list[str]) -> np.ndarray:
+        return self._get_model().encode(
+            batch,
+            batch_size=len(batch),
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+        )
+
+    def embed(
+        self,
+        texts: list[str],
+        oai_api_key: str | None = None,
+        usage: dict[str, int] | None = None,
+    ) -> np.ndarray:
+        batches = [
+            texts[i : i + self.batch_size]
+            for i in range(0, len(texts), self.batch_size)
+        ]
+        rows = list(self._pool.map(self._encode, batches))
+        if not rows:
+            return np.empty((0, self.dim), dtype=np.float32)
+        return np.concatenate(rows).astype(np.float32, copy=False)
+
+    @property
+    def dim(self) -> int:
+        return self._get_model().get_sentence_embedding_dimension()
+
+    def warm_up(self) -> None:
+        # Loading is most of it, but the first inference also sets up kernels.
+        # Streamlit reruns the app script on every interaction, so only once.
+        if not self._warm:
+            self.embed(["warm up"])
+            self._warm = True
+
+
+EMBEDDERS = {
+    "openai": OpenAIEmbedder,
+    "local": LocalEmbedder,
+}
+
+_embedder: Embedder | None = None
+_embedder_lock = threading.Lock()
+
+
+def get_embedder() -> Embedder:
+    """
+    Get the embedder chosen by RGOV_EMBEDDER, shared by the whole process.
+
+    Returns:
+        Embedder: The process-wide embedder.
+    """
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                if EMBEDDER not in EMBEDDERS:
+                    raise ValueError(
+                        f"Unknown embedder {EMBEDDER!r}; choose from {list(EMBEDDERS)}"
+                    )
+                _embedder = EMBEDDERS[EMBEDDER]()
+    return _embedder
+
+
+_other_embedders: dict[str, Embedder] = {}
+_other_embedders_lock = threading.Lock()
+
+
+def embedder_for(model_name: str | None = None) -> Embedder:
+    """
+    Get an embedder for a model, shared by the whole process.
+
+    Args:
+        model_name (str | None): The model.  None uses the process-wide embedder;
+            names starting with "local:" run locally, and others are OpenAI
+            models.
+
+    Returns:
+        Embedder: The embedder.
+    """
+    embedder = get_embedder()
+    if model_name is None or model_name == embedder.model_name:
+        return embedder
+    # Built once per model, since a local one loads its model and thread pool
+    if model_name not in _other_embedders:
+        with _other_embedders_lock:
+            if model_name not in _other_embedders:
+                if model_name.startswith(LOCAL_PREFIX):
+                    _other_embedders[model_name] = LocalEmbedder(model_name)
+                else:
+                    _other_embedders[model_name] = OpenAIEmbedder(model_name)
+    return _other_embedders[model_name]
@@ -0,0 +1,266 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from b6_chunks import passages_text
+
+try:
+    from sentence_transformers import CrossEncoder
+except ImportError:  # only needed when re-ranking is on
+    CrossEncoder = None
+
+logger = logging.getLogger(__name__)
+
+# Re-rank the best talks by embedding with a cross-encoder before choosing which
+# go into the prompt: "cross-encoder", or "none" to keep limit_docs' cosine
+# threshold.  The cross-encoder reads the question and each talk together, so it
+# tells relevant talks from merely similar ones far better than cosine does.
+RERANK = os.getenv("RGOV_RERANK", "none")
+RERANK_MODEL = os.getenv("RGOV_RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+
+# Talks re-ranked per question, at least n_results
+RERANK_CANDIDATES = int(os.getenv("RGOV_RERANK_CANDIDATES", "10"))
+
+# Re-ranking gives up and falls back to the cosine order when it would take
+# longer than this.  Pairs are scored in small batches so a slow batch is
+# noticed early.
+RERANK_BUDGET_MS = float(os.getenv("RGOV_RERANK_BUDGET_MS", "200"))
+RERANK_BATCH_SIZE = int(os.getenv("RGOV_RERANK_BATCH_SIZE", "4"))
+
+# Talks the cross-encoder gives less than this relevance (0-1) are left out of
+# the prompt, though the best talk is always kept
+RERANK_MIN_SCORE = float(os.getenv("RGOV_RERANK_MIN_SCORE", "0.1"))
+
+# Characters of each talk shown to the cross-encoder.  The model truncates at
+# 512 tokens anyway; cutting first saves tokenizing whole transcripts.
+RERANK_MAX_CHARS = 2000
+
+
+class CrossEncoderReranker:
+    """
+    Scores (question, talk) pairs with a sentence-transformers cross-encoder on
+    the CPU.
+
+    The model loads in `warm_up`, or in the background the first time it is
+    needed; questions asked before it has loaded fall back to the cosine order
+    rather than wait.  The time per pair is tracked as pairs are scored, to
+    predict what fits in the latency budget.
+    """
+
+    def __init__(
+        self, model_name: str = RERANK_MODEL, batch_size: int = RERANK_BATCH_SIZE
+    ):
+        if CrossEncoder is None:
+            raise ImportError(
+                "Re-ranking needs sentence-transformers: "
+                "pip install sentence-transformers"
+            )
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.secs_per_pair: float | None = None
+        self._model = None
+        self._loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+        self._loading = None
+        self._load_lock = threading.Lock()
+
+    def _load(self) -> None:
+        logger.info(f"Loading cross-encoder {self.model_name}")
+        self._model = CrossEncoder(self.model_name, device="cpu")
+
+    def _start_loading(self):
+        with self._load_lock:
+            if self._loading is None:
+                self._loading = self._loader.submit(self._load)
+            return self._loading
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._model is not None
+
+    def warm_up(self) -> None:
+        """
+        Load the model and time a first batch, so the first question is not slow.
+        """
+        self._start_loading().result()
+        if self.secs_per_pair is None:
+            # The first inference also sets up kernels, so time the second
+            pairs = ["warm up"] * self.batch_size
+            self.score("warm up", pairs, deadline=None)
+            self.secs_per_pair = None
+            self.score("warm up", pairs, deadline=None)
+
+    def max_pairs(self, budget_secs: float) -> int | None:
+        """
+        Estimate how many pairs can be scored within a budget.
+
+        Args:
+            budget_secs (float): The budget, in seconds.
+
+        Returns:
+            int | None: The estimate, or None before any pairs have been timed.
+        """
+        if self.secs_per_pair is None:
+            return None
+        return int(budget_secs / self.secs_per_pair)
+
+    def relax(self) -> None:
+        """
+        Lower the time per pair after a question was not re-ranked to fit the
+        budget, so that one slow batch does not turn re-ranking off for good.
+        """
+        if self.secs_per_pair is not None:
+            self.secs_per_pair *= 0.9
+
+    def score(
+        self, query: str, texts: list[str], deadline: float | None
+    ) -> np.ndarray | None:
+        """
+        Score how well each text answers a query.
+
+        Args:
+            query (str): The query.
+            texts (list[str]): The texts.
+            deadline (float | None): The `time.perf_counter()` by which scoring
+                must finish, or None for no limit.
+
+        Returns:
+            np.ndarray | None: The relevance of each text, from 0 to 1, or None
+                if the model has not loaded yet or the deadline would be missed.
+        """
+        if not self.is_loaded:
+            self._start_loading()
+            return None
+
+        scores = []
+        for i in range(0, len(texts), self.batch_size):
+            batch = texts[i : i + self.batch_size]
+            if (
+                deadline is not None
+                and self.secs_per_pair is not None
+                and time.perf_counter() + self.secs_per_pair * len(batch) > deadline
+            ):
+                return None
+            start = time.perf_counter()
+            # With one output, the model's default activation is a sigmoid
+            scores.append(
+                self._model.predict(
+                    [(query, text) for text in batch],
+                    batch_size=len(batch),
+                    show_progress_bar=False,
+                )
+            )
+            # Take a slowdown at once, but a speedup only gradually
+            secs = (time.perf_counter() - start) / len(batch)
+            if self.secs_per_pair is None or secs > self.secs_per_pair:
+                self.secs_per_pair = secs
+            else:
+                self.secs_per_pair = 0.8 * self.secs_per_pair + 0.2 * secs
+        return np.concatenate(scores).astype(np.float32, copy=False)
+
+
+def talk_text(vid: dict, talk: dict, max_chars: int = RERANK_MAX_CHARS) -> str:
+    """
+    Get the text of a talk to show the cross-encoder.
+
+    Args:
+        vid (dict): The ranked talk, with its matching "passages" if it was
+            retrieved by chunk.
+        talk (dict): The talk's info.
+        max_chars (int): How much text to keep.
+
+    Returns:
+        str: The title, then the matching passages or else the abstract.
+    """
+    if vid.get("passages"):
+        body = passages_text(talk.get("transcript") or "", vid["passages"])
+    else:
+        body = talk.get("Abstract") or ""
+    return f"{talk.get('Title') or ''}\n{body}"[:max_chars]
+
+
+def rerank_docs(
+    query: str,
+    sorted_vids: list[dict],
+    talk_info: dict,
+    n_results: int,
+    reranker: CrossEncoderReranker,
+    budget_ms: float = RERANK_BUDGET_MS,
+    min_score: float = RERANK_MIN_SCORE,
+) -> list[dict] | None:
+    """
+    Choose the documents for the prompt by cross-encoder relevance.
+
+    Takes the place of `limit_docs`.  When the budget cannot fit all the
+    candidates, only the best by cosine are re-ranked, as long as that still
+    leaves `n_results` of them.
+
+    Args:
+        query (str): The user's query.
+        sorted_vids (list[dict]): The candidate talks, best by cosine first.
+        talk_info (dict): The talk info, keyed by talk ID.
+        n_results (int): The most documents to return.
+        reranker (CrossEncoderReranker): The cross-encoder.
+        budget_ms (float): The most time to spend, in milliseconds.
+        min_score (float): The least relevance a document other than the best
+            needs to be kept.
+
+    Returns:
+        list[dict] | None: The documents, most relevant first, each with its
+            "rerank_score" (its "score" stays the cosine).  None when re-ranking
+            would not finish in time, to fall back to `limit_docs`.
+    """
+    if not sorted_vids:
+        return None
+    start = time.perf_counter()
+    budget_secs = budget_ms / 1000
+
+    max_pairs = reranker.max_pairs(budget_secs)
+    n_candidates = len(sorted_vids)
+    if max_pairs is not None:
+        if max_pairs < min(n_results, n_candidates):
+            reranker.relax()
+            return None
+        n_candidates = min(n_candidates, max_pairs)
+    candidates = sorted_vids[:n_candidates]
+
+    texts = [talk_text(vid, talk_info[vid["id0"]]) for vid in candidates]
+    scores = reranker.score(query, texts, deadline=start + budget_secs)
+    if scores is None:
+        return None
+
+    best = np.argsort(-scores, kind="stable")[:n_results]
+    keep = [i for i in best if scores[i] >= min_score] or best[:1]
+    return [
+        {
+            **talk_info[candidates[i]["id0"]],
+            **candidates[i],
+            "rerank_score": float(scores[i]),
+        }
+        for i in keep
+    ]
+
+
+_reranker: CrossEncoderReranker | None = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker() -> CrossEncoderReranker | None:
+    """
+    Get the process-wide re-ranker chosen by RGOV_RERANK.
+
+    Returns:
+        CrossEncoderReranker | None: The re-ranker, or None when re-ranking is off.
+    """
+    global _reranker
+    if RERANK == "none":
+        return None
+    if RERANK != "cross-encoder":
+        raise ValueError(f"Unknown re-ranker {RERANK!r}; use cross-encoder or none")
+    if _reranker is None:
+        with _reranker_lock:
+            if _reranker is None:
+                _reranker = CrossEncoderReranker()
+    return _reranker
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+# The ingestion scripts in a1_data_process record here, for each talk and
+# stage, a hash of the input the stage last processed the talk from.  A rerun
+# only processes talks whose input has changed since, and merges the results
+# into the existing files.
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+
+# Bytes read at a time when hashing audio files
+HASH_BLOCK_BYTES = 1 << 20
+
+
+def content_hash(*parts) -> str:
+    """
+    Hash JSON-serializable values.
+
+    Args:
+        *parts: The values, e.g. a model name and the text it embeds.
+
+    Returns:
+        str: A hex digest that changes whenever any of the values does.
+    """
+    data = json.dumps(parts, sort_keys=True, ensure_ascii=False).encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_hash(path: str | os.PathLike) -> str:
+    """
+    Hash a file's contents.
+
+    Args:
+        path (str | os.PathLike): The file.
+
+    Returns:
+        str: A hex digest of the contents.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while block := f.read(HASH_BLOCK_BYTES):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    What each ingestion stage last processed, talk by talk.
+
+    Attributes:
+        path (Path): The manifest file.
+        talks (dict[str, dict[str, str]]): For each talk ID, the input hash each
+            stage last processed it from.
+    """
+
+    def __init__(self, path: Path, talks: dict[str, dict[str, str]] | None = None):
+        self.path = Path(path)
+        self.talks = talks if talks is not None else {}
+
+    @classmethod
+    def load(cls, fp_data: Path) -> "Manifest":
+        """
+        Load the manifest of a data directory, or start an empty one.
+
+        Args:
+            fp_data (Path): The data directory.
+
+        Returns:
+            Manifest: The manifest.
+        """
+        path = Path(fp_data) / MANIFEST_FILE
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return cls(path)
+        if data.get("version") != MANIFEST_VERSION:
+            # An unknown layout tells us nothing, so everything is reprocessed
+            return cls(path)
+        return cls(path, data["talks"])
+
+    def is_current(self, id0: str, stage: str, input_hash: str) -> bool:
+        """
+        Check whether a stage already processed a talk from this input.
+
+        Args:
+            id0 (str): The talk ID.
+            stage (str): The stage.
+            input_hash (str): The hash of the talk's input to the stage now.
+
+        Returns:
+            bool: True if the stage can skip the talk.
+        """
+        return self.get(id0, stage) == input_hash
+
+    def get(self, id0: str, stage: str) -> str | None:
+        """
+        Get the input hash a stage last processed a talk from.
+
+        Args:
+            id0 (str): The talk ID.
+            stage (str): The stage.
+
+        Returns:
+            str | None: The hash, or None if the stage has no record of the talk.
+        """
+        return self.talks.get(id0, {}).get(stage)
+
+    def stale(self, talks: list[dict], stage: str, input_hash) -> list[dict]:
+        """
+        Find the talks a stage has to (re)process.
+
+        Args:
+            talks (list[dict]): The talks.
+            stage (str): The stage.
+            input_hash: Called with a talk to get the hash of its input.
+
+        Returns:
+            list[dict]: The talks whose input changed since the stage last ran,
+                in order.
+        """
+        return [
+            vid
+            for vid in talks
+            if not self.is_current(vid["id0"], stage, input_hash(vid))
+        ]
+
+    def mark(self, id0: str, stage: str, input_hash: str) -> None:
+        """
+        Record that a stage processed a talk from this input.
+
+        Args:
+            id0 (str): The talk ID.
+            stage (str): The stage.
+            input_hash (str): The hash of the input it processed.
+        """
+        self.talks.setdefault(id0, {})[stage] = input_hash
+
+    def forget(self, id0: str, stage: str) -> None:
+        """
+        Drop a stage's record of a talk, so the stage processes it afresh.
+
+        Args:
+            id0 (str): The talk ID.
+            stage (str): The stage.
+        """
+        self.talks.get(id0, {}).pop(stage, None)
+
+    def prune(self, ids: set[str]) -> None:
+        """
+        Drop the records of talks that are no longer in the data.
+
+        Args:
+            ids (set[str]): The IDs of the talks to keep.
+        """
+        self.talks = {id0: stages for id0, stages in self.talks.items() if id0 in ids}
+
+    def save(self) -> None:
+        """
+        Write the manifest.  Call it after the stage's files are written, so a
+        crash in between leaves talks marked stale rather than done.
+        """
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "talks": self.talks}, f, indent=1)
+        os.replace(tmp_path, self.path)
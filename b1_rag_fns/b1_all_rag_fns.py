@@ -1,131 +1,465 @@
-import io
+import contextvars
 import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import requests
-
-
-def import_talk_info() -> list[dict]:
+from b10_usage import (
+    RagResult,
+    Usage,
+    UsageTotals,
+    calc_cost,  # noqa: F401  (re-exported for existing callers)
+    call_when_done,
+    record_usage,
+)
+from b11_instrument import get_instrument, measure_stream, record_generation
+from b12_retrievers import ANN_CANDIDATES, Retriever, top_k_indices
+from b13_lexical import FUSION, HYBRID_CANDIDATES, fuse, lexical_candidates
+from b14_embedders import embedder_for, get_embedder
+from b15_rerank import RERANK_CANDIDATES, get_reranker, rerank_docs
+from b2_corpus_store import (
+    DATA_SOURCE,
+    EMBEDS_CSV_FILE,
+    EMBEDS_META_FILE,
+    EMBEDS_NPY_FILE,
+    TALKS_FILE,
+    Corpus,
+    align_talks,
+    check_embeds_hash,
+    fetch_file,
+    get_corpus_store,
+    is_missing,
+    open_embeds_npy,
+    parse_embeds_csv,
+    parse_talk_info,
+)
+from b3_caches import (
+    get_answer_cache,
+    get_embed_cache,
+    get_semantic_cache,
+    replay_stream,
+)
+from b4_http_client import OPENAI_BASE_URL, http_post, make_headers
+from b6_chunks import N_PASSAGES, ChunkIndex, passages_text
+from b7_context import CONTEXT_TOKEN_BUDGET, count_tokens, pack_context
+from b9_sse import ChatStream, json_loads
+
+logger = logging.getLogger(__name__)
+
+# Worker threads for pipeline stages that overlap with network waits
+_STAGE_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="rag-stage")
+
+
+def import_talk_info(source: str = DATA_SOURCE) -> list[dict]:
     """
     Import talk info from file.
 
+    Args:
+        source (str): A URL prefix or a local directory holding the data files.
+
     Returns:
         list[dict]: A list of talk info.
     """
+    raw, _ = fetch_file(source, TALKS_FILE)
+    return parse_talk_info(raw)
 
-    target_file_url = "https://raw.githubusercontent.com/AlanFeder/rgov-2024/main/data/rgov_talks.json"
-
-    response = requests.get(target_file_url)
-    response.raise_for_status()  # Ensure we notice if the download fails
-    return response.json()
 
-
-def import_embeds() -> np.ndarray:
+def import_embeds(source: str = DATA_SOURCE) -> tuple[np.ndarray, dict | None]:
     """
     Import embeddings from file.
 
-    Returns:
-        np.ndarray: The embeddings.
-    """
+    Memory-maps the float32 embeds.npy when it exists, and falls back to parsing
+    embeds.csv otherwise.
 
-    target_file_url = (
-        "https://raw.githubusercontent.com/AlanFeder/rgov-2024/main/data/embeds.csv"
-    )
+    Args:
+        source (str): A URL prefix or a local directory holding the data files.
 
-    response = requests.get(target_file_url)
-    response.raise_for_status()
+    Returns:
+        tuple[np.ndarray, dict | None]: The embeddings and their header (model name,
+            dimension and row -> id0 mapping), or None for the CSV fallback.
+    """
+    is_local = not source.startswith(("http://", "https://"))
+    try:
+        raw_meta, _ = fetch_file(source, EMBEDS_META_FILE)
+        raw_npy, _ = fetch_file(source, EMBEDS_NPY_FILE, read=not is_local)
+    except (requests.HTTPError, FileNotFoundError) as e:
+        if not is_missing(e):
+            raise
+        raw_csv, _ = fetch_file(source, EMBEDS_CSV_FILE)
+        return parse_embeds_csv(raw_csv), None
 
-    # Use numpy.genfromtxt to read the CSV data from the response text
-    data = np.genfromtxt(
-        io.StringIO(response.text), delimiter=","
-    )  # skip header if needed
+    embeds = open_embeds_npy(source, None if is_local else raw_npy)
+    embeds_meta = json.loads(raw_meta)
+    check_embeds_hash(embeds, embeds_meta, EMBEDS_NPY_FILE)
+    return embeds, embeds_meta
 
-    return data
 
+def import_data(source: str = DATA_SOURCE) -> tuple[list[dict], np.ndarray]:
+    """
+    Import data from files.
 
-def import_data() -> tuple[list[dict], np.ndarray]:
-    #     """
-    #     Import data from files.
+    Args:
+        source (str): A URL prefix or a local directory holding the data files.
 
-    #     Returns:
-    #         tuple[list[dict], dict]: A tuple containing the talk info and embeddings.
-    #     """
+    Returns:
+        tuple[list[dict], np.ndarray]: A tuple containing the talk info and embeddings,
+            with one talk per embedding row.
+    """
 
-    talk_info = import_talk_info()
-    embeds = import_embeds()
+    talk_info = import_talk_info(source)
+    embeds, embeds_meta = import_embeds(source)
+    if embeds_meta is not None:
+        talk_info = align_talks(talk_info, embeds_meta)
 
     return talk_info, embeds
 
 
-def do_1_embed(lt: str, oai_api_key: str) -> np.ndarray:
+def do_1_embed(
+    lt: str,
+    oai_api_key: str,
+    model_name: str | None = None,
+    use_cache: bool = True,
+    usage: dict[str, int] | None = None,
+) -> np.ndarray:
     """
-    Generate embeddings using the OpenAI API for a single text.
+    Generate embeddings for a single text.
+
+    Repeat texts are served from the process-wide query embedding cache.
 
     Args:
         lt (str): A text to generate embeddings for.
-        emb_client (OpenAI): The embedding API client (OpenAI).
+        oai_api_key (str): The OpenAI API key.
+        model_name (str | None): The embedding model.  None uses the configured
+            embedder (RGOV_EMBEDDER).
+        use_cache (bool): Whether to read and write the query embedding cache.
+        usage (dict[str, int] | None): If given, filled with the token counts the
+            API reported.  Left empty when the embedding came from the cache or
+            a local model.
 
     Returns:
         np.ndarray: The generated embeddings.
     """
-    # OpenAI API endpoint for embeddings
-    url = "https://api.openai.com/v1/embeddings"
-
-    # Headers for the API request
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {oai_api_key}",
-    }
-
-    # Request payload
-    payload = {"input": lt, "model": "text-embedding-3-small"}
+    embedder = embedder_for(model_name)
+    embed_cache = get_embed_cache() if use_cache else None
+    if embed_cache is not None:
+        here_embed = embed_cache.get_embed(lt, embedder.model_name)
+        if here_embed is not None:
+            return here_embed
 
-    # Make the API request
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
-
-    # Check if the request was successful
-    if response.status_code == 200:
-        # Parse the JSON response
-        embed_response = response.json()
+    try:
+        here_embed = embedder.embed([lt], oai_api_key=oai_api_key, usage=usage)[0]
+    except requests.RequestException as e:
+        # Status errors, and transport errors once the retries have run out
+        detail = e.response.text if e.response is not None else ""
+        logger.error(f"Embedding request failed: {e!r} {detail}")
+        return None
 
-        # Extract the embedding
-        here_embed = np.array(embed_response["data"][0]["embedding"])
+    if embed_cache is not None:
+        embed_cache.put_embed(lt, embedder.model_name, here_embed)
 
-        return here_embed
-    else:
-        print(f"Error: {response.status_code}")
-        print(response.text)
+    return here_embed
 
 
 def do_sort(
-    embed_q: np.ndarray, embed_talks: np.ndarray, list_talk_ids: list[str]
+    embed_q: np.ndarray,
+    embed_talks: np.ndarray,
+    list_talk_ids: list[str],
+    top_k: int | None = None,
 ) -> list[dict[str, str | float]]:
     """
     Sort documents based on their cosine similarity to the query embedding.
 
     Args:
-        embed_dict (dict[str, np.ndarray]): Dictionary containing document embeddings.
-        arr_q (np.ndarray): Query embedding.
+        embed_q (np.ndarray): Query embedding.
+        embed_talks (np.ndarray): Document embeddings, one row per talk.
+        list_talk_ids (list[str]): The id0 of the talk in each row.
+        top_k (int | None): Only rank and return the best `top_k` documents.
+            None ranks every document.
 
     Returns:
-        pd.DataFrame: Sorted dataframe containing document IDs and similarity scores.
+        list[dict[str, str | float]]: Document IDs and similarity scores, best first.
     """
 
     # Calculate cosine similarities between query embedding and document embeddings
     cos_sims = np.dot(embed_talks, embed_q)
 
     # Get the indices of the best matching video IDs
-    best_match_video_ids = np.argsort(-cos_sims)
+    best_match_video_ids = top_k_indices(cos_sims, top_k)
 
     # Get the sorted video IDs based on the best match indices
     sorted_vids = [
-        {"id0": list_talk_ids[i], "score": -cs}
-        for i, cs in zip(best_match_video_ids, np.sort(-cos_sims))
+        {"id0": list_talk_ids[i], "score": float(cos_sims[i])}
+        for i in best_match_video_ids
     ]
 
     return sorted_vids
 
 
+def do_chunk_sort(
+    embed_q: np.ndarray,
+    chunks: ChunkIndex,
+    list_talk_ids: list[str],
+    top_k: int | None = None,
+    n_passages: int = N_PASSAGES,
+) -> list[dict[str, str | float | list]]:
+    """
+    Sort talks by their best-matching transcript chunk.
+
+    Args:
+        embed_q (np.ndarray): Query embedding.
+        chunks (ChunkIndex): The chunk index.
+        list_talk_ids (list[str]): The id0 of the talk in each corpus row.
+        top_k (int | None): Only rank and return the best `top_k` talks.
+            None ranks every talk that has chunks.
+        n_passages (int): How many chunks to keep from each returned talk.
+
+    Returns:
+        list[dict[str, str | float | list]]: Talk IDs, similarity scores and the
+            best passages of each talk, best talk first.
+    """
+    if chunks.retriever is not None and top_k is not None:
+        return do_chunk_ann_sort(embed_q, chunks, list_talk_ids, top_k, n_passages)
+
+    chunk_scores, talk_scores = chunks.score_talks(embed_q)
+    best_talks = top_k_indices(talk_scores, top_k)
+
+    sorted_vids = [
+        {
+            "id0": list_talk_ids[chunks.chunk_talks[k]],
+            "score": float(talk_scores[k]),
+            "passages": chunks.best_passages(chunk_scores, k, n_passages=n_passages),
+        }
+        for k in best_talks
+    ]
+
+    return sorted_vids
+
+
+def do_ann_sort(
+    embed_q: np.ndarray,
+    retriever: Retriever,
+    list_talk_ids: list[str],
+    top_k: int,
+) -> list[dict[str, str | float]]:
+    """
+    Sort documents with an approximate index, like `do_sort` without scoring
+    every row.
+
+    Args:
+        embed_q (np.ndarray): Query embedding.
+        retriever (Retriever): The index over the document embeddings.
+        list_talk_ids (list[str]): The id0 of the talk in each row.
+        top_k (int): How many documents to return.
+
+    Returns:
+        list[dict[str, str | float]]: Document IDs and similarity scores, best first.
+    """
+    rows, scores = retriever.search(embed_q, top_k)
+    return [
+        {"id0": list_talk_ids[i], "score": score}
+        for i, score in zip(rows.tolist(), scores.tolist())
+    ]
+
+
+def do_chunk_ann_sort(
+    embed_q: np.ndarray,
+    chunks: ChunkIndex,
+    list_talk_ids: list[str],
+    top_k: int,
+    n_passages: int = N_PASSAGES,
+) -> list[dict[str, str | float | list]]:
+    """
+    Sort talks by their best-matching chunk, using the chunk index's approximate
+    retriever to pick the candidate talks.
+
+    The candidates' chunks are then scored exactly, so scores and passages match
+    `do_chunk_sort` for every talk that is found.
+
+    Args:
+        embed_q (np.ndarray): Query embedding.
+        chunks (ChunkIndex): The chunk index, with a retriever.
+        list_talk_ids (list[str]): The id0 of the talk in each corpus row.
+        top_k (int): How many talks to return.
+        n_passages (int): How many chunks to keep from each returned talk.
+
+    Returns:
+        list[dict[str, str | float | list]]: Talk IDs, similarity scores and the
+            best passages of each talk, best talk first.
+    """
+    # A few talks can hold all the best chunks, so widen the search until it
+    # turns up enough distinct talks
+    n_chunks = len(chunks.talk_rows)
+    n_candidates = top_k * ANN_CANDIDATES
+    while True:
+        chunk_rows, _ = chunks.retriever.search(embed_q, n_candidates)
+        candidates = np.unique(chunks.talk_positions(chunk_rows))
+        if len(candidates) >= top_k or n_candidates >= n_chunks:
+            break
+        n_candidates *= 4
+
+    sorted_vids = []
+    for k in candidates.tolist():
+        score, passages = chunks.score_talk(embed_q, k, n_passages=n_passages)
+        sorted_vids.append(
+            {
+                "id0": list_talk_ids[chunks.chunk_talks[k]],
+                "score": score,
+                "passages": passages,
+            }
+        )
+    sorted_vids.sort(key=lambda vid: vid["score"], reverse=True)
+
+    return sorted_vids[:top_k]
+
+
+def rank_talks(
+    embed_q: np.ndarray,
+    corpus: Corpus,
+    n_results: int,
+    use_chunks: bool | None = None,
+    query_text: str | None = None,
+) -> list[dict]:
+    """
+    Rank the talks in a corpus against a query embedding.
+
+    Uses the corpus's approximate retrievers when it has them, and scores every
+    talk (or chunk) otherwise.  Given the query text and a corpus with a BM25
+    index, the embedding scores are fused with lexical ones.
+
+    Args:
+        embed_q (np.ndarray): The unit-norm query embedding.
+        corpus (Corpus): The corpus.
+        n_results (int): The number of talks to return.
+        use_chunks (bool | None): Score transcript chunks rather than abstracts.
+            None uses chunks whenever the corpus has a chunk index.
+        query_text (str | None): The query, for lexical scoring.
+
+    Returns:
+        list[dict]: Talk IDs and similarity scores, best first.
+    """
+    if use_chunks is None:
+        use_chunks = corpus.chunks is not None
+
+    if query_text and corpus.lexical is not None and FUSION != "none":
+        dense_vids = rank_talks(
+            embed_q, corpus, n_results * HYBRID_CANDIDATES, use_chunks=use_chunks
+        )
+        return fuse_lexical(
+            embed_q, query_text, corpus, dense_vids, n_results, use_chunks
+        )
+
+    if not use_chunks:
+        if corpus.retriever is not None:
+            return do_ann_sort(
+                embed_q=embed_q,
+                retriever=corpus.retriever,
+                list_talk_ids=corpus.row_ids,
+                top_k=n_results,
+            )
+        return do_sort(
+            embed_q=embed_q,
+            embed_talks=corpus.embeds,
+            list_talk_ids=corpus.row_ids,
+            top_k=n_results,
+        )
+
+    if corpus.chunks is None:
+        raise ValueError("This corpus has no chunk index")
+    return do_chunk_sort(
+        embed_q=embed_q,
+        chunks=corpus.chunks,
+        list_talk_ids=corpus.row_ids,
+        top_k=n_results,
+    )
+
+
+def score_talk_rows(
+    embed_q: np.ndarray, corpus: Corpus, rows: list[int], use_chunks: bool
+) -> list[dict]:
+    """
+    Score chosen talks against a query embedding, in the form `rank_talks`
+    returns.
+
+    Args:
+        embed_q (np.ndarray): The unit-norm query embedding.
+        corpus (Corpus): The corpus.
+        rows (list[int]): The corpus rows of the talks.
+        use_chunks (bool): Score transcript chunks rather than abstracts.  Talks
+            without chunks are then left out.
+
+    Returns:
+        list[dict]: Talk IDs and similarity scores, in the order of `rows`.
+    """
+    if not use_chunks:
+        scores = corpus.embeds[rows] @ embed_q
+        return [
+            {"id0": corpus.row_ids[row], "score": float(score)}
+            for row, score in zip(rows, scores)
+        ]
+
+    chunks = corpus.chunks
+    positions = np.searchsorted(chunks.chunk_talks, rows)
+    sorted_vids = []
+    for row, k in zip(rows, positions.tolist()):
+        if k == len(chunks.chunk_talks) or chunks.chunk_talks[k] != row:
+            continue
+        score, passages = chunks.score_talk(embed_q, k)
+        sorted_vids.append(
+            {"id0": corpus.row_ids[row], "score": score, "passages": passages}
+        )
+    return sorted_vids
+
+
+def fuse_lexical(
+    embed_q: np.ndarray,
+    query_text: str,
+    corpus: Corpus,
+    dense_vids: list[dict],
+    n_results: int,
+    use_chunks: bool,
+) -> list[dict]:
+    """
+    Re-rank the best talks by embedding with the corpus's BM25 index.
+
+    The best lexical matches join the candidates even if their embeddings
+    ranked them low, so a query naming a package or a speaker finds their talk.
+
+    Args:
+        embed_q (np.ndarray): The unit-norm query embedding.
+        query_text (str): The query.
+        corpus (Corpus): The corpus, with a lexical index.
+        dense_vids (list[dict]): The best talks by embedding, from `rank_talks`.
+        n_results (int): The number of talks to return.
+        use_chunks (bool): Whether `dense_vids` were scored by chunk.
+
+    Returns:
+        list[dict]: Talk IDs, cosine and fused scores, best fused first.  See
+            `fuse`.
+    """
+    with get_instrument().span("lexical"):
+        lexical_scores = corpus.lexical.score(query_text)
+        seen = {vid["id0"] for vid in dense_vids}
+        new_rows = [
+            row
+            for row in lexical_candidates(
+                lexical_scores, n_results * HYBRID_CANDIDATES
+            ).tolist()
+            if corpus.row_ids[row] not in seen
+        ]
+        candidates = dense_vids + score_talk_rows(
+            embed_q, corpus, new_rows, use_chunks
+        )
+        candidate_rows = [corpus.id_to_row[vid["id0"]] for vid in candidates]
+        return fuse(
+            candidates,
+            lexical_scores[candidate_rows],
+            n_results,
+            max_lexical=corpus.lexical.max_score(query_text),
+        )
+
+
 def limit_docs(
     sorted_vids: list[dict],
     talk_info: dict,
@@ -147,8 +481,9 @@ def limit_docs(
     # Get the top n_results documents
     top_vids = sorted_vids[:n_results]
 
-    # Get the top score and calculate the score threshold
-    top_score = top_vids[0]["score"]
+    # Get the top score and calculate the score threshold.  Results fused with
+    # lexical scores are not in cosine order, so take the best cosine of them.
+    top_score = max(my_vid["score"] for my_vid in top_vids)
     score_thresh = max(min(0.6, top_score - 0.2), 0.2)
 
     # Filter the top documents based on the score threshold
@@ -162,43 +497,254 @@ def limit_docs(
     return keep_texts
 
 
+def load_corpus_and_embed(
+    query0: str,
+    oai_api_key: str,
+    timings: dict[str, float] | None = None,
+    embed_usage: dict[str, int] | None = None,
+) -> tuple[Corpus, np.ndarray]:
+    """
+    Load the corpus and embed the query at the same time.
+
+    Both usually wait on the network, so the corpus load runs on a worker thread
+    while the query is embedded on this one.
+
+    Args:
+        query0 (str): The user's query.
+        oai_api_key (str): The OpenAI API key.
+        timings (dict[str, float] | None): If given, filled with the seconds
+            spent in "load_data", "embed_query" and "load_and_embed" (wall time).
+        embed_usage (dict[str, int] | None): If given, filled with the token
+            counts of the embedding request.
+
+    Returns:
+        tuple[Corpus, np.ndarray]: The corpus and the query embedding.
+    """
+    start = time.perf_counter()
+    # Run the load in this context, so its span joins the caller's trace
+    corpus_future = _STAGE_POOL.submit(
+        contextvars.copy_context().run,
+        timed,
+        get_corpus_store().get,
+        span_name="load_data",
+    )
+    arr_q, embed_secs = timed(
+        do_1_embed,
+        query0,
+        oai_api_key=oai_api_key,
+        usage=embed_usage,
+        span_name="embed_query",
+    )
+    corpus, load_secs = corpus_future.result()
+
+    if timings is not None:
+        timings["load_data"] = load_secs
+        timings["embed_query"] = embed_secs
+        timings["load_and_embed"] = time.perf_counter() - start
+
+    return corpus, arr_q
+
+
+def timed(fn, *args, span_name: str | None = None, **kwargs) -> tuple:
+    """
+    Call a function and time it, in a span named `span_name` (default: the
+    function's name).
+
+    Returns:
+        tuple: The function's result and the seconds it took.
+    """
+    with get_instrument().span(span_name or fn.__name__) as span:
+        result = fn(*args, **kwargs)
+    return result, span.duration
+
+
 def do_retrieval(
     query0: str,
     n_results: int,
     oai_api_key: str,
-    embeds: np.ndarray,
-    talk_info: dict[str, str | int],
+    embeds: np.ndarray | None = None,
+    talk_info: list[dict] | None = None,
+    corpus: Corpus | None = None,
+    timings: dict[str, float] | None = None,
+    use_chunks: bool | None = None,
 ) -> list[dict]:
     """
     Retrieve relevant documents based on the user's query.
 
+    With no `corpus` (or `embeds` and `talk_info`), the process-wide corpus is
+    loaded while the query is being embedded.
+
     Args:
         query0 (str): The user's query.
         n_results (int): The number of documents to retrieve.
-        api_client (OpenAI): The API client (OpenAI) for generating embeddings.
+        oai_api_key (str): The OpenAI API key.
+        embeds (np.ndarray | None): The talk embeddings, if `corpus` is not given.
+        talk_info (list[dict] | None): The talk info, if `corpus` is not given.
+        corpus (Corpus | None): The prebuilt corpus.  Preferred, since it skips
+            rebuilding the id lookups on every query.
+        timings (dict[str, float] | None): If given, filled with the seconds spent
+            in each stage.
+        use_chunks (bool | None): Retrieve by transcript chunk rather than by
+            abstract.  None uses chunks whenever the corpus has a chunk index.
 
     Returns:
-        dict[str, dict]: The retrieved documents.
+        list[dict]: The retrieved documents.  With chunks, each carries the
+            "passages" of its transcript that matched best.
     """
-    try:
+    if corpus is None and embeds is None:
+        corpus, arr_q = load_corpus_and_embed(query0, oai_api_key, timings=timings)
+    else:
+        if corpus is None:
+            corpus = Corpus.from_data(talk_info, embeds)
+
         # Generate embeddings for the query
-        arr_q = do_1_embed(query0, oai_api_key=oai_api_key)
+        arr_q, embed_secs = timed(
+            do_1_embed, query0, oai_api_key=oai_api_key, span_name="embed_query"
+        )
+        if timings is not None:
+            timings["embed_query"] = embed_secs
+
+    arr_q = normalize_query(arr_q, corpus)
+    keep_texts = retrieve_by_embed(
+        arr_q,
+        corpus,
+        n_results=n_results,
+        use_chunks=use_chunks,
+        timings=timings,
+        query_text=query0,
+    )
+
+    return keep_texts
+
+
+def retrieve_by_embed(
+    arr_q: np.ndarray,
+    corpus: Corpus,
+    n_results: int,
+    use_chunks: bool | None = None,
+    timings: dict[str, float] | None = None,
+    query_text: str | None = None,
+) -> list[dict]:
+    """
+    Retrieve relevant documents for an already embedded query.
+
+    Args:
+        arr_q (np.ndarray): The unit-norm query embedding.
+        corpus (Corpus): The corpus.
+        n_results (int): The number of documents to retrieve.
+        use_chunks (bool | None): Retrieve by transcript chunk rather than by
+            abstract.  None uses chunks whenever the corpus has a chunk index.
+        timings (dict[str, float] | None): If given, filled with the seconds spent
+            in "scoring", "rerank" (when re-ranking is on) and "limit_docs".
+        query_text (str | None): The query, to fuse lexical scores with the
+            embedding scores and to re-rank the talks with the cross-encoder.
+            None ranks by embedding alone.
+
+    Returns:
+        list[dict]: The retrieved documents.
+    """
+    instrument = get_instrument()
+    reranker = get_reranker() if query_text is not None else None
+    n_candidates = n_results
+    if reranker is not None:
+        n_candidates = max(n_results, RERANK_CANDIDATES)
+
+    # Sort documents based on their cosine similarity to the query embedding
+    with instrument.span("scoring", n_talks=len(corpus.row_ids)) as scoring:
+        sorted_vids = rank_talks(
+            arr_q,
+            corpus,
+            n_results=n_candidates,
+            use_chunks=use_chunks,
+            query_text=query_text,
+        )
 
-        # reformat to be like old version
-        talk_ids = [ti["id0"] for ti in talk_info]
-        talk_info = {ti["id0"]: ti for ti in talk_info}
+    # Choose the documents with the cross-encoder, within its latency budget
+    keep_texts = None
+    if reranker is not None:
+        with instrument.span("rerank", n_candidates=len(sorted_vids)) as reranking:
+            keep_texts = rerank_docs(
+                query_text, sorted_vids, corpus.talks_by_id, n_results, reranker
+            )
+            reranking.attrs["fell_back"] = keep_texts is None
+        if timings is not None:
+            timings["rerank"] = reranking.duration
+
+    # Otherwise limit the retrieved documents based on a score threshold
+    with instrument.span("limit_docs") as limiting:
+        if keep_texts is None:
+            keep_texts = limit_docs(
+                sorted_vids=sorted_vids,
+                talk_info=corpus.talks_by_id,
+                n_results=n_results,
+            )
 
-        # Sort documents based on their cosine similarity to the query embedding
-        sorted_vids = do_sort(embed_q=arr_q, embed_talks=embeds, list_talk_ids=talk_ids)
+    if timings is not None:
+        timings["scoring"] = scoring.duration
+        timings["limit_docs"] = limiting.duration
+
+    return keep_texts
 
-        # Limit the retrieved documents based on a score threshold
-        keep_texts = limit_docs(
-            sorted_vids=sorted_vids, talk_info=talk_info, n_results=n_results
+
+def normalize_query(
+    arr_q: np.ndarray, corpus: Corpus, model_name: str | None = None
+) -> np.ndarray:
+    """
+    Check a query embedding against the corpus and scale it to unit length.
+
+    Args:
+        arr_q (np.ndarray): The query embedding.
+        corpus (Corpus): The corpus it will be scored against.
+        model_name (str | None): The model that embedded the query.  None means
+            the configured embedder.
+
+    Returns:
+        np.ndarray: The unit-norm float32 query embedding.
+    """
+    if arr_q is None:
+        raise ValueError("The query embedding request failed")
+    check_embed_model(corpus, model_name)
+    arr_q = np.asarray(arr_q, dtype=np.float32)
+    if arr_q.shape != (corpus.dim,):
+        raise ValueError(
+            f"Query embedding has shape {arr_q.shape} but the corpus has dim {corpus.dim}"
         )
+    return arr_q / np.linalg.norm(arr_q)
 
-        return keep_texts
-    except Exception as e:
-        raise e
+
+def check_embed_model(corpus: Corpus, model_name: str | None = None) -> None:
+    """
+    Check that queries are embedded by the model that embedded the corpus and
+    its chunk index.
+
+    Args:
+        corpus (Corpus): The corpus.
+        model_name (str | None): The model embedding the queries.  None means the
+            configured embedder.
+    """
+    model_name = model_name or get_embedder().model_name
+    if corpus.model_name is not None and corpus.model_name != model_name:
+        raise ValueError(
+            f"Queries are embedded with {model_name} but the corpus with "
+            f"{corpus.model_name}; set RGOV_EMBEDDER to match or re-run a5_embed"
+        )
+    chunks_model = corpus.chunks.model_name if corpus.chunks is not None else None
+    if chunks_model is not None and chunks_model != model_name:
+        raise ValueError(
+            f"Queries are embedded with {model_name} but the chunks with "
+            f"{chunks_model}; set RGOV_EMBEDDER to match or re-run a6_embed_chunks"
+        )
+
+
+def warm_up_models() -> None:
+    """
+    Load the configured query embedder and re-ranker now, so the first question
+    does not wait for them.  The apps call this once at startup.
+    """
+    get_embedder().warm_up()
+    reranker = get_reranker()
+    if reranker is not None:
+        reranker.warm_up()
 
 
 SYSTEM_PROMPT = """
@@ -234,25 +780,58 @@ def set_messages(system_prompt: str, user_prompt: str) -> list[dict[str, str]]:
     return messages1
 
 
-def make_user_prompt(question: str, keep_texts: list[dict]) -> str:
+def make_user_prompt(
+    question: str,
+    keep_texts: list[dict],
+    token_budget: int | None = None,
+    model_name: str = "gpt-4o-mini",
+    stats: dict[str, int] | None = None,
+) -> str:
     """
     Create the user prompt based on the question and the retrieved transcripts.
 
     Args:
         question (str): The user's question.
-        keep_texts (dict[str, dict[str, str]]): The retrieved transcripts.
+        keep_texts (list[dict]): The retrieved transcripts.
+        token_budget (int | None): The most transcript tokens to include.  The
+            most relevant passages are kept and the rest cut.  None includes
+            every retrieved passage (or whole transcript).
+        model_name (str): The chat model, for counting tokens.
+        stats (dict[str, int] | None): If given, filled with the tokens used by
+            the transcripts ("context_tokens") and the whole prompt ("prompt_tokens").
 
     Returns:
         str: The user prompt.
     """
+    if token_budget is None:
+        packed = [
+            [
+                passages_text(tx_val["transcript"], tx_val["passages"])
+                if "passages" in tx_val
+                else tx_val["transcript"]
+            ]
+            for tx_val in keep_texts
+        ]
+        context_tokens = None
+    else:
+        packed, context_tokens = pack_context(
+            keep_texts, token_budget=token_budget, model_name=model_name
+        )
+
     user_prompt = f"""
 Question: {question}
 ==============================
 """
-    if len(keep_texts) > 0:
+    # Talks whose text did not fit in the budget are left out
+    keep_packed = [
+        (tx_val, segments)
+        for tx_val, segments in zip(keep_texts, packed)
+        if segments
+    ]
+    if len(keep_packed) > 0:
         list_strs = []
-        for i, tx_val in enumerate(keep_texts):
-            text0 = tx_val["transcript"]
+        for i, (tx_val, segments) in enumerate(keep_packed):
+            text0 = "\n...\n".join(segments)
             speaker_name = tx_val["Speaker"]
             list_strs.append(
                 f"Video Transcript {i+1}\nSpeaker: {speaker_name}\n{text0}"
@@ -266,161 +845,343 @@ Address the response to me directly.  Do not use any information not explicitly
         # If no relevant transcripts are found, generate a default response
         user_prompt += "No relevant video transcripts were found.  Please just return a result that says something like 'I'm sorry, but the answer to {Question} was not found in the transcripts from the R/Gov Conference'"
     # logger.info(f'User prompt: {user_prompt}')
+    if stats is not None:
+        stats["context_tokens"] = context_tokens
+        stats["prompt_tokens"] = count_tokens(user_prompt, model_name)
     return user_prompt
 
 
-def parse_1_query_stream(response):
+JSON_ERROR_PREFIX = "Error decoding JSON: "
+
+
+def parse_1_query_stream(response, on_complete=None, completion_info=None):
+    """
+    Yield the text of a streamed chat completion as it arrives.
+
+    Args:
+        response: The streaming response.
+        on_complete: Called with the full answer once the stream has been read
+            without errors.
+        completion_info (dict | None): If given, filled with the "finish_reason",
+            "usage" and "error" of the completion once the stream ends.
+
+    Yields:
+        str: The next piece of the answer.
+    """
     # Check if the request was successful
     if response.status_code == 200:
-        for line in response.iter_lines():
-            if line:
-                line = line.decode("utf-8")
-                if line.startswith("data: "):
-                    data = line[6:]  # Remove 'data: ' prefix
-                    if data != "[DONE]":
-                        try:
-                            chunk = json.loads(data)
-                            content = chunk["choices"][0]["delta"].get("content", "")
-                            if content:
-                                yield content
-                        except json.JSONDecodeError:
-                            yield f"Error decoding JSON: {data}"
+        chat_stream = ChatStream()
+        pieces = []
+        for content in chat_stream.iter_content(response.iter_content(chunk_size=None)):
+            pieces.append(content)
+            yield content
+        if completion_info is not None:
+            completion_info.update(chat_stream.info())
+        if on_complete is not None and chat_stream.ok:
+            on_complete("".join(pieces))
     else:
         yield f"Error: {response.status_code}\n{response.text}"
 
 
-def parse_1_query_no_stream(response):
+def parse_1_query_no_stream(response, on_complete=None, completion_info=None):
+    """
+    Get the text of a chat completion.
+
+    Args:
+        response: The response.
+        on_complete: Called with the answer if the request succeeded.
+        completion_info (dict | None): If given, filled with the "finish_reason",
+            "usage" and "error" of the completion.
+
+    Returns:
+        str: The answer, or a description of the error.
+    """
     if response.status_code == 200:
         try:
-            response1 = response.json()
-            completion = response1["choices"][0]["message"]["content"]
-            return completion
-        except json.JSONDecodeError:
-            return f"Error decoding JSON: {response.text}"
+            response1 = json_loads(response.content)
+        except ValueError:
+            return f"{JSON_ERROR_PREFIX}{response.text}"
+        choice = response1["choices"][0]
+        completion = choice["message"]["content"]
+        if completion_info is not None:
+            completion_info.update(
+                finish_reason=choice.get("finish_reason"),
+                usage=response1.get("usage"),
+                error=None,
+            )
+        if on_complete is not None:
+            on_complete(completion)
+        return completion
     else:
         return f"Error: {response.status_code}\n{response.text}"
 
 
+def make_chat_payload(
+    messages1: list[dict[str, str]], model_name: str, stream: bool
+) -> dict:
+    """
+    Make the request payload for a chat completion.
+
+    Args:
+        messages1 (list[dict[str, str]]): The messages for the chat completion.
+        model_name (str): The chat model.
+        stream (bool): Whether to stream the response.
+
+    Returns:
+        dict: The request payload.
+    """
+    payload = {
+        "model": model_name,
+        "messages": messages1,
+        "seed": 18,
+        "temperature": 0,
+        "stream": stream,
+    }
+    if stream:
+        # Ask for a last chunk with the token counts
+        payload["stream_options"] = {"include_usage": True}
+    return payload
+
+
+def chain_callbacks(*callbacks):
+    """
+    Combine callbacks into one that calls each in turn, skipping any that are None.
+    """
+    callbacks = [cb for cb in callbacks if cb is not None]
+
+    def chained(*args) -> None:
+        for cb in callbacks:
+            cb(*args)
+
+    return chained
+
+
 def do_1_query(
-    messages1: list[dict[str, str]], oai_api_key: str, stream: bool, model_name: str
+    messages1: list[dict[str, str]],
+    oai_api_key: str,
+    stream: bool,
+    model_name: str,
+    use_cache: bool = True,
+    on_complete=None,
+    completion_info: dict | None = None,
 ):
     """
     Generate a response using the specified chat completion model.
 
+    Completions are deterministic (temperature 0, fixed seed), so answers are
+    kept in the process-wide answer cache and repeats are served from it.  A
+    cached answer is replayed word by word when streaming.
+
     Args:
         messages1 (list[dict[str, str]]): The messages for the chat completion.
-        gen_client (OpenAI): The generation client (OpenAI).
+        oai_api_key (str): The OpenAI API key.
+        stream (bool): Whether to stream the response.
+        model_name (str): The chat model.
+        use_cache (bool): Whether to read and write the answer cache.
+        on_complete: Called with the full answer once it has been received
+            without errors, or straight away for an answer from the cache.
+        completion_info (dict | None): If given, filled with the "finish_reason",
+            "usage" and "error" of the completion, or "cached" for an answer
+            from the cache.
+
+    Returns:
+        str | Generator[str]: The answer, or a generator of its pieces when streaming.
     """
+    answer_cache = get_answer_cache() if use_cache else None
+    if answer_cache is not None:
+        cached_answer = answer_cache.get_answer(messages1, model_name)
+        if cached_answer is not None:
+            if on_complete is not None:
+                on_complete(cached_answer)
+            if completion_info is not None:
+                completion_info["cached"] = True
+            return replay_stream(cached_answer) if stream else cached_answer
+        on_complete = chain_callbacks(
+            lambda answer: answer_cache.put_answer(messages1, model_name, answer),
+            on_complete,
+        )
 
     # OpenAI API endpoint for chat completions
-    url = "https://api.openai.com/v1/chat/completions"
-
-    # Your OpenAI API key
-    # Headers for the API request
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {oai_api_key}",
-    }
-    if stream:
-        headers["Accept"] = "text/event-stream"  # Required for streaming
+    url = f"{OPENAI_BASE_URL}/chat/completions"
 
-    # Model to use
-    model1 = model_name
+    # Headers and payload for the API request
+    headers = make_headers(oai_api_key, stream=stream)
+    payload = make_chat_payload(messages1, model_name=model_name, stream=stream)
 
-    # Request payload
-    payload = {
-        "model": model1,
-        "messages": messages1,
-        "seed": 18,
-        "temperature": 0,
-        "stream": stream,
-    }
+    # Kept even if the caller did not ask, for the tokens/sec measurement
+    completion_info = {} if completion_info is None else completion_info
 
     # Make the API request
-    response = requests.post(
+    start = time.perf_counter()
+    response = http_post(
         url, headers=headers, data=json.dumps(payload), stream=stream
     )
 
     if stream:
-        response1 = parse_1_query_stream(response)
+        response1 = parse_1_query_stream(
+            response, on_complete=on_complete, completion_info=completion_info
+        )
+        response1 = measure_stream(
+            response1, start, completion_info=completion_info, model=model_name
+        )
     else:
         # Check if the request was successful
-        response1 = parse_1_query_no_stream(response)
+        response1 = parse_1_query_no_stream(
+            response, on_complete=on_complete, completion_info=completion_info
+        )
+        instrument = get_instrument()
+        if instrument.enabled:
+            record_generation(
+                instrument, start, None, 0, completion_info, None, model=model_name
+            )
 
     return response1
 
 
 def do_generation(
-    query1: str, keep_texts: list[dict], oai_api_key: str, stream: bool, model_name: str
+    query1: str,
+    keep_texts: list[dict],
+    oai_api_key: str,
+    stream: bool,
+    model_name: str,
+    token_budget: int | None = CONTEXT_TOKEN_BUDGET,
+    prompt_stats: dict[str, int] | None = None,
+    on_complete=None,
+    completion_info: dict | None = None,
 ):
     """
     Generate the chatbot response using the specified generation client.
 
     Args:
         query1 (str): The user's query.
-        keep_texts (dict[str, dict[str, str]]): The retrieved relevant texts.
-        gen_client (OpenAI): The generation client (OpenAI).
+        keep_texts (list[dict]): The retrieved relevant texts.
+        oai_api_key (str): The OpenAI API key.
+        stream (bool): Whether to stream the response.
+        model_name (str): The chat model.
+        token_budget (int | None): The most transcript tokens to put in the prompt.
+            None sends every retrieved passage (or whole transcript).
+        prompt_stats (dict[str, int] | None): If given, filled with the prompt's
+            token counts.
+        on_complete: Called with the full answer once it has been received
+            without errors.
+        completion_info (dict | None): If given, filled with the "finish_reason"
+            and "usage" of the completion, as for `do_1_query`.
 
     Returns:
-        tuple[Stream, int]: A tuple containing the generated response stream and the number of prompt tokens.
+        str | Generator[str]: The answer, or a generator of its pieces when streaming.
     """
-    user_prompt = make_user_prompt(query1, keep_texts=keep_texts)
-    messages1 = set_messages(SYSTEM_PROMPT, user_prompt)
+    with get_instrument().span("prompt"):
+        user_prompt = make_user_prompt(
+            query1,
+            keep_texts=keep_texts,
+            token_budget=token_budget,
+            model_name=model_name,
+            stats=prompt_stats,
+        )
+        messages1 = set_messages(SYSTEM_PROMPT, user_prompt)
     response = do_1_query(
-        messages1, oai_api_key=oai_api_key, stream=stream, model_name=model_name
+        messages1,
+        oai_api_key=oai_api_key,
+        stream=stream,
+        model_name=model_name,
+        on_complete=on_complete,
+        completion_info=completion_info,
     )
 
     return response
 
 
-def calc_cost(
-    prompt_tokens: int, completion_tokens: int, embedding_tokens: int
-) -> float:
+def do_rag(
+    user_input: str,
+    oai_api_key: str,
+    model_name: str,
+    stream: bool = False,
+    n_results: int = 3,
+    timings: dict[str, float] | None = None,
+    use_semantic_cache: bool = True,
+    session_usage: UsageTotals | None = None,
+) -> RagResult:
     """
-    Calculate the cost in cents based on the number of prompt, completion, and embedding tokens.
+    Answer a question about the R/Gov talks.
+
+    If a near-duplicate question retrieved the same talks before, its answer
+    is reused from the semantic cache and no completion is requested.
+
+    The tokens used are added to the process-wide totals (`get_usage_totals`),
+    and to `session_usage` if given, once the answer has been received.
 
     Args:
-        prompt_tokens (int): The number of tokens in the prompt.
-        completion_tokens (int): The number of tokens in the completion.
-        embedding_tokens (int): The number of tokens in the embedding.
+        user_input (str): The user's question.
+        oai_api_key (str): The OpenAI API key.
+        model_name (str): The chat model.
+        stream (bool): Whether to stream the response.
+        n_results (int): The number of documents to retrieve.
+        timings (dict[str, float] | None): If given, filled with the seconds spent
+            in each stage.  When streaming, "generation" only covers the time to
+            open the stream.
+        use_semantic_cache (bool): Whether to read and write the semantic cache.
+        session_usage (UsageTotals | None): The caller's running usage totals.
 
     Returns:
-        float: The cost in cents.
+        RagResult: The answer (a generator of text pieces when streaming), the
+            retrieved documents, the token usage and cost, and the timings.
+            Unpacks as `(response, retrieved_docs)`.
     """
-    prompt_cost = prompt_tokens / 2000
-    completion_cost = 3 * completion_tokens / 2000
-    embedding_cost = embedding_tokens / 500000
-
-    cost_cents = prompt_cost + completion_cost + embedding_cost
-
-    return cost_cents
+    with get_instrument().span("do_rag", model=model_name, stream=stream):
+        timings = {} if timings is None else timings
+        start = time.perf_counter()
+        usage = Usage(
+            model_name=model_name, embed_model_name=get_embedder().model_name
+        )
 
+        # The corpus (cached for the whole process) loads while the query is embedded
+        embed_usage = {}
+        corpus, arr_q = load_corpus_and_embed(
+            user_input, oai_api_key, timings=timings, embed_usage=embed_usage
+        )
+        usage.embedding_tokens = embed_usage.get("total_tokens", 0)
+        arr_q = normalize_query(arr_q, corpus)
+        retrieved_docs = retrieve_by_embed(
+            arr_q, corpus, n_results=n_results, timings=timings, query_text=user_input
+        )
 
-def do_rag(
-    user_input: str,
-    oai_api_key: str,
-    model_name: str,
-    stream: bool = False,
-    n_results: int = 3,
-):
-    # Load the data
-    talk_info, embeds = import_data()
-    # Load the model
+        semantic_cache = get_semantic_cache() if use_semantic_cache else None
+        on_complete = None
+        if semantic_cache is not None:
+            talk_ids = [doc["id0"] for doc in retrieved_docs]
+            cached_answer = semantic_cache.get_answer(arr_q, model_name, talk_ids)
+            if cached_answer is not None:
+                logger.debug("do_rag answered from the semantic cache")
+                timings["total"] = time.perf_counter() - start
+                usage.answer_cached = True
+                record_usage(usage, session_usage)
+                response = replay_stream(cached_answer) if stream else cached_answer
+                return RagResult(response, retrieved_docs, usage, timings)
+
+            def on_complete(answer: str) -> None:
+                semantic_cache.put_answer(arr_q, model_name, talk_ids, answer)
+
+        completion_info = {}
+        response, timings["generation"] = timed(
+            do_generation,
+            query1=user_input,
+            keep_texts=retrieved_docs,
+            model_name=model_name,
+            oai_api_key=oai_api_key,
+            stream=stream,
+            on_complete=on_complete,
+            completion_info=completion_info,
+        )
+        timings["total"] = time.perf_counter() - start
+        logger.debug(f"do_rag stage timings: {timings}")
 
-    retrieved_docs = do_retrieval(
-        query0=user_input,
-        n_results=n_results,
-        oai_api_key=oai_api_key,
-        embeds=embeds,
-        talk_info=talk_info,
-    )
+        def finish() -> None:
+            usage.add_completion(completion_info)
+            record_usage(usage, session_usage)
 
-    response = do_generation(
-        query1=user_input,
-        keep_texts=retrieved_docs,
-        model_name=model_name,
-        oai_api_key=oai_api_key,
-        stream=stream,
-    )
+        if stream:
+            response = call_when_done(response, finish)
+        else:
+            finish()
 
-    return response, retrieved_docs
+        return RagResult(response, retrieved_docs, usage, timings)
@@ -0,0 +1,621 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, replace
+from pathlib import Path
+
+import numpy as np
+import requests
+from b12_retrievers import (
+    BUILD_BLOCK_ROWS,
+    RETRIEVER,
+    Retriever,
+    array_hash,
+    make_retriever,
+)
+from b13_lexical import FUSION, BM25Index
+from b4_http_client import http_get
+from b6_chunks import ChunkIndex
+
+logger = logging.getLogger(__name__)
+
+# Where the talk info and embeddings live.  Either a URL prefix or a local directory.
+DATA_SOURCE = os.getenv(
+    "RGOV_DATA_SOURCE",
+    "https://raw.githubusercontent.com/AlanFeder/rgov-2024/main/data",
+)
+
+# Seconds before the next request revalidates the cached corpus against the source
+CORPUS_TTL = float(os.getenv("RGOV_CORPUS_TTL", "3600"))
+
+# Where remote .npy files are written so they can be memory-mapped
+CACHE_DIR = Path(
+    os.getenv("RGOV_CACHE_DIR", Path(tempfile.gettempdir()) / "rgov_cache")
+)
+
+TALKS_FILE = "rgov_talks.json"
+EMBEDS_NPY_FILE = "embeds.npy"
+EMBEDS_META_FILE = "embeds_meta.json"
+EMBEDS_CSV_FILE = "embeds.csv"
+CHUNKS_NPY_FILE = "chunks.npy"
+CHUNKS_META_FILE = "chunks_meta.json"
+
+# The quantized copies a5_embed can save (RGOV_QUANTIZE) for each quantized
+# retriever, as (file, dtype, ndim) by the retriever argument they fill
+QUANTIZED_FILES = {
+    "int8": {
+        "codes": ("embeds_int8.npy", np.int8, 2),
+        "scales": ("embeds_int8_scales.npy", np.float32, 1),
+    },
+    "binary": {"bits": ("embeds_binary.npy", np.uint64, 2)},
+}
+
+
+def parse_talk_info(raw: bytes) -> list[dict]:
+    """
+    Parse the talk info file.
+
+    Args:
+        raw (bytes): The contents of rgov_talks.json.
+
+    Returns:
+        list[dict]: A list of talk info.
+    """
+    return json.loads(raw)
+
+
+def parse_embeds_csv(raw: bytes) -> np.ndarray:
+    """
+    Parse the embeddings CSV.  Only used when the binary embeddings are missing.
+
+    Args:
+        raw (bytes): The contents of embeds.csv.
+
+    Returns:
+        np.ndarray: The embeddings as float32.
+    """
+    return np.loadtxt(io.BytesIO(raw), delimiter=",", dtype=np.float32, ndmin=2)
+
+
+def open_embeds_npy(
+    source: str,
+    raw: bytes | None = None,
+    file_name: str = EMBEDS_NPY_FILE,
+    dtype: type = np.float32,
+    ndim: int = 2,
+) -> np.ndarray:
+    """
+    Memory-map the binary embeddings.
+
+    Local files are mapped in place.  Remote files are first written to
+    `CACHE_DIR` under a name derived from their contents, so a mapping held by an
+    older snapshot is never overwritten.
+
+    Args:
+        source (str): A URL prefix or a local directory.
+        raw (bytes | None): The downloaded contents of the file, for remote sources.
+        file_name (str): The .npy file to open.
+        dtype (type): The dtype the file must have.
+        ndim (int): The number of dimensions the file must have.
+
+    Returns:
+        np.ndarray: A read-only view of the embeddings.
+    """
+    if raw is None:
+        file_path = Path(source) / file_name
+    else:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        file_stem = Path(file_name).stem
+        digest = hashlib.sha1(raw).hexdigest()[:16]
+        file_path = CACHE_DIR / f"{file_stem}-{digest}.npy"
+        if not file_path.exists():
+            tmp_path = file_path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_path.write_bytes(raw)
+            os.replace(tmp_path, file_path)
+
+    embeds = np.load(file_path, mmap_mode="r")
+    if embeds.dtype != dtype or embeds.ndim != ndim:
+        raise ValueError(
+            f"{file_path} must be a {ndim}-D {np.dtype(dtype)} array, "
+            f"got {embeds.dtype} {embeds.shape}"
+        )
+    return embeds
+
+
+def check_embeds_hash(embeds: np.ndarray, meta: dict, file_name: str) -> None:
+    """
+    Check that a matrix is the one its header was written for.
+
+    a5_embed replaces the .npy and then its header, so a reader can catch one
+    new and the other old.  Headers written before the hash was recorded are
+    trusted.
+
+    Args:
+        embeds (np.ndarray): The matrix, as loaded.
+        meta (dict): Its header, with the matrix's `array_hash` in "hash".
+        file_name (str): The .npy file, for the error message.
+    """
+    expected = meta.get("hash")
+    if expected is not None and array_hash(embeds) != expected:
+        raise ValueError(
+            f"{file_name} does not match its header, it is probably being rewritten"
+        )
+
+
+def align_talks(talk_info: list[dict], embeds_meta: dict) -> list[dict]:
+    """
+    Order the talk info to match the rows of the embedding matrix.
+
+    Args:
+        talk_info (list[dict]): A list of talk info.
+        embeds_meta (dict): The embeddings header, with the row -> id0 mapping in "ids".
+
+    Returns:
+        list[dict]: The talk info, one entry per embedding row.
+    """
+    row_ids = embeds_meta["ids"]
+    if [ti["id0"] for ti in talk_info] == row_ids:
+        return talk_info
+
+    talks_by_id = {ti["id0"]: ti for ti in talk_info}
+    missing = [id0 for id0 in row_ids if id0 not in talks_by_id]
+    if missing:
+        raise ValueError(f"Embeddings reference unknown talks: {missing[:5]}")
+    return [talks_by_id[id0] for id0 in row_ids]
+
+
+def is_missing(e: Exception) -> bool:
+    """Whether a fetch failed because the file does not exist at the source."""
+    if isinstance(e, FileNotFoundError):
+        return True
+    return (
+        isinstance(e, requests.HTTPError)
+        and e.response is not None
+        and e.response.status_code == 404
+    )
+
+
+def fetch_file(
+    source: str,
+    file_name: str,
+    validator: tuple[str | None, str | None] = (None, None),
+    read: bool = True,
+) -> tuple[bytes | None, tuple[str | None, str | None]]:
+    """
+    Fetch a data file, skipping the download if it has not changed.
+
+    Remote sources are revalidated with a conditional GET (ETag / Last-Modified).
+    Local sources use the file's modification time as the validator.
+
+    Args:
+        source (str): A URL prefix or a local directory.
+        file_name (str): The file to fetch.
+        validator (tuple[str | None, str | None]): The (ETag, Last-Modified) pair
+            from the previous fetch.
+        read (bool): Whether to read a changed local file.  When False an empty
+            bytes object signals the change, for files that are memory-mapped instead.
+
+    Returns:
+        tuple[bytes | None, tuple[str | None, str | None]]: The file contents, or
+            None if unchanged, and the new validator.
+    """
+    etag, last_modified = validator
+
+    if not source.startswith(("http://", "https://")):
+        file_path = Path(source) / file_name
+        mtime = str(file_path.stat().st_mtime_ns)
+        if mtime == last_modified:
+            return None, validator
+        return (file_path.read_bytes() if read else b""), (None, mtime)
+
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    response = http_get(f"{source}/{file_name}", headers=headers)
+    if response.status_code == 304:
+        return None, validator
+    response.raise_for_status()
+
+    new_validator = (
+        response.headers.get("ETag"),
+        response.headers.get("Last-Modified"),
+    )
+    return response.content, new_validator
+
+
+def row_norms(embeds: np.ndarray) -> np.ndarray:
+    """
+    Compute the L2 norm of each row, a block at a time so a memory-mapped matrix
+    is never copied whole.
+
+    Args:
+        embeds (np.ndarray): The matrix.
+
+    Returns:
+        np.ndarray: The norm of each row.
+    """
+    norms = np.empty(embeds.shape[0], dtype=np.float32)
+    for start in range(0, embeds.shape[0], BUILD_BLOCK_ROWS):
+        block = embeds[start : start + BUILD_BLOCK_ROWS]
+        norms[start : start + len(block)] = np.linalg.norm(block, axis=1)
+    return norms
+
+
+# How far a row's L2 norm may drift from 1 before the matrix is renormalized
+NORM_TOLERANCE = 1e-3
+
+
+@dataclass(frozen=True)
+class Corpus:
+    """
+    Everything retrieval needs, built once when the data is loaded.
+
+    Attributes:
+        talk_info (list[dict]): The talk info, one entry per embedding row.
+        embeds (np.ndarray): C-contiguous float32 matrix of L2-normalized
+            embeddings.  Memory-mapped when loaded from embeds.npy.
+        row_ids (np.ndarray): The id0 of the talk in each row.
+        id_to_row (dict[str, int]): Row index for each id0.
+        talks_by_id (dict[str, dict]): Talk info for each id0.
+        model_name (str | None): The embedding model, if the data recorded it.
+        chunks (ChunkIndex | None): Embeddings of transcript windows, if the data
+            directory has a chunk index.
+        retriever (Retriever | None): An approximate index over `embeds`, or None
+            to score every talk.
+        lexical (BM25Index | None): A BM25 index of the talks' text, to fuse with
+            the embedding scores.
+    """
+
+    talk_info: list[dict]
+    embeds: np.ndarray
+    row_ids: np.ndarray
+    id_to_row: dict[str, int]
+    talks_by_id: dict[str, dict]
+    model_name: str | None = None
+    chunks: ChunkIndex | None = None
+    retriever: Retriever | None = None
+    lexical: BM25Index | None = None
+
+    @property
+    def dim(self) -> int:
+        return self.embeds.shape[1]
+
+    @classmethod
+    def from_data(
+        cls,
+        talk_info: list[dict],
+        embeds: np.ndarray,
+        embeds_meta: dict | None = None,
+    ) -> "Corpus":
+        """
+        Validate the talk info and embeddings and build the lookup tables.
+
+        Args:
+            talk_info (list[dict]): A list of talk info, one per embedding row.
+            embeds (np.ndarray): The embeddings.
+            embeds_meta (dict | None): The embeddings header, if there is one.
+
+        Returns:
+            Corpus: The corpus.
+        """
+        if embeds.ndim != 2:
+            raise ValueError(f"Embeddings must be 2-D, got shape {embeds.shape}")
+        if len(talk_info) != embeds.shape[0]:
+            raise ValueError(
+                f"{len(talk_info)} talks but the embeddings have {embeds.shape[0]} rows"
+            )
+        header_dim = (embeds_meta or {}).get("dim")
+        if header_dim is not None and header_dim != embeds.shape[1]:
+            raise ValueError(
+                f"Embeddings header says dim {header_dim} but rows have {embeds.shape[1]}"
+            )
+
+        # A no-op for the memory-mapped .npy, which is already float32 and contiguous
+        embeds = np.ascontiguousarray(embeds, dtype=np.float32)
+
+        norms = row_norms(embeds)
+        if not np.all(np.isfinite(norms)) or np.any(norms == 0):
+            raise ValueError("Embeddings contain rows that are zero or not finite")
+        if np.max(np.abs(norms - 1)) > NORM_TOLERANCE:
+            logger.warning("Embeddings are not unit-norm, normalizing them")
+            embeds = embeds / norms[:, None]
+
+        row_ids = np.array([ti["id0"] for ti in talk_info], dtype=object)
+        id_to_row = {id0: i for i, id0 in enumerate(row_ids.tolist())}
+        if len(id_to_row) != len(row_ids):
+            raise ValueError("Talk info contains duplicate id0 values")
+
+        return cls(
+            talk_info=talk_info,
+            embeds=embeds,
+            row_ids=row_ids,
+            id_to_row=id_to_row,
+            talks_by_id={ti["id0"]: ti for ti in talk_info},
+            model_name=(embeds_meta or {}).get("model"),
+        )
+
+
+def chunk_mismatch(chunks: ChunkIndex, corpus: Corpus) -> str | None:
+    """
+    Check that a chunk index was embedded like the talks it belongs to.
+
+    a6_embed_chunks can be run with a different RGOV_EMBEDDER than a5_embed,
+    and its chunks would then fail to score against the queries, or score
+    wrongly when the dims happen to agree.
+
+    Args:
+        chunks (ChunkIndex): The chunk index.
+        corpus (Corpus): The corpus.
+
+    Returns:
+        str | None: What does not match, or None if nothing.
+    """
+    if chunks.dim != corpus.dim:
+        return f"chunks have dim {chunks.dim} but the talks have dim {corpus.dim}"
+    if (
+        chunks.model_name is not None
+        and corpus.model_name is not None
+        and chunks.model_name != corpus.model_name
+    ):
+        return (
+            f"chunks are embedded with {chunks.model_name} but the talks with "
+            f"{corpus.model_name}"
+        )
+    return None
+
+
+class CorpusStore:
+    """
+    Holds the talk info and embeddings for the life of the process.
+
+    The first call to `get` loads the corpus.  Later calls return the cached
+    `Corpus` until it is older than `ttl`, at which point one caller revalidates
+    the files while the rest keep using the current one.  A new `Corpus` replaces
+    the old one in a single assignment, so readers never see talk info from one
+    version paired with embeddings from another.
+    """
+
+    def __init__(
+        self,
+        source: str | None = None,
+        ttl: float | None = None,
+        lexical: bool | None = None,
+    ):
+        self.source = (source or DATA_SOURCE).rstrip("/")
+        self.ttl = CORPUS_TTL if ttl is None else ttl
+        # Build the BM25 index, unless RGOV_FUSION turns lexical scoring off
+        self.lexical = FUSION != "none" if lexical is None else lexical
+
+        self._snapshot: Corpus | None = None
+        self._validators: dict[str, tuple[str | None, str | None]] = {}
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+        # Last successfully fetched pieces, reused when a revalidation returns 304
+        self._raw_talks: bytes | None = None
+        self._embeds_meta: dict | None = None
+        self._npy: np.ndarray | None = None
+        self._csv: np.ndarray | None = None
+        self._chunks_meta: dict | None = None
+        self._chunks_npy: np.ndarray | None = None
+        self._quantized: dict[str, np.ndarray] = {}
+        self._layout: tuple[bool, bool] | None = None
+
+    def _is_fresh(self) -> bool:
+        return (
+            self._snapshot is not None
+            and time.monotonic() - self._checked_at < self.ttl
+        )
+
+    def get(self) -> Corpus:
+        """
+        Get the current corpus, revalidating it first if the TTL has expired.
+
+        Returns:
+            Corpus: The corpus.
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and self._is_fresh():
+            return snapshot
+        return self.refresh()
+
+    def refresh(self, force: bool = False) -> Corpus:
+        """
+        Revalidate the corpus against the source and swap in any new data.
+
+        Args:
+            force (bool): Revalidate even if the TTL has not expired.
+
+        Returns:
+            Corpus: The corpus.
+        """
+        # Only wait for the lock when there is nothing to serve yet
+        if not self._lock.acquire(blocking=self._snapshot is None):
+            return self._snapshot
+        try:
+            if not force and self._is_fresh():
+                return self._snapshot
+            try:
+                self._snapshot = self._load()
+            except (requests.RequestException, OSError, ValueError) as e:
+                if self._snapshot is None:
+                    raise
+                logger.warning(f"Corpus revalidation failed, serving cached copy: {e}")
+            self._checked_at = time.monotonic()
+            return self._snapshot
+        finally:
+            self._lock.release()
+
+    def _fetch(self, file_name: str, read: bool = True) -> bytes | None:
+        raw, validator = fetch_file(
+            self.source,
+            file_name,
+            self._validators.get(file_name, (None, None)),
+            read=read,
+        )
+        self._pending_validators[file_name] = validator
+        return raw
+
+    def _fetch_optional(self, meta_file: str, npy_file: str):
+        try:
+            return self._fetch(meta_file), self._fetch(npy_file, read=False), True
+        except (requests.HTTPError, FileNotFoundError) as e:
+            if not is_missing(e):
+                raise
+            return None, None, False
+
+    def _fetch_quantized(self, file_names: list[str]) -> dict[str, bytes | None]:
+        raws = {}
+        for file_name in file_names:
+            try:
+                raws[file_name] = self._fetch(file_name, read=False)
+            except (requests.HTTPError, FileNotFoundError) as e:
+                if not is_missing(e):
+                    raise
+                # Quantized on load instead
+                self._quantized.pop(file_name, None)
+                self._validators.pop(file_name, None)
+        return raws
+
+    def _saved_codes(self, quantized_files: dict[str, tuple]) -> dict[str, np.ndarray]:
+        """
+        The retriever's codes saved by a5_embed, if they were made from the
+        current embeddings, else nothing, so the retriever quantizes them itself.
+        """
+        hashes = self._embeds_meta.get("quantized", {})
+        saved = {}
+        for arg, (file_name, _, _) in quantized_files.items():
+            codes = self._quantized.get(file_name)
+            if codes is None or hashes.get(file_name) != array_hash(codes):
+                logger.info(f"No current {file_name}, quantizing the embeddings")
+                return {}
+            saved[arg] = codes
+        return saved
+
+    def _load(self) -> Corpus:
+        self._pending_validators = {}
+        is_local = not self.source.startswith(("http://", "https://"))
+
+        raw_talks = self._fetch(TALKS_FILE)
+        raw_meta, raw_npy, use_npy = self._fetch_optional(
+            EMBEDS_META_FILE, EMBEDS_NPY_FILE
+        )
+        # Older data directories only have the CSV
+        raw_csv = None if use_npy else self._fetch(EMBEDS_CSV_FILE)
+        raw_chunks_meta, raw_chunks_npy, has_chunks = self._fetch_optional(
+            CHUNKS_META_FILE, CHUNKS_NPY_FILE
+        )
+        # The codes a quantized retriever scans, when a5_embed saved them
+        quantized_files = QUANTIZED_FILES.get(RETRIEVER, {}) if use_npy else {}
+        raw_quantized = self._fetch_quantized(
+            [file_name for file_name, _, _ in quantized_files.values()]
+        )
+
+        fetched = [raw_talks, raw_meta, raw_npy, raw_csv]
+        fetched += [raw_chunks_meta, raw_chunks_npy, *raw_quantized.values()]
+        changed = any(raw is not None for raw in fetched)
+        layout = (use_npy, has_chunks)
+        if self._snapshot is not None and not changed and layout == self._layout:
+            return self._snapshot
+
+        # Re-read whatever did not change from the previous fetch
+        if raw_talks is not None:
+            self._raw_talks = raw_talks
+        talk_info = parse_talk_info(self._raw_talks)
+
+        if use_npy:
+            if raw_meta is not None:
+                self._embeds_meta = json.loads(raw_meta)
+            if raw_npy is not None:
+                self._npy = open_embeds_npy(self.source, None if is_local else raw_npy)
+            if raw_meta is not None or raw_npy is not None:
+                check_embeds_hash(self._npy, self._embeds_meta, EMBEDS_NPY_FILE)
+            embeds = self._npy
+            talk_info = align_talks(talk_info, self._embeds_meta)
+        else:
+            if raw_csv is not None:
+                self._csv = parse_embeds_csv(raw_csv)
+            embeds = self._csv
+
+        corpus = Corpus.from_data(
+            talk_info, embeds, self._embeds_meta if use_npy else None
+        )
+
+        saved = {}
+        if quantized_files:
+            for file_name, dtype, ndim in quantized_files.values():
+                raw = raw_quantized.get(file_name)
+                if raw is not None:
+                    self._quantized[file_name] = open_embeds_npy(
+                        self.source,
+                        None if is_local else raw,
+                        file_name=file_name,
+                        dtype=dtype,
+                        ndim=ndim,
+                    )
+            saved = self._saved_codes(quantized_files)
+        # None unless RGOV_RETRIEVER asks for an approximate index and the
+        # matrix is large enough to need one.  A quantized retriever then only
+        # re-ranks a few rows of the memory-mapped float32 matrix.
+        corpus = replace(corpus, retriever=make_retriever(corpus.embeds, **saved))
+        if self.lexical:
+            corpus = replace(corpus, lexical=BM25Index.from_talks(talk_info))
+
+        if has_chunks:
+            if raw_chunks_meta is not None:
+                self._chunks_meta = json.loads(raw_chunks_meta)
+            if raw_chunks_npy is not None:
+                self._chunks_npy = open_embeds_npy(
+                    self.source,
+                    None if is_local else raw_chunks_npy,
+                    file_name=CHUNKS_NPY_FILE,
+                )
+            if raw_chunks_meta is not None or raw_chunks_npy is not None:
+                check_embeds_hash(self._chunks_npy, self._chunks_meta, CHUNKS_NPY_FILE)
+            chunks = ChunkIndex.from_data(
+                self._chunks_npy, self._chunks_meta, corpus.id_to_row
+            )
+            mismatch = chunk_mismatch(chunks, corpus)
+            if mismatch is not None:
+                # Answer from the abstracts rather than fail every question
+                logger.warning(
+                    f"Not using the chunk index: {mismatch}; re-run "
+                    "a6_embed_chunks with the same RGOV_EMBEDDER as a5_embed"
+                )
+            else:
+                chunks = replace(chunks, retriever=make_retriever(chunks.embeds))
+                corpus = replace(corpus, chunks=chunks)
+
+        # Only record the validators once everything has parsed cleanly
+        self._validators.update(self._pending_validators)
+        self._layout = layout
+        logger.info(f"Loaded corpus of {len(talk_info)} talks from {self.source}")
+
+        return corpus
+
+
+_store: CorpusStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_corpus_store() -> CorpusStore:
+    """
+    Get the corpus store shared by every session in this process.
+
+    Returns:
+        CorpusStore: The process-wide corpus store.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = CorpusStore()
+    return _store
@@ -0,0 +1,241 @@
+import asyncio
+import os
+import threading
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import httpx
+except ImportError:  # only needed by the async pipeline
+    httpx = None
+
+# Base URL for the OpenAI API, so a proxy or a local stand-in can be used instead
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip(
+    "/"
+)
+
+# Seconds to wait for a connection and for each read from the socket
+CONNECT_TIMEOUT = float(os.getenv("RGOV_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("RGOV_READ_TIMEOUT", "60"))
+
+# Retries on connection errors, 429 and 5xx, with exponential backoff between them
+MAX_RETRIES = int(os.getenv("RGOV_MAX_RETRIES", "3"))
+BACKOFF_FACTOR = float(os.getenv("RGOV_BACKOFF_FACTOR", "0.5"))
+BACKOFF_MAX = float(os.getenv("RGOV_BACKOFF_MAX", "20"))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+POOL_SIZE = int(os.getenv("RGOV_HTTP_POOL_SIZE", "20"))
+
+
+def make_headers(oai_api_key: str, stream: bool = False) -> dict[str, str]:
+    """
+    Make the headers for an OpenAI API request.
+
+    Args:
+        oai_api_key (str): The OpenAI API key.
+        stream (bool): Whether the response will be streamed as server-sent events.
+
+    Returns:
+        dict[str, str]: The request headers.
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {oai_api_key}",
+    }
+    if stream:
+        headers["Accept"] = "text/event-stream"  # Required for streaming
+    return headers
+
+
+def make_session(
+    max_retries: int = MAX_RETRIES,
+    backoff_factor: float = BACKOFF_FACTOR,
+    pool_size: int = POOL_SIZE,
+) -> requests.Session:
+    """
+    Make a session with a keep-alive connection pool and retries.
+
+    Retries back off exponentially, capped at `BACKOFF_MAX` seconds, and a
+    `Retry-After` header from the server takes precedence over the backoff.
+    POST is retried too: the embedding and chat completion calls are safe to repeat.
+
+    Args:
+        max_retries (int): The maximum number of retries per request.
+        backoff_factor (float): The base of the exponential backoff, in seconds.
+        pool_size (int): The number of connections kept open per host.
+
+    Returns:
+        requests.Session: The configured session.
+    """
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        backoff_max=BACKOFF_MAX,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset({"GET", "POST"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size
+    )
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Get the HTTP session shared by every session in this process.
+
+    Returns:
+        requests.Session: The process-wide HTTP session.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = make_session()
+    return _session
+
+
+def http_get(url: str, **kwargs) -> requests.Response:
+    """
+    Send a GET through the shared session with the default timeouts.
+
+    Args:
+        url (str): The URL to fetch.
+        **kwargs: Passed on to `requests.Session.get`.
+
+    Returns:
+        requests.Response: The response.
+    """
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return get_session().get(url, **kwargs)
+
+
+def http_post(url: str, **kwargs) -> requests.Response:
+    """
+    Send a POST through the shared session with the default timeouts.
+
+    Args:
+        url (str): The URL to post to.
+        **kwargs: Passed on to `requests.Session.post`.
+
+    Returns:
+        requests.Response: The response.
+    """
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return get_session().post(url, **kwargs)
+
+
+def retry_delay(attempt: int, response=None) -> float:
+    """
+    Seconds to wait before retrying, honoring a `Retry-After` header if present.
+
+    Args:
+        attempt (int): How many retries have already been made.
+        response: The response that triggered the retry, if there was one.
+
+    Returns:
+        float: The delay in seconds.
+    """
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), BACKOFF_MAX)
+            except ValueError:
+                pass
+    return min(BACKOFF_FACTOR * 2**attempt, BACKOFF_MAX)
+
+
+# One httpx.AsyncClient per event loop
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client() -> "httpx.AsyncClient":
+    """
+    Get the async HTTP client for the running event loop.
+
+    httpx clients are tied to the loop they were first used on, so there is one
+    client per loop, each with its own keep-alive pool.
+
+    Returns:
+        httpx.AsyncClient: The client for the running loop.
+    """
+    if httpx is None:
+        raise ImportError("The async pipeline needs httpx: pip install httpx")
+
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE
+            ),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def ahttp_send(
+    method: str, url: str, stream: bool = False, **kwargs
+) -> "httpx.Response":
+    """
+    Send a request with the async client, retrying like the sync session does.
+
+    Args:
+        method (str): The HTTP method.
+        url (str): The URL.
+        stream (bool): Return before reading the body.  The caller must close
+            the response.
+        **kwargs: Passed on to `httpx.AsyncClient.build_request`.
+
+    Returns:
+        httpx.Response: The response.
+    """
+    client = get_async_client()
+    request = client.build_request(method, url, **kwargs)
+
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = await client.send(request, stream=stream)
+        except httpx.TransportError:
+            if attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(retry_delay(attempt))
+            continue
+
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            return response
+
+        delay = retry_delay(attempt, response)
+        await response.aclose()
+        await asyncio.sleep(delay)
+
+
+async def ahttp_post(url: str, stream: bool = False, **kwargs) -> "httpx.Response":
+    """
+    Send a POST with the async client.
+
+    Args:
+        url (str): The URL to post to.
+        stream (bool): Return before reading the body.  The caller must close
+            the response.
+        **kwargs: Passed on to `httpx.AsyncClient.build_request`.
+
+    Returns:
+        httpx.Response: The response.
+    """
+    return await ahttp_send("POST", url, stream=stream, **kwargs)
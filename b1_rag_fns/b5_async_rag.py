@@ -0,0 +1,497 @@
+import asyncio
+import json
+import logging
+import time
+from typing import AsyncIterator
+
+import httpx
+import numpy as np
+from b10_usage import (
+    RagResult,
+    Usage,
+    UsageTotals,
+    acall_when_done,
+    record_usage,
+)
+from b11_instrument import ameasure_stream, get_instrument, record_generation
+from b14_embedders import embedder_for, get_embedder
+from b15_rerank import get_reranker
+from b1_all_rag_fns import (
+    SYSTEM_PROMPT,
+    chain_callbacks,
+    make_chat_payload,
+    make_headers,
+    make_user_prompt,
+    normalize_query,
+    parse_1_query_no_stream,
+    retrieve_by_embed,
+    set_messages,
+    timed,
+)
+from b2_corpus_store import Corpus, get_corpus_store
+from b3_caches import (
+    get_answer_cache,
+    get_embed_cache,
+    get_semantic_cache,
+    replay_stream,
+)
+from b4_http_client import OPENAI_BASE_URL, ahttp_post
+from b7_context import CONTEXT_TOKEN_BUDGET
+from b9_sse import ChatStream
+
+logger = logging.getLogger(__name__)
+
+# Async versions of the pipeline in b1_all_rag_fns, for apps that run on an
+# event loop (Shiny).  They build the same requests and parse the same responses,
+# but never block the loop while waiting on the network.
+
+
+async def ado_1_embed(
+    lt: str,
+    oai_api_key: str,
+    model_name: str | None = None,
+    use_cache: bool = True,
+    usage: dict[str, int] | None = None,
+) -> np.ndarray:
+    """
+    Generate embeddings for a single text, without blocking.
+
+    Args:
+        lt (str): A text to generate embeddings for.
+        oai_api_key (str): The OpenAI API key.
+        model_name (str | None): The embedding model.  None uses the configured
+            embedder (RGOV_EMBEDDER).
+        use_cache (bool): Whether to read and write the query embedding cache.
+        usage (dict[str, int] | None): If given, filled with the token counts the
+            API reported.  Left empty when the embedding came from the cache or
+            a local model.
+
+    Returns:
+        np.ndarray: The generated embeddings.
+    """
+    embedder = embedder_for(model_name)
+    embed_cache = get_embed_cache() if use_cache else None
+    # The cache may go to SQLite, so it is read and written off the event loop
+    if embed_cache is not None:
+        here_embed = await asyncio.to_thread(
+            embed_cache.get_embed, lt, embedder.model_name
+        )
+        if here_embed is not None:
+            return here_embed
+
+    try:
+        embeds = await embedder.aembed([lt], oai_api_key=oai_api_key, usage=usage)
+    except httpx.HTTPError as e:
+        # Status errors, and transport errors once the retries have run out
+        detail = e.response.text if isinstance(e, httpx.HTTPStatusError) else ""
+        logger.error(f"Embedding request failed: {e!r} {detail}")
+        return None
+    here_embed = embeds[0]
+
+    if embed_cache is not None:
+        await asyncio.to_thread(
+            embed_cache.put_embed, lt, embedder.model_name, here_embed
+        )
+
+    return here_embed
+
+
+async def atimed(fn, *args, span_name: str | None = None, **kwargs) -> tuple:
+    """
+    Await a coroutine function and time it, like `timed`.
+
+    Returns:
+        tuple: The function's result and the seconds it took.
+    """
+    with get_instrument().span(span_name or fn.__name__) as span:
+        result = await fn(*args, **kwargs)
+    return result, span.duration
+
+
+async def aload_corpus_and_embed(
+    query0: str,
+    oai_api_key: str,
+    timings: dict[str, float] | None = None,
+    embed_usage: dict[str, int] | None = None,
+) -> tuple[Corpus, np.ndarray]:
+    """
+    Load the corpus off the event loop while the query is embedded, like
+    `load_corpus_and_embed` and with the same spans and timings.
+
+    Args:
+        query0 (str): The user's query.
+        oai_api_key (str): The OpenAI API key.
+        timings (dict[str, float] | None): If given, filled with the seconds
+            spent in "load_data", "embed_query" and "load_and_embed" (wall time).
+        embed_usage (dict[str, int] | None): If given, filled with the token
+            counts of the embedding request.
+
+    Returns:
+        tuple[Corpus, np.ndarray]: The corpus and the query embedding.
+    """
+    start = time.perf_counter()
+    # to_thread runs the load in a copy of this context, so its span joins the
+    # caller's trace
+    (corpus, load_secs), (arr_q, embed_secs) = await asyncio.gather(
+        asyncio.to_thread(timed, get_corpus_store().get, span_name="load_data"),
+        atimed(
+            ado_1_embed,
+            query0,
+            oai_api_key=oai_api_key,
+            usage=embed_usage,
+            span_name="embed_query",
+        ),
+    )
+
+    if timings is not None:
+        timings["load_data"] = load_secs
+        timings["embed_query"] = embed_secs
+        timings["load_and_embed"] = time.perf_counter() - start
+
+    return corpus, arr_q
+
+
+async def aretrieve_by_embed(*args, **kwargs) -> list[dict]:
+    """
+    Run `retrieve_by_embed` without blocking.
+
+    Scoring is quick enough to run on the loop, but cross-encoder re-ranking can
+    take up to its latency budget, so when it is on, retrieval runs on a thread.
+    """
+    if get_reranker() is None:
+        return retrieve_by_embed(*args, **kwargs)
+    return await asyncio.to_thread(retrieve_by_embed, *args, **kwargs)
+
+
+async def ado_retrieval(
+    query0: str,
+    n_results: int,
+    oai_api_key: str,
+    corpus: Corpus | None = None,
+    timings: dict[str, float] | None = None,
+    use_chunks: bool | None = None,
+) -> list[dict]:
+    """
+    Retrieve relevant documents based on the user's query, without blocking.
+
+    Args:
+        query0 (str): The user's query.
+        n_results (int): The number of documents to retrieve.
+        oai_api_key (str): The OpenAI API key.
+        corpus (Corpus | None): The corpus.  Defaults to the process-wide one.
+        timings (dict[str, float] | None): If given, filled with the seconds spent
+            in each stage, as for `do_retrieval`.
+        use_chunks (bool | None): Retrieve by transcript chunk rather than by
+            abstract.  None uses chunks whenever the corpus has a chunk index.
+
+    Returns:
+        list[dict]: The retrieved documents.
+    """
+    if corpus is None:
+        corpus, arr_q = await aload_corpus_and_embed(
+            query0, oai_api_key, timings=timings
+        )
+    else:
+        arr_q, embed_secs = await atimed(
+            ado_1_embed, query0, oai_api_key=oai_api_key, span_name="embed_query"
+        )
+        if timings is not None:
+            timings["embed_query"] = embed_secs
+    arr_q = normalize_query(arr_q, corpus)
+    keep_texts = await aretrieve_by_embed(
+        arr_q,
+        corpus,
+        n_results=n_results,
+        use_chunks=use_chunks,
+        timings=timings,
+        query_text=query0,
+    )
+
+    return keep_texts
+
+
+async def aparse_1_query_stream(
+    url: str,
+    headers: dict,
+    payload: dict,
+    on_complete=None,
+    completion_info: dict | None = None,
+) -> AsyncIterator[str]:
+    """
+    Stream a chat completion, yielding the answer text as it arrives.
+
+    The request is only sent once iteration starts, and the connection is
+    returned to the pool when iteration ends.
+
+    Args:
+        url (str): The chat completions endpoint.
+        headers (dict): The request headers.
+        payload (dict): The request payload.
+        on_complete: Called with the full answer once the stream has been read
+            without errors.
+        completion_info (dict | None): If given, filled with the "finish_reason",
+            "usage" and "error" of the completion once the stream ends.
+
+    Yields:
+        str: The next piece of the answer.
+    """
+    response = await ahttp_post(
+        url, stream=True, headers=headers, content=json.dumps(payload)
+    )
+    try:
+        if response.status_code == 200:
+            chat_stream = ChatStream()
+            pieces = []
+            async for content in chat_stream.aiter_content(response.aiter_bytes()):
+                pieces.append(content)
+                yield content
+            if completion_info is not None:
+                completion_info.update(chat_stream.info())
+            if on_complete is not None and chat_stream.ok:
+                on_complete("".join(pieces))
+        else:
+            await response.aread()
+            yield f"Error: {response.status_code}\n{response.text}"
+    finally:
+        await response.aclose()
+
+
+async def areplay_stream(answer: str) -> AsyncIterator[str]:
+    """
+    Yield a cached answer piece by piece, like `replay_stream`.
+
+    Args:
+        answer (str): The full answer.
+
+    Yields:
+        str: Each word of the answer with the whitespace before it.
+    """
+    for piece in replay_stream(answer):
+        yield piece
+
+
+async def ado_1_query(
+    messages1: list[dict[str, str]],
+    oai_api_key: str,
+    stream: bool,
+    model_name: str,
+    use_cache: bool = True,
+    on_complete=None,
+    completion_info: dict | None = None,
+) -> str | AsyncIterator[str]:
+    """
+    Generate a response using the specified chat completion model, without blocking.
+
+    Args:
+        messages1 (list[dict[str, str]]): The messages for the chat completion.
+        oai_api_key (str): The OpenAI API key.
+        stream (bool): Whether to stream the response.
+        model_name (str): The chat model.
+        use_cache (bool): Whether to read and write the answer cache.
+        on_complete: Called with the full answer once it has been received
+            without errors, or straight away for an answer from the cache.
+        completion_info (dict | None): If given, filled with the "finish_reason",
+            "usage" and "error" of the completion, or "cached" for an answer
+            from the cache.
+
+    Returns:
+        str | AsyncIterator[str]: The answer, or an async iterator over its pieces
+            when streaming.
+    """
+    answer_cache = get_answer_cache() if use_cache else None
+    if answer_cache is not None:
+        cached_answer = answer_cache.get_answer(messages1, model_name)
+        if cached_answer is not None:
+            if on_complete is not None:
+                on_complete(cached_answer)
+            if completion_info is not None:
+                completion_info["cached"] = True
+            return areplay_stream(cached_answer) if stream else cached_answer
+        on_complete = chain_callbacks(
+            lambda answer: answer_cache.put_answer(messages1, model_name, answer),
+            on_complete,
+        )
+
+    url = f"{OPENAI_BASE_URL}/chat/completions"
+    headers = make_headers(oai_api_key, stream=stream)
+    payload = make_chat_payload(messages1, model_name=model_name, stream=stream)
+
+    # Kept even if the caller did not ask, for the tokens/sec measurement
+    completion_info = {} if completion_info is None else completion_info
+
+    if stream:
+        # The request is sent when iteration starts, which is close enough to now
+        # for the time to first token
+        pieces = aparse_1_query_stream(
+            url,
+            headers,
+            payload,
+            on_complete=on_complete,
+            completion_info=completion_info,
+        )
+        return ameasure_stream(
+            pieces,
+            time.perf_counter(),
+            completion_info=completion_info,
+            model=model_name,
+        )
+
+    start = time.perf_counter()
+    response = await ahttp_post(url, headers=headers, content=json.dumps(payload))
+    response1 = parse_1_query_no_stream(
+        response, on_complete=on_complete, completion_info=completion_info
+    )
+    instrument = get_instrument()
+    if instrument.enabled:
+        record_generation(
+            instrument, start, None, 0, completion_info, None, model=model_name
+        )
+    return response1
+
+
+async def ado_generation(
+    query1: str,
+    keep_texts: list[dict],
+    oai_api_key: str,
+    stream: bool,
+    model_name: str,
+    token_budget: int | None = CONTEXT_TOKEN_BUDGET,
+    prompt_stats: dict[str, int] | None = None,
+    on_complete=None,
+    completion_info: dict | None = None,
+) -> str | AsyncIterator[str]:
+    """
+    Generate the chatbot response, without blocking.
+
+    Args:
+        query1 (str): The user's query.
+        keep_texts (list[dict]): The retrieved relevant texts.
+        oai_api_key (str): The OpenAI API key.
+        stream (bool): Whether to stream the response.
+        model_name (str): The chat model.
+        token_budget (int | None): The most transcript tokens to put in the prompt.
+            None sends every retrieved passage (or whole transcript).
+        prompt_stats (dict[str, int] | None): If given, filled with the prompt's
+            token counts.
+        on_complete: Called with the full answer once it has been received
+            without errors.
+        completion_info (dict | None): If given, filled with the "finish_reason"
+            and "usage" of the completion, as for `ado_1_query`.
+
+    Returns:
+        str | AsyncIterator[str]: The answer, or an async iterator over its pieces
+            when streaming.
+    """
+    with get_instrument().span("prompt"):
+        user_prompt = make_user_prompt(
+            query1,
+            keep_texts=keep_texts,
+            token_budget=token_budget,
+            model_name=model_name,
+            stats=prompt_stats,
+        )
+        messages1 = set_messages(SYSTEM_PROMPT, user_prompt)
+    response = await ado_1_query(
+        messages1,
+        oai_api_key=oai_api_key,
+        stream=stream,
+        model_name=model_name,
+        on_complete=on_complete,
+        completion_info=completion_info,
+    )
+
+    return response
+
+
+async def ado_rag(
+    user_input: str,
+    oai_api_key: str,
+    model_name: str,
+    stream: bool = False,
+    n_results: int = 3,
+    timings: dict[str, float] | None = None,
+    use_semantic_cache: bool = True,
+    session_usage: UsageTotals | None = None,
+) -> RagResult:
+    """
+    Run the whole RAG pipeline without blocking the event loop.
+
+    Takes the same arguments and returns the same result as `do_rag`, records
+    usage the same way, and opens the same spans (the root span is marked
+    "asynchronous"), so the two can be compared stage by stage.
+
+    Args:
+        user_input (str): The user's question.
+        oai_api_key (str): The OpenAI API key.
+        model_name (str): The chat model.
+        stream (bool): Whether to stream the response.
+        n_results (int): The number of documents to retrieve.
+        timings (dict[str, float] | None): If given, filled with the seconds spent
+            in each stage.  When streaming, "generation" only covers the time to
+            open the stream.
+        use_semantic_cache (bool): Whether to read and write the semantic cache.
+        session_usage (UsageTotals | None): The caller's running usage totals.
+
+    Returns:
+        RagResult: The answer (an async iterator when streaming), the retrieved
+            documents, the token usage and cost, and the timings.  Unpacks as
+            `(response, retrieved_docs)`.
+    """
+    with get_instrument().span(
+        "do_rag", model=model_name, stream=stream, asynchronous=True
+    ):
+        timings = {} if timings is None else timings
+        start = time.perf_counter()
+        usage = Usage(
+            model_name=model_name, embed_model_name=get_embedder().model_name
+        )
+
+        embed_usage = {}
+        corpus, arr_q = await aload_corpus_and_embed(
+            user_input, oai_api_key, timings=timings, embed_usage=embed_usage
+        )
+        usage.embedding_tokens = embed_usage.get("total_tokens", 0)
+        arr_q = normalize_query(arr_q, corpus)
+        retrieved_docs = await aretrieve_by_embed(
+            arr_q, corpus, n_results=n_results, timings=timings, query_text=user_input
+        )
+
+        semantic_cache = get_semantic_cache() if use_semantic_cache else None
+        on_complete = None
+        if semantic_cache is not None:
+            talk_ids = [doc["id0"] for doc in retrieved_docs]
+            cached_answer = semantic_cache.get_answer(arr_q, model_name, talk_ids)
+            if cached_answer is not None:
+                timings["total"] = time.perf_counter() - start
+                usage.answer_cached = True
+                record_usage(usage, session_usage)
+                response = areplay_stream(cached_answer) if stream else cached_answer
+                return RagResult(response, retrieved_docs, usage, timings)
+
+            def on_complete(answer: str) -> None:
+                semantic_cache.put_answer(arr_q, model_name, talk_ids, answer)
+
+        completion_info = {}
+        response, timings["generation"] = await atimed(
+            ado_generation,
+            query1=user_input,
+            keep_texts=retrieved_docs,
+            model_name=model_name,
+            oai_api_key=oai_api_key,
+            stream=stream,
+            on_complete=on_complete,
+            completion_info=completion_info,
+            span_name="do_generation",
+        )
+        timings["total"] = time.perf_counter() - start
+
+        def finish() -> None:
+            usage.add_completion(completion_info)
+            record_usage(usage, session_usage)
+
+        if stream:
+            response = acall_when_done(response, finish)
+        else:
+            finish()
+
+        return RagResult(response, retrieved_docs, usage, timings)
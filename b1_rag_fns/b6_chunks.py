@@ -0,0 +1,248 @@
+from dataclasses import dataclass
+
+import numpy as np
+from b12_retrievers import Retriever
+
+# Transcript chunking used to build the chunk index.  ~1500 characters is
+# roughly 350 tokens.
+CHUNK_CHARS = 1500
+OVERLAP_CHARS = 300
+
+# How many passages from each retrieved talk go into the prompt
+N_PASSAGES = 3
+
+
+def split_transcript(
+    text: str, chunk_chars: int = CHUNK_CHARS, overlap_chars: int = OVERLAP_CHARS
+) -> list[tuple[int, int]]:
+    """
+    Split a transcript into overlapping windows.
+
+    Windows end at a sentence break when there is one in their last fifth, and
+    the next window starts `overlap_chars` before the previous one ended.
+
+    Args:
+        text (str): The transcript.
+        chunk_chars (int): The maximum length of a window, in characters.
+        overlap_chars (int): How much consecutive windows overlap, in characters.
+
+    Returns:
+        list[tuple[int, int]]: The (start, end) character offsets of each window.
+    """
+    if overlap_chars >= chunk_chars:
+        raise ValueError("overlap_chars must be smaller than chunk_chars")
+
+    spans = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_chars, len(text))
+        if end < len(text):
+            sentence_end = text.rfind(". ", end - chunk_chars // 5, end)
+            if sentence_end != -1:
+                end = sentence_end + 1
+        spans.append((start, end))
+        if end == len(text):
+            break
+
+        # Begin the next window on a word boundary
+        start = max(end - overlap_chars, start + 1)
+        next_space = text.find(" ", start, end)
+        if next_space != -1:
+            start = next_space + 1
+    return spans
+
+
+@dataclass(frozen=True)
+class ChunkIndex:
+    """
+    Embeddings of transcript windows, grouped by talk.
+
+    Chunks are stored talk by talk, so the chunks of the k-th talk that has any
+    are rows `talk_offsets[k]:talk_offsets[k + 1]`.
+
+    Attributes:
+        embeds (np.ndarray): C-contiguous float32 matrix of L2-normalized
+            chunk embeddings.
+        talk_rows (np.ndarray): The corpus row of the talk each chunk came from.
+        starts (np.ndarray): Start offset of each chunk in its talk's transcript.
+        ends (np.ndarray): End offset of each chunk in its talk's transcript.
+        chunk_talks (np.ndarray): The corpus rows of the talks that have chunks.
+        talk_offsets (np.ndarray): Where each of those talks' chunks begin, plus
+            the total number of chunks.
+        retriever (Retriever | None): An approximate index over `embeds`, or None
+            to score every chunk.
+        model_name (str | None): The embedding model, if the header recorded it.
+    """
+
+    embeds: np.ndarray
+    talk_rows: np.ndarray
+    starts: np.ndarray
+    ends: np.ndarray
+    chunk_talks: np.ndarray
+    talk_offsets: np.ndarray
+    retriever: Retriever | None = None
+    model_name: str | None = None
+
+    @property
+    def dim(self) -> int:
+        return self.embeds.shape[1]
+
+    @classmethod
+    def from_data(
+        cls, embeds: np.ndarray, chunks_meta: dict, id_to_row: dict[str, int]
+    ) -> "ChunkIndex":
+        """
+        Validate the chunk embeddings and group them by talk.
+
+        Args:
+            embeds (np.ndarray): The chunk embeddings, one row per chunk.
+            chunks_meta (dict): The chunk header, with "ids", "starts" and "ends" lists.
+            id_to_row (dict[str, int]): The corpus row of each talk.
+
+        Returns:
+            ChunkIndex: The chunk index.
+        """
+        ids = chunks_meta["ids"]
+        if embeds.ndim != 2 or embeds.shape[0] != len(ids):
+            raise ValueError(
+                f"{len(ids)} chunks but the chunk embeddings have shape {embeds.shape}"
+            )
+        header_dim = chunks_meta.get("dim")
+        if header_dim is not None and header_dim != embeds.shape[1]:
+            raise ValueError(
+                f"Chunk header says dim {header_dim} but rows have {embeds.shape[1]}"
+            )
+        unknown = {id0 for id0 in ids if id0 not in id_to_row}
+        if unknown:
+            raise ValueError(f"Chunks reference unknown talks: {sorted(unknown)[:5]}")
+
+        talk_rows = np.array([id_to_row[id0] for id0 in ids], dtype=np.int64)
+        starts = np.asarray(chunks_meta["starts"], dtype=np.int64)
+        ends = np.asarray(chunks_meta["ends"], dtype=np.int64)
+
+        embeds = np.ascontiguousarray(embeds, dtype=np.float32)
+        norms = np.linalg.norm(embeds, axis=1)
+        if np.any(norms == 0):
+            raise ValueError("Chunk embeddings contain zero rows")
+        if np.max(np.abs(norms - 1)) > 1e-3:
+            embeds = embeds / norms[:, None]
+
+        # Group the chunks talk by talk, keeping their order within a talk
+        order = np.argsort(talk_rows, kind="stable")
+        if np.any(order != np.arange(len(order))):
+            embeds = embeds[order]
+            talk_rows, starts, ends = talk_rows[order], starts[order], ends[order]
+
+        chunk_talks, first_chunk = np.unique(talk_rows, return_index=True)
+        talk_offsets = np.append(first_chunk, len(talk_rows))
+
+        return cls(
+            embeds=embeds,
+            talk_rows=talk_rows,
+            starts=starts,
+            ends=ends,
+            chunk_talks=chunk_talks,
+            talk_offsets=talk_offsets,
+            model_name=chunks_meta.get("model"),
+        )
+
+    def score_talks(self, embed_q: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Score every chunk, and each talk by its best chunk.
+
+        Args:
+            embed_q (np.ndarray): The unit-norm query embedding.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The score of every chunk, and the score
+                of each talk in `chunk_talks`.
+        """
+        chunk_scores = self.embeds @ embed_q
+        talk_scores = np.maximum.reduceat(chunk_scores, self.talk_offsets[:-1])
+        return chunk_scores, talk_scores
+
+    def best_passages(
+        self, chunk_scores: np.ndarray, k: int, n_passages: int = N_PASSAGES
+    ) -> list[dict[str, int | float]]:
+        """
+        Get the best passages of one talk, in transcript order.
+
+        Overlapping chunks are merged into one passage.
+
+        Args:
+            chunk_scores (np.ndarray): The score of every chunk.
+            k (int): The talk's position in `chunk_talks`.
+            n_passages (int): How many chunks to take before merging.
+
+        Returns:
+            list[dict[str, int | float]]: The start and end offset and best chunk
+                score of each passage.
+        """
+        lo, hi = self.talk_offsets[k], self.talk_offsets[k + 1]
+        return self._merge_passages(chunk_scores[lo:hi], lo, n_passages)
+
+    def talk_positions(self, chunk_rows: np.ndarray) -> np.ndarray:
+        """
+        Find the talk each chunk belongs to.
+
+        Args:
+            chunk_rows (np.ndarray): Chunk row indices.
+
+        Returns:
+            np.ndarray: The position in `chunk_talks` of each chunk's talk.
+        """
+        return np.searchsorted(self.talk_offsets, chunk_rows, side="right") - 1
+
+    def score_talk(
+        self, embed_q: np.ndarray, k: int, n_passages: int = N_PASSAGES
+    ) -> tuple[float, list[dict[str, int | float]]]:
+        """
+        Score one talk's chunks, for when the rest of the index is not scored.
+
+        Args:
+            embed_q (np.ndarray): The unit-norm query embedding.
+            k (int): The talk's position in `chunk_talks`.
+            n_passages (int): How many chunks to take before merging.
+
+        Returns:
+            tuple[float, list[dict[str, int | float]]]: The talk's best chunk
+                score, and its best passages as from `best_passages`.
+        """
+        lo, hi = self.talk_offsets[k], self.talk_offsets[k + 1]
+        talk_scores = self.embeds[lo:hi] @ embed_q
+        return float(talk_scores.max()), self._merge_passages(
+            talk_scores, lo, n_passages
+        )
+
+    def _merge_passages(
+        self, talk_scores: np.ndarray, lo: int, n_passages: int
+    ) -> list[dict[str, int | float]]:
+        n_take = min(n_passages, len(talk_scores))
+        best = np.argpartition(-talk_scores, n_take - 1)[:n_take]
+        best.sort()
+
+        passages = []
+        for j in best:
+            i = lo + j
+            start, end = int(self.starts[i]), int(self.ends[i])
+            score = float(talk_scores[j])
+            if passages and start <= passages[-1]["end"]:
+                passages[-1]["end"] = max(passages[-1]["end"], end)
+                passages[-1]["score"] = max(passages[-1]["score"], score)
+            else:
+                passages.append({"start": start, "end": end, "score": score})
+        return passages
+
+
+def passages_text(transcript: str, passages: list[dict]) -> str:
+    """
+    Pull the passages out of a transcript.
+
+    Args:
+        transcript (str): The full transcript.
+        passages (list[dict]): Passages with "start" and "end" offsets, in order.
+
+    Returns:
+        str: The passages, separated by ellipses where text was skipped.
+    """
+    return "\n...\n".join(transcript[p["start"] : p["end"]] for p in passages)
@@ -0,0 +1,131 @@
+import functools
+import math
+import os
+
+try:
+    import tiktoken
+except ImportError:  # fall back to estimating from the character count
+    tiktoken = None
+
+# Tokens of transcript text allowed in one prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("RGOV_CONTEXT_TOKENS", "8000"))
+
+# Average characters per token for English text, used when tiktoken is missing
+CHARS_PER_TOKEN = 4
+
+# Below this many tokens, a cut-down segment is not worth adding
+MIN_SEGMENT_TOKENS = 100
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name: str):
+    """
+    Get the tiktoken encoding for a model, or None if tiktoken is not installed.
+
+    Args:
+        model_name (str): The chat model.
+
+    Returns:
+        The tiktoken encoding, or None.
+    """
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text: str, model_name: str = "gpt-4o-mini") -> int:
+    """
+    Count the tokens in a text, or estimate them if tiktoken is not installed.
+
+    Args:
+        text (str): The text.
+        model_name (str): The chat model whose tokenizer to use.
+
+    Returns:
+        int: The number of tokens.
+    """
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(
+    text: str, max_tokens: int, model_name: str = "gpt-4o-mini"
+) -> str:
+    """
+    Cut a text down to at most `max_tokens` tokens, ending on a word boundary.
+
+    Args:
+        text (str): The text.
+        max_tokens (int): The most tokens to keep.
+        model_name (str): The chat model whose tokenizer to use.
+
+    Returns:
+        str: The start of the text.
+    """
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        cut = text[: max_tokens * CHARS_PER_TOKEN]
+    else:
+        cut = encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+    if len(cut) < len(text) and " " in cut:
+        cut = cut[: cut.rfind(" ")]
+    return cut
+
+
+def pack_context(
+    keep_texts: list[dict],
+    token_budget: int = CONTEXT_TOKEN_BUDGET,
+    model_name: str = "gpt-4o-mini",
+) -> tuple[list[list[str]], int]:
+    """
+    Choose the transcript text to send for each retrieved talk within a token budget.
+
+    Each talk contributes its retrieved passages, or its whole transcript if it
+    has none.  These segments are added best score first while they fit.  The
+    first one that does not fit is cut down to the budget that is left, unless
+    too little is left, in which case smaller segments may still be added.
+
+    Args:
+        keep_texts (list[dict]): The retrieved talks, with "score" and
+            "transcript" and optionally "passages".
+        token_budget (int): The most transcript tokens to send.
+        model_name (str): The chat model whose tokenizer to use.
+
+    Returns:
+        tuple[list[list[str]], int]: The text segments for each talk, in
+            transcript order, and the tokens they use.
+    """
+    segments = []
+    for i, tx_val in enumerate(keep_texts):
+        transcript = tx_val["transcript"]
+        for passage in tx_val.get("passages") or [
+            {"start": 0, "end": len(transcript), "score": tx_val["score"]}
+        ]:
+            text = transcript[passage["start"] : passage["end"]]
+            segments.append((passage["score"], i, passage["start"], text))
+
+    chosen = []
+    tokens_used = 0
+    for score, i, start, text in sorted(segments, key=lambda seg: -seg[0]):
+        remaining = token_budget - tokens_used
+        n_tokens = count_tokens(text, model_name)
+        if n_tokens <= remaining:
+            chosen.append((i, start, text))
+            tokens_used += n_tokens
+        elif remaining >= MIN_SEGMENT_TOKENS:
+            text = truncate_to_tokens(text, remaining, model_name)
+            chosen.append((i, start, text))
+            tokens_used += count_tokens(text, model_name)
+            break
+
+    packed = [[] for _ in keep_texts]
+    for i, start, text in sorted(chosen, key=lambda seg: seg[:2]):
+        packed[i].append(text)
+
+    return packed, tokens_used
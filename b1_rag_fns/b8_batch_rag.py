@@ -0,0 +1,354 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from b10_usage import Usage, UsageTotals, record_usage
+from b12_retrievers import top_k_indices
+from b13_lexical import FUSION, HYBRID_CANDIDATES
+from b14_embedders import embedder_for, get_embedder
+from b15_rerank import RERANK_CANDIDATES, get_reranker, rerank_docs
+from b1_all_rag_fns import (
+    check_embed_model,
+    do_generation,
+    fuse_lexical,
+    limit_docs,
+)
+from b2_corpus_store import Corpus, get_corpus_store
+from b3_caches import get_embed_cache
+
+# Batch versions of the pipeline in b1_all_rag_fns, for offline jobs such as
+# evaluation sets: one embeddings request and one matrix product for all the
+# questions, then completions in parallel.
+
+
+def do_embed_batch(
+    texts: list[str],
+    oai_api_key: str,
+    model_name: str | None = None,
+    use_cache: bool = True,
+    usage: dict[str, int] | None = None,
+) -> np.ndarray:
+    """
+    Generate embeddings for many texts with as few API requests as possible.
+
+    Texts already in the query embedding cache are not sent.
+
+    Args:
+        texts (list[str]): The texts to generate embeddings for.
+        oai_api_key (str): The OpenAI API key.
+        model_name (str | None): The embedding model.  None uses the configured
+            embedder (RGOV_EMBEDDER).
+        use_cache (bool): Whether to read and write the query embedding cache.
+        usage (dict[str, int] | None): If given, filled with the token counts the
+            API reported for the whole batch.
+
+    Returns:
+        np.ndarray: The float32 embeddings, one row per text.
+    """
+    embedder = embedder_for(model_name)
+    embed_cache = get_embed_cache() if use_cache else None
+    all_embeds: list[np.ndarray | None] = [None] * len(texts)
+    if embed_cache is not None:
+        all_embeds = [
+            embed_cache.get_embed(text, embedder.model_name) for text in texts
+        ]
+
+    # Send each distinct uncached text once
+    to_embed = list(dict.fromkeys(t for t, e in zip(texts, all_embeds) if e is None))
+    new_embeds = {}
+    if to_embed:
+        new_embeds = dict(
+            zip(
+                to_embed,
+                embedder.embed(to_embed, oai_api_key=oai_api_key, usage=usage),
+            )
+        )
+
+    for text, here_embed in new_embeds.items():
+        if embed_cache is not None:
+            embed_cache.put_embed(text, embedder.model_name, here_embed)
+    all_embeds = [
+        new_embeds[text] if here_embed is None else here_embed
+        for text, here_embed in zip(texts, all_embeds)
+    ]
+
+    return np.asarray(all_embeds, dtype=np.float32)
+
+
+def rank_talks_batch(
+    embed_qs: np.ndarray,
+    corpus: Corpus,
+    n_results: int,
+    use_chunks: bool | None = None,
+    query_texts: list[str] | None = None,
+) -> list[list[dict]]:
+    """
+    Rank the talks in a corpus against many query embeddings at once.
+
+    Gives the same results as calling `rank_talks` for each query with exact
+    search, but scores all of them with one matrix-matrix product.
+
+    Args:
+        embed_qs (np.ndarray): The unit-norm query embeddings, one row per query.
+        corpus (Corpus): The corpus.
+        n_results (int): The number of talks to return per query.
+        use_chunks (bool | None): Score transcript chunks rather than abstracts.
+            None uses chunks whenever the corpus has a chunk index.
+        query_texts (list[str] | None): The queries, to fuse lexical scores with
+            the embedding scores as `rank_talks` does.
+
+    Returns:
+        list[list[dict]]: For each query, talk IDs and similarity scores, best first.
+    """
+    if use_chunks is None:
+        use_chunks = corpus.chunks is not None
+
+    if query_texts is not None and corpus.lexical is not None and FUSION != "none":
+        all_dense_vids = rank_talks_batch(
+            embed_qs, corpus, n_results * HYBRID_CANDIDATES, use_chunks=use_chunks
+        )
+        return [
+            fuse_lexical(embed_q, query, corpus, dense_vids, n_results, use_chunks)
+            for embed_q, query, dense_vids in zip(
+                embed_qs, query_texts, all_dense_vids
+            )
+        ]
+
+    if not use_chunks:
+        # (queries, talks)
+        all_scores = embed_qs @ corpus.embeds.T
+        return [
+            [
+                {"id0": corpus.row_ids[i], "score": float(scores[i])}
+                for i in top_k_indices(scores, n_results)
+            ]
+            for scores in all_scores
+        ]
+
+    chunks = corpus.chunks
+    if chunks is None:
+        raise ValueError("This corpus has no chunk index")
+
+    # (queries, chunks), then each talk scored by its best chunk
+    all_chunk_scores = embed_qs @ chunks.embeds.T
+    all_talk_scores = np.maximum.reduceat(
+        all_chunk_scores, chunks.talk_offsets[:-1], axis=1
+    )
+    return [
+        [
+            {
+                "id0": corpus.row_ids[chunks.chunk_talks[k]],
+                "score": float(talk_scores[k]),
+                "passages": chunks.best_passages(chunk_scores, k),
+            }
+            for k in top_k_indices(talk_scores, n_results)
+        ]
+        for chunk_scores, talk_scores in zip(all_chunk_scores, all_talk_scores)
+    ]
+
+
+def error_text(e: Exception) -> str:
+    """Describe an exception for a result's "error" field."""
+    return f"{type(e).__name__}: {e}"
+
+
+def share_tokens(n_tokens: int, texts: list[str]) -> list[int]:
+    """
+    Split a batch's token count between its texts, in proportion to their
+    length, so the shares add up to the total.
+
+    Args:
+        n_tokens (int): The tokens the batch used.
+        texts (list[str]): The texts in the batch.
+
+    Returns:
+        list[int]: Each text's share.
+    """
+    lengths = np.array([max(len(text), 1) for text in texts], dtype=np.float64)
+    bounds = np.rint(np.cumsum(lengths) / lengths.sum() * n_tokens).astype(int)
+    return np.diff(bounds, prepend=0).tolist()
+
+
+def embed_questions(
+    questions: list[str], oai_api_key: str, usages: list[Usage], errors: list
+) -> np.ndarray:
+    """
+    Embed the questions in one batch, or one at a time if the batch fails, so a
+    question the API rejects does not fail the rest.
+
+    Args:
+        questions (list[str]): The questions.
+        oai_api_key (str): The OpenAI API key.
+        usages (list[Usage]): Each question's usage, given its embedding tokens.
+        errors (list): Each question's error, set for those that failed.
+
+    Returns:
+        np.ndarray: The unit-norm embeddings, one row per question.  Rows of
+            questions that failed are zero.
+    """
+    embed_usage = {}
+    try:
+        rows = list(
+            do_embed_batch(questions, oai_api_key=oai_api_key, usage=embed_usage)
+        )
+        shares = share_tokens(embed_usage.get("total_tokens", 0), questions)
+        for usage, n_tokens in zip(usages, shares):
+            usage.embedding_tokens = n_tokens
+    except Exception:
+        rows = []
+        for i, question in enumerate(questions):
+            embed_usage = {}
+            try:
+                embed_q = do_embed_batch(
+                    [question], oai_api_key=oai_api_key, usage=embed_usage
+                )
+                rows.append(embed_q[0])
+            except Exception as e:
+                rows.append(None)
+                errors[i] = f"Embedding failed: {error_text(e)}"
+            usages[i].embedding_tokens = embed_usage.get("total_tokens", 0)
+
+    dims = {len(row) for row in rows if row is not None}
+    embed_qs = np.zeros((len(questions), dims.pop() if dims else 0), np.float32)
+    for i, row in enumerate(rows):
+        if row is None:
+            continue
+        norm = np.linalg.norm(row)
+        if not np.isfinite(norm) or norm == 0:
+            errors[i] = "Embedding failed: the embedding is zero or not finite"
+        else:
+            embed_qs[i] = row / norm
+    return embed_qs
+
+
+def do_rag_batch(
+    user_inputs: list[str],
+    oai_api_key: str,
+    model_name: str,
+    n_results: int = 3,
+    max_concurrency: int = 8,
+    session_usage: UsageTotals | None = None,
+) -> list[dict]:
+    """
+    Answer many questions about the R/Gov talks.
+
+    A failure on one question is reported in its result and does not stop the
+    others: when a step shared by the batch fails (the embeddings request, or
+    ranking), it is retried one question at a time.
+
+    Each question's usage is recorded as in `do_rag`, with the embedding tokens
+    of the batch request shared out by question length.
+
+    Args:
+        user_inputs (list[str]): The questions.
+        oai_api_key (str): The OpenAI API key.
+        model_name (str): The chat model.
+        n_results (int): The number of documents to retrieve per question.
+        max_concurrency (int): The most completions to request at once.
+        session_usage (UsageTotals | None): The caller's running usage totals.
+
+    Returns:
+        list[dict]: One result per question, in input order, with "question",
+            "answer", "retrieved_docs", "usage" and "error" (None on success).
+    """
+    if not user_inputs:
+        return []
+    corpus = get_corpus_store().get()
+
+    check_embed_model(corpus)
+    embed_model_name = get_embedder().model_name
+    usages = [
+        Usage(model_name=model_name, embed_model_name=embed_model_name)
+        for _ in user_inputs
+    ]
+    errors: list[str | None] = [None] * len(user_inputs)
+
+    embed_qs = embed_questions(user_inputs, oai_api_key, usages, errors)
+    if embed_qs.shape[1] not in (0, corpus.dim):
+        raise ValueError(
+            f"Query embeddings have dim {embed_qs.shape[1]} "
+            f"but the corpus has dim {corpus.dim}"
+        )
+
+    reranker = get_reranker()
+    n_candidates = n_results
+    if reranker is not None:
+        n_candidates = max(n_results, RERANK_CANDIDATES)
+
+    # Rank every question that has an embedding at once
+    ranked = [i for i, error in enumerate(errors) if error is None]
+    all_sorted_vids: list[list[dict] | None] = [None] * len(user_inputs)
+    if ranked:
+        try:
+            batch_vids = rank_talks_batch(
+                embed_qs[ranked],
+                corpus,
+                n_results=n_candidates,
+                query_texts=[user_inputs[i] for i in ranked],
+            )
+            for i, sorted_vids in zip(ranked, batch_vids):
+                all_sorted_vids[i] = sorted_vids
+        except Exception:
+            for i in ranked:
+                try:
+                    all_sorted_vids[i] = rank_talks_batch(
+                        embed_qs[i : i + 1],
+                        corpus,
+                        n_results=n_candidates,
+                        query_texts=[user_inputs[i]],
+                    )[0]
+                except Exception as e:
+                    errors[i] = f"Retrieval failed: {error_text(e)}"
+
+    all_docs: list[list[dict] | None] = [None] * len(user_inputs)
+    for i, (question, sorted_vids) in enumerate(zip(user_inputs, all_sorted_vids)):
+        if errors[i] is not None:
+            continue
+        try:
+            docs = None
+            if reranker is not None:
+                docs = rerank_docs(
+                    question, sorted_vids, corpus.talks_by_id, n_results, reranker
+                )
+            if docs is None:
+                docs = limit_docs(
+                    sorted_vids, talk_info=corpus.talks_by_id, n_results=n_results
+                )
+            all_docs[i] = docs
+        except Exception as e:
+            errors[i] = f"Retrieval failed: {error_text(e)}"
+
+    def answer_1(
+        question: str, retrieved_docs: list[dict] | None, usage: Usage, error
+    ) -> dict:
+        answer = None
+        if error is None:
+            # Generation only reports success through on_complete
+            succeeded = []
+            completion_info = {}
+            try:
+                answer = do_generation(
+                    query1=question,
+                    keep_texts=retrieved_docs,
+                    oai_api_key=oai_api_key,
+                    stream=False,
+                    model_name=model_name,
+                    on_complete=succeeded.append,
+                    completion_info=completion_info,
+                )
+                error = None if succeeded else answer
+            except Exception as e:
+                error = error_text(e)
+            usage.add_completion(completion_info)
+        record_usage(usage, session_usage)
+        return {
+            "question": question,
+            "answer": answer if error is None else None,
+            "retrieved_docs": retrieved_docs,
+            "usage": usage,
+            "error": error,
+        }
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        results = list(pool.map(answer_1, user_inputs, all_docs, usages, errors))
+
+    return results
@@ -0,0 +1,212 @@
+import json
+import logging
+from dataclasses import dataclass
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator
+
+try:
+    import orjson
+except ImportError:  # the standard library parser is slower but gives the same result
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Both accept bytes, and both raise a ValueError subclass on bad input
+json_loads = json.loads if orjson is None else orjson.loads
+
+DONE = b"[DONE]"
+
+
+class SSEDecoder:
+    """
+    Incremental decoder for a server-sent event stream.
+
+    Network reads are fed in as raw bytes and complete events come out.  A line
+    split across reads is kept until the rest of it arrives, and the lines of
+    an event with several `data:` fields are joined with newlines, as the SSE
+    spec requires.  Fields other than `data:` and comments are ignored.
+
+    Only the data of each event is copied out of the buffer; nothing is decoded
+    to str.
+    """
+
+    def __init__(self) -> None:
+        self._buf = bytearray()
+        self._data: bytes | None = None
+
+    def feed(self, chunk: bytes) -> list[bytes]:
+        """
+        Add bytes read from the stream.
+
+        Args:
+            chunk (bytes): The bytes, which may end part way through a line.
+
+        Returns:
+            list[bytes]: The data of every event completed by these bytes.
+        """
+        buf = self._buf
+        buf += chunk
+        events = []
+        pos = 0
+        while True:
+            newline = buf.find(b"\n", pos)
+            if newline == -1:
+                break
+            self._read_line(pos, newline, events)
+            pos = newline + 1
+
+        if pos:
+            del buf[:pos]
+        return events
+
+    def flush(self) -> list[bytes]:
+        """
+        End the stream, completing an event that was not followed by a blank line.
+
+        Returns:
+            list[bytes]: The data of the last event, if there was one.
+        """
+        events = []
+        if self._buf:
+            self._read_line(0, len(self._buf), events)
+            self._buf.clear()
+        if self._data is not None:
+            events.append(self._data)
+            self._data = None
+        return events
+
+    def _read_line(self, pos: int, end: int, events: list[bytes]) -> None:
+        buf = self._buf
+        if end > pos and buf[end - 1] == 13:  # "\r\n" line ending
+            end -= 1
+
+        if end == pos:
+            # A blank line ends the event
+            if self._data is not None:
+                events.append(self._data)
+                self._data = None
+        elif buf.startswith(b"data:", pos):
+            start = pos + 5
+            if start < end and buf[start] == 32:  # one optional space
+                start += 1
+            value = bytes(buf[start:end])
+            self._data = value if self._data is None else self._data + b"\n" + value
+
+
+@dataclass
+class ChatStream:
+    """
+    The state of one streamed chat completion.
+
+    Attributes:
+        finish_reason (str | None): Why the model stopped, from the last choice chunk.
+        usage (dict | None): Token counts, sent in a final chunk when the request
+            asks for them.
+        error (str | None): What went wrong, if the stream could not be read.
+        done (bool): Whether the `[DONE]` event has arrived.
+    """
+
+    finish_reason: str | None = None
+    usage: dict | None = None
+    error: str | None = None
+    done: bool = False
+
+    @property
+    def ok(self) -> bool:
+        """Whether the whole completion arrived without errors."""
+        return self.error is None and (self.done or self.finish_reason is not None)
+
+    def info(self) -> dict:
+        """
+        Get what the stream reported besides the answer text.
+
+        Returns:
+            dict: The "finish_reason", "usage" and "error".
+        """
+        return {
+            "finish_reason": self.finish_reason,
+            "usage": self.usage,
+            "error": self.error,
+        }
+
+    def read_event(self, data: bytes) -> str | None:
+        """
+        Take in one event of the stream.
+
+        Args:
+            data (bytes): The event's data.
+
+        Returns:
+            str | None: The text the event adds to the answer, if any.
+        """
+        if data == DONE:
+            self.done = True
+            return None
+        try:
+            chunk = json_loads(data)
+        except ValueError:
+            self.error = "Could not decode a chunk of the stream"
+            logger.warning("Undecodable chat completion chunk: %r", data[:200])
+            return None
+
+        if "error" in chunk:
+            self.error = str(chunk["error"])
+            return None
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+
+        choices = chunk.get("choices")
+        if not choices:
+            return None
+        choice = choices[0]
+        if choice.get("finish_reason"):
+            self.finish_reason = choice["finish_reason"]
+        return choice.get("delta", {}).get("content") or None
+
+    def iter_content(self, chunks: Iterable[bytes]) -> Iterator[str]:
+        """
+        Yield the answer text from the raw bytes of a stream.
+
+        Args:
+            chunks (Iterable[bytes]): The bytes as they are read.
+
+        Yields:
+            str: The next piece of the answer.
+        """
+        decoder = SSEDecoder()
+        for chunk in chunks:
+            for data in decoder.feed(chunk):
+                content = self.read_event(data)
+                if content:
+                    yield content
+        for data in decoder.flush():
+            content = self.read_event(data)
+            if content:
+                yield content
+        self._check_finished()
+
+    async def aiter_content(self, chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+        """
+        Yield the answer text from the raw bytes of a stream, read asynchronously.
+
+        Args:
+            chunks (AsyncIterable[bytes]): The bytes as they are read.
+
+        Yields:
+            str: The next piece of the answer.
+        """
+        decoder = SSEDecoder()
+        async for chunk in chunks:
+            for data in decoder.feed(chunk):
+                content = self.read_event(data)
+                if content:
+                    yield content
+        for data in decoder.flush():
+            content = self.read_event(data)
+            if content:
+                yield content
+        self._check_finished()
+
+    def _check_finished(self) -> None:
+        if self.error is None and not self.ok:
+            self.error = "The stream ended before the completion did"
+            logger.warning(self.error)
@@ -12,9 +12,17 @@ cousin_folder = os.path.join(current_dir, "..", "b1_rag_fns")
 # Add cousin folder to sys.path so it can be imported
 sys.path.append(os.path.abspath(cousin_folder))
 
-from b1_all_rag_fns import do_rag
 from dotenv import load_dotenv
 
+# Load .env before the b1_rag_fns modules, which read their RGOV_* settings when
+# they are imported
+load_dotenv()
+
+from b1_all_rag_fns import do_rag, warm_up_models
+
+# Load the local models, if any are configured, before the first question
+warm_up_models()
+
 
 def gr_ch_if(user_input: str, history):
     oai_api_key = os.getenv("OPENAI_API_KEY")
@@ -12,11 +12,18 @@ cousin_folder = os.path.join(current_dir, "..", "b1_rag_fns")
 # Add cousin folder to sys.path so it can be imported
 sys.path.append(os.path.abspath(cousin_folder))
 
-from b1_all_rag_fns import do_rag
 from dotenv import load_dotenv
 
+# Load .env before the b1_rag_fns modules, which read their RGOV_* settings when
+# they are imported
 is_env = load_dotenv()
 
+from b1_all_rag_fns import warm_up_models
+from b5_async_rag import ado_rag
+
+# Load the local models, if any are configured, before the first question
+warm_up_models()
+
 oai_api_key = os.getenv("OPENAI_API_KEY")
 ui.page_opts(
     title="Use Shiny to Run RAG on the previous R/Gov Talks",
@@ -63,7 +70,7 @@ ui.markdown(
 @chat.on_user_submit
 async def _():
     user_message = chat.user_input()
-    response, _ = do_rag(
+    response, _ = await ado_rag(
         user_input=user_message,
         n_results=3,
         stream=True,
@@ -13,7 +13,11 @@ cousin_folder = os.path.join(current_dir, "..", "b1_rag_fns")
 # Add cousin folder to sys.path so it can be imported
 sys.path.append(os.path.abspath(cousin_folder))
 
-from b1_all_rag_fns import do_rag
+from b10_usage import UsageTotals, get_usage_totals
+from b1_all_rag_fns import do_rag, warm_up_models
+
+# Load the local models, if any are configured, before the first question
+warm_up_models()
 
 
 def run_app():
@@ -28,6 +32,10 @@ def run_app():
 
     oai_api_key = st.secrets["OPENAI_API_KEY"]
 
+    # Token usage and cost for this browser session
+    if "usage" not in st.session_state:
+        st.session_state["usage"] = UsageTotals()
+
     with st.sidebar:
         model_name = st.radio(
             label="Which GPT model\ndo you want to use?",
@@ -52,11 +60,21 @@ def run_app():
                 stream=True,
                 n_results=n_results,
                 model_name=model_name,
+                session_usage=st.session_state["usage"],
             )
 
             # Display the response
             st.write_stream(response)
 
+            session_totals = st.session_state["usage"].snapshot()
+            process_totals = get_usage_totals().snapshot()
+            st.sidebar.caption(
+                f"This session: {session_totals['requests']} questions, "
+                f"{session_totals['cost_cents']:.3f}¢\n\n"
+                f"All sessions: {process_totals['requests']} questions, "
+                f"{process_totals['cost_cents']:.3f}¢"
+            )
+
             feedback = streamlit_feedback(
                 feedback_type="thumbs",
                 optional_text_label="[Optional] Please provide an explanation",
@@ -3,6 +3,7 @@ import json
 
 import numpy as np
 import requests
+from caches import get_answer_cache, replay_stream
 
 
 def import_talk_info() -> list[dict]:
@@ -269,9 +270,24 @@ Address the response to me directly.  Do not use any information not explicitly
     return user_prompt
 
 
-def parse_1_query_stream(response):
+JSON_ERROR_PREFIX = "Error decoding JSON: "
+
+
+def parse_1_query_stream(response, on_complete=None):
+    """
+    Yield the text of a streamed chat completion as it arrives.
+
+    Args:
+        response: The streaming response.
+        on_complete: Called with the full answer once the stream has been read
+            without errors.
+
+    Yields:
+        str: The next piece of the answer.
+    """
     # Check if the request was successful
     if response.status_code == 200:
+        pieces = []
         for line in response.iter_lines():
             if line:
                 line = line.decode("utf-8")
@@ -282,35 +298,77 @@ def parse_1_query_stream(response):
                             chunk = json.loads(data)
                             content = chunk["choices"][0]["delta"].get("content", "")
                             if content:
+                                pieces.append(content)
                                 yield content
                         except json.JSONDecodeError:
-                            yield f"Error decoding JSON: {data}"
+                            error = f"{JSON_ERROR_PREFIX}{data}"
+                            pieces.append(error)
+                            yield error
+        if on_complete is not None and not any(
+            piece.startswith(JSON_ERROR_PREFIX) for piece in pieces
+        ):
+            on_complete("".join(pieces))
     else:
         yield f"Error: {response.status_code}\n{response.text}"
 
 
-def parse_1_query_no_stream(response):
+def parse_1_query_no_stream(response, on_complete=None):
+    """
+    Get the text of a chat completion.
+
+    Args:
+        response: The response.
+        on_complete: Called with the answer if the request succeeded.
+
+    Returns:
+        str: The answer, or a description of the error.
+    """
     if response.status_code == 200:
         try:
             response1 = response.json()
             completion = response1["choices"][0]["message"]["content"]
+            if on_complete is not None:
+                on_complete(completion)
             return completion
         except json.JSONDecodeError:
-            return f"Error decoding JSON: {response.text}"
+            return f"{JSON_ERROR_PREFIX}{response.text}"
     else:
         return f"Error: {response.status_code}\n{response.text}"
 
 
 def do_1_query(
-    messages1: list[dict[str, str]], oai_api_key: str, stream: bool, model_name: str
+    messages1: list[dict[str, str]],
+    oai_api_key: str,
+    stream: bool,
+    model_name: str,
+    use_cache: bool = True,
 ):
     """
     Generate a response using the specified chat completion model.
 
+    Completions are deterministic (temperature 0, fixed seed), so answers are
+    kept in the process-wide answer cache and repeats are served from it.  A
+    cached answer is replayed word by word when streaming.
+
     Args:
         messages1 (list[dict[str, str]]): The messages for the chat completion.
-        gen_client (OpenAI): The generation client (OpenAI).
+        oai_api_key (str): The OpenAI API key.
+        stream (bool): Whether to stream the response.
+        model_name (str): The chat model.
+        use_cache (bool): Whether to read and write the answer cache.
+
+    Returns:
+        str | Generator[str]: The answer, or a generator of its pieces when streaming.
     """
+    answer_cache = get_answer_cache() if use_cache else None
+    on_complete = None
+    if answer_cache is not None:
+        cached_answer = answer_cache.get_answer(messages1, model_name)
+        if cached_answer is not None:
+            return replay_stream(cached_answer) if stream else cached_answer
+
+        def on_complete(answer: str) -> None:
+            answer_cache.put_answer(messages1, model_name, answer)
 
     # OpenAI API endpoint for chat completions
     url = "https://api.openai.com/v1/chat/completions"
@@ -342,10 +400,10 @@ def do_1_query(
     )
 
     if stream:
-        response1 = parse_1_query_stream(response)
+        response1 = parse_1_query_stream(response, on_complete=on_complete)
     else:
         # Check if the request was successful
-        response1 = parse_1_query_no_stream(response)
+        response1 = parse_1_query_no_stream(response, on_complete=on_complete)
 
     return response1
 
@@ -0,0 +1,311 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Iterator
+
+# The answer cache half of b1_rag_fns/b3_caches.py, for this self-contained
+# deploy.  Keep the two in step.
+
+# Chat answer cache settings.  Answers older than the TTL (seconds) are not served.
+ANSWER_CACHE_SIZE = int(os.getenv("RGOV_ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL = float(os.getenv("RGOV_ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_PATH = os.getenv("RGOV_ANSWER_CACHE_PATH")
+ANSWER_CACHE_DISK_SIZE = int(os.getenv("RGOV_ANSWER_CACHE_DISK_SIZE", "20000"))
+
+# The SQLite tier drops expired rows, then the oldest rows over its size, once
+# every this many writes
+PRUNE_EVERY = 256
+
+
+def make_key(*parts: str) -> str:
+    """
+    Hash the parts of a cache key into a fixed-length string.
+
+    Args:
+        *parts (str): The values that identify the cached item.
+
+    Returns:
+        str: The hex digest of the parts.
+    """
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """
+    A thread-safe in-memory cache that evicts the least recently used entry.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data: OrderedDict[str, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SqliteCache:
+    """
+    A persistent key -> bytes store in a single SQLite file.
+
+    Each value is stored with the Unix time it was written.  The file is pruned
+    when opened and every `PRUNE_EVERY` writes: rows older than `ttl` are
+    deleted, then the oldest rows beyond `max_rows`.
+    """
+
+    def __init__(
+        self,
+        path: str | os.PathLike,
+        table: str = "cache",
+        max_rows: int | None = None,
+        ttl: float | None = None,
+    ):
+        self.path = str(path)
+        self.table = table
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._n_puts = 0
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} "
+                "(key TEXT PRIMARY KEY, value BLOB, created REAL)"
+            )
+            self._conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {table}_created ON {table} (created)"
+            )
+            self._prune()
+
+    def get(self, key: str) -> tuple[bytes, float] | None:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        return row
+
+    def put(self, key: str, value: bytes, created: float) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created) "
+                "VALUES (?, ?, ?)",
+                (key, value, created),
+            )
+            self._n_puts += 1
+            if self._n_puts % PRUNE_EVERY == 0:
+                self._prune()
+
+    def delete(self, key: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def __len__(self) -> int:
+        with self._lock:
+            row = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+        return row[0]
+
+    def _prune(self) -> None:
+        # Called with the lock held, inside a transaction
+        if self.ttl is not None:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE created < ?",
+                (time.time() - self.ttl,),
+            )
+        if self.max_rows is not None:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN "
+                f"(SELECT key FROM {self.table} ORDER BY created DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self.max_rows,),
+            )
+
+
+class TieredCache:
+    """
+    An LRU cache in memory with an optional SQLite tier behind it.
+
+    Lookups try memory first, then disk; a disk hit is promoted back into
+    memory.  With a `ttl`, entries older than `ttl` seconds count as misses
+    and are dropped.  The disk tier holds at most `disk_size` entries.  Hit and
+    miss counts are kept for each tier.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        path: str | os.PathLike | None = None,
+        table: str = "cache",
+        dumps: Callable[[Any], bytes] | None = None,
+        loads: Callable[[bytes], Any] | None = None,
+        ttl: float | None = None,
+        disk_size: int | None = None,
+    ):
+        self.ttl = ttl
+        self.memory = LRUCache(max_size)
+        self.disk = (
+            SqliteCache(path, table, max_rows=disk_size, ttl=ttl) if path else None
+        )
+        self._dumps = dumps
+        self._loads = loads
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def _count(self, counter: str) -> None:
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _is_expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key: str) -> Any | None:
+        item = self.memory.get(key)
+        if item is not None:
+            created, value = item
+            if not self._is_expired(created):
+                self._count("memory_hits")
+                return value
+            self.memory.pop(key)
+
+        if self.disk is not None:
+            row = self.disk.get(key)
+            if row is not None:
+                raw, created = row
+                if not self._is_expired(created):
+                    value = self._loads(raw)
+                    self.memory.put(key, (created, value))
+                    self._count("disk_hits")
+                    return value
+                self.disk.delete(key)
+
+        self._count("misses")
+        return None
+
+    def put(self, key: str, value: Any) -> None:
+        created = time.time()
+        self.memory.put(key, (created, value))
+        if self.disk is not None:
+            self.disk.put(key, self._dumps(value), created)
+
+    def stats(self) -> dict[str, int | float]:
+        """
+        Get the hit and miss counters.
+
+        Returns:
+            dict[str, int | float]: Hits per tier, misses, the hit rate and the
+                number of entries held in memory.
+        """
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "size": len(self.memory),
+        }
+
+
+class AnswerCache(TieredCache):
+    """
+    Cache of chat completions, keyed on a hash of the model name and the messages.
+
+    Only safe because completions are requested with temperature 0 and a fixed
+    seed, so the same messages give the same answer.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: float | None = None,
+        path: str | os.PathLike | None = None,
+        disk_size: int | None = None,
+    ):
+        super().__init__(
+            max_size,
+            path=path,
+            table="answers",
+            dumps=lambda answer: answer.encode("utf-8"),
+            loads=lambda raw: raw.decode("utf-8"),
+            ttl=ttl,
+            disk_size=disk_size,
+        )
+
+    @staticmethod
+    def key(messages1: list[dict[str, str]], model_name: str) -> str:
+        return make_key(
+            model_name, json.dumps(messages1, sort_keys=True, ensure_ascii=False)
+        )
+
+    def get_answer(
+        self, messages1: list[dict[str, str]], model_name: str
+    ) -> str | None:
+        return self.get(self.key(messages1, model_name))
+
+    def put_answer(
+        self, messages1: list[dict[str, str]], model_name: str, answer: str
+    ) -> None:
+        self.put(self.key(messages1, model_name), answer)
+
+
+def replay_stream(answer: str) -> Iterator[str]:
+    """
+    Yield a cached answer piece by piece, the way a streamed completion arrives.
+
+    Args:
+        answer (str): The full answer.
+
+    Yields:
+        str: Each word of the answer with the whitespace before it.
+    """
+    for match in re.finditer(r"\s*\S+", answer):
+        yield match.group()
+
+
+_answer_cache: AnswerCache | None = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache:
+    """
+    Get the chat answer cache shared by every session in this process.
+
+    Returns:
+        AnswerCache: The process-wide chat answer cache.
+    """
+    global _answer_cache
+    if _answer_cache is None:
+        with _answer_cache_lock:
+            if _answer_cache is None:
+                _answer_cache = AnswerCache(
+                    ANSWER_CACHE_SIZE,
+                    ttl=ANSWER_CACHE_TTL,
+                    path=ANSWER_CACHE_PATH,
+                    disk_size=ANSWER_CACHE_DISK_SIZE,
+                )
+    return _answer_cache
@@ -0,0 +1,227 @@
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# A local stand-in for the OpenAI embeddings and chat completions endpoints, so
+# the pipeline can be benchmarked without network noise or API costs.  Answers
+# are filler text; only the timing and the response format are realistic.
+
+FILLER_WORDS = (
+    "the R Gov conference talks covered data science in government with "
+    "examples from agencies using open source tools to analyze public data"
+).split()
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    """
+    HTTP server that answers like the OpenAI API.
+
+    Attributes:
+        latency (float): Seconds before a completion's first token, or before an
+            embedding response.
+        token_rate (float): Completion tokens sent per second.
+        completion_tokens (int): Tokens in every completion.
+        dim (int): The embedding dimension.
+        anchor_embeds (np.ndarray | None): If given, each query embedding is a
+            noisy copy of one of these rows, so retrieval finds real matches.
+    """
+
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(
+        self,
+        address: tuple[str, int],
+        latency: float = 0.2,
+        token_rate: float = 100.0,
+        completion_tokens: int = 100,
+        dim: int = 1536,
+        anchor_embeds: np.ndarray | None = None,
+    ):
+        super().__init__(address, MockOpenAIHandler)
+        self.latency = latency
+        self.token_rate = token_rate
+        self.completion_tokens = completion_tokens
+        self.anchor_embeds = anchor_embeds
+        self.dim = dim if anchor_embeds is None else anchor_embeds.shape[1]
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def make_embed(self, text: str) -> list[float]:
+        """
+        Make a deterministic unit-norm embedding for a text.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            list[float]: The embedding.
+        """
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+        rng = np.random.default_rng(seed)
+        embed = rng.standard_normal(self.dim, dtype=np.float32)
+        if self.anchor_embeds is not None:
+            anchor = self.anchor_embeds[seed % len(self.anchor_embeds)]
+            embed = anchor / np.linalg.norm(anchor) + 0.01 * embed
+        embed /= np.linalg.norm(embed)
+        return embed.tolist()
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: MockOpenAIServer
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path.endswith("/embeddings"):
+            self.send_embeddings(body)
+        elif self.path.endswith("/chat/completions"):
+            if body.get("stream"):
+                self.send_chat_stream(body)
+            else:
+                self.send_chat(body)
+        else:
+            self.send_json({"error": {"message": f"Unknown path {self.path}"}}, 404)
+
+    def send_json(self, payload: dict, status: int = 200) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_embeddings(self, body: dict) -> None:
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        time.sleep(self.server.latency / 4)
+        n_tokens = sum(len(text.split()) for text in texts)
+        self.send_json(
+            {
+                "object": "list",
+                "data": [
+                    {
+                        "object": "embedding",
+                        "index": i,
+                        "embedding": self.server.make_embed(text),
+                    }
+                    for i, text in enumerate(texts)
+                ],
+                "model": body.get("model"),
+                "usage": {"prompt_tokens": n_tokens, "total_tokens": n_tokens},
+            }
+        )
+
+    def chat_usage(self, body: dict) -> dict:
+        prompt_tokens = sum(len(m["content"]) // 4 for m in body["messages"])
+        completion_tokens = self.server.completion_tokens
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    def words(self):
+        for i in range(self.server.completion_tokens):
+            word = FILLER_WORDS[i % len(FILLER_WORDS)]
+            yield word if i == 0 else " " + word
+
+    def send_chat(self, body: dict) -> None:
+        time.sleep(
+            self.server.latency + self.server.completion_tokens / self.server.token_rate
+        )
+        self.send_json(
+            {
+                "object": "chat.completion",
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {
+                            "role": "assistant",
+                            "content": "".join(self.words()),
+                        },
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": self.chat_usage(body),
+            }
+        )
+
+    def send_chat_stream(self, body: dict) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send_event(payload: dict | str) -> None:
+            data = payload if isinstance(payload, str) else json.dumps(payload)
+            event = f"data: {data}\n\n".encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+            self.wfile.flush()
+
+        time.sleep(self.server.latency)
+        interval = 1 / self.server.token_rate
+        next_at = time.perf_counter()
+        for word in self.words():
+            delta = {"index": 0, "delta": {"content": word}, "finish_reason": None}
+            send_event({"choices": [delta]})
+            next_at += interval
+            time.sleep(max(0.0, next_at - time.perf_counter()))
+        send_event({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if body.get("stream_options", {}).get("include_usage"):
+            send_event({"choices": [], "usage": self.chat_usage(body)})
+        send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def start_mock_server(port: int = 0, **kwargs) -> MockOpenAIServer:
+    """
+    Start the mock server on a background thread.
+
+    Args:
+        port (int): The port, or 0 for any free one.
+        **kwargs: Passed on to `MockOpenAIServer`.
+
+    Returns:
+        MockOpenAIServer: The running server.  Call `shutdown()` to stop it.
+    """
+    server = MockOpenAIServer(("127.0.0.1", port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a mock OpenAI API server.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--token-rate", type=float, default=100.0)
+    parser.add_argument("--completion-tokens", type=int, default=100)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument(
+        "--anchor-embeds", help="An embeds.npy whose rows the query embeddings copy"
+    )
+    args = parser.parse_args()
+
+    anchor_embeds = np.load(args.anchor_embeds) if args.anchor_embeds else None
+    server = MockOpenAIServer(
+        ("127.0.0.1", args.port),
+        latency=args.latency,
+        token_rate=args.token_rate,
+        completion_tokens=args.completion_tokens,
+        dim=args.dim,
+        anchor_embeds=anchor_embeds,
+    )
+    print(f"Mock OpenAI API at {server.base_url}")
+    server.serve_forever()
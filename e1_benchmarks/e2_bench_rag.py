@@ -0,0 +1,318 @@
+import argparse
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+# Get the directory of the current script
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Add the pipeline folder to sys.path so it can be imported
+sys.path.append(os.path.join(current_dir, "..", "b1_rag_fns"))
+sys.path.append(current_dir)
+
+from e1_mock_openai import start_mock_server
+
+# End-to-end benchmark of the RAG pipeline against the mock OpenAI server and a
+# local copy of the corpus.  Prints (or writes) one JSON document so runs can
+# be compared for regressions.
+
+DEFAULT_DATA_SOURCE = os.path.join(current_dir, "..", "data")
+CONCURRENCY_LEVELS = (1, 10, 100)
+
+
+def summarize(latencies: list[float], wall_secs: float | None = None) -> dict:
+    """
+    Summarize latencies in seconds.
+
+    Args:
+        latencies (list[float]): The latency of each call.
+        wall_secs (float | None): Wall time for all the calls, for throughput.
+
+    Returns:
+        dict: Count, mean, percentiles and max, plus calls per second if
+            `wall_secs` is given.
+    """
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    summary = {
+        "n": len(latencies),
+        "mean": float(np.mean(latencies)),
+        "p50": float(p50),
+        "p95": float(p95),
+        "p99": float(p99),
+        "max": float(np.max(latencies)),
+    }
+    if wall_secs is not None:
+        summary["wall_secs"] = wall_secs
+        summary["throughput_per_sec"] = len(latencies) / wall_secs
+    return summary
+
+
+def bench_calls(fn, n_iter: int, warmup: int = 3) -> dict:
+    """
+    Time a function called repeatedly on one thread.
+
+    Args:
+        fn: Called with no arguments.
+        n_iter (int): How many timed calls to make.
+        warmup (int): How many untimed calls to make first.
+
+    Returns:
+        dict: The latency summary.
+    """
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(n_iter):
+        call_start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - call_start)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def bench_concurrent(fn, concurrency: int, n_requests: int) -> dict:
+    """
+    Time `n_requests` calls made by `concurrency` callers at once.
+
+    Args:
+        fn: Called with the request number.
+        concurrency (int): How many calls are in flight at a time.
+        n_requests (int): How many calls to make in total.
+
+    Returns:
+        dict: The latency summary of the calls that succeeded, with throughput,
+            the number of errors, and how many times each error was raised
+            (as "Type: message") in "error_types".
+    """
+
+    def call(i: int) -> float | str:
+        call_start = time.perf_counter()
+        try:
+            fn(i)
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+        return time.perf_counter() - call_start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(call, range(n_requests)))
+    wall_secs = time.perf_counter() - start
+
+    latencies = [r for r in results if not isinstance(r, str)]
+    error_types = Counter(r for r in results if isinstance(r, str))
+    summary = summarize(latencies, wall_secs) if latencies else {"n": 0}
+    summary["errors"] = len(results) - len(latencies)
+    summary["error_types"] = dict(error_types.most_common())
+    return summary
+
+
+def make_sse_body(n_tokens: int) -> list[bytes]:
+    """
+    Make a streamed chat completion, one network read per event.
+
+    Args:
+        n_tokens (int): The number of content chunks.
+
+    Returns:
+        list[bytes]: The reads.
+    """
+    reads = []
+    for i in range(n_tokens):
+        chunk = {
+            "choices": [
+                {"index": 0, "delta": {"content": f" word{i}"}, "finish_reason": None}
+            ]
+        }
+        reads.append(b"data: " + json.dumps(chunk).encode() + b"\n\n")
+    reads.append(
+        b'data: {"choices":[{"index":0,"delta":{},"finish_reason":"stop"}]}\n\n'
+    )
+    reads.append(b"data: [DONE]\n\n")
+    return reads
+
+
+class ReplayedResponse:
+    """
+    Stands in for a streaming `requests.Response`, replaying recorded reads.
+    """
+
+    status_code = 200
+
+    def __init__(self, reads: list[bytes]):
+        self.reads = reads
+
+    def iter_content(self, chunk_size=None):
+        return iter(self.reads)
+
+
+def run_benchmarks(args: argparse.Namespace) -> dict:
+    """
+    Run every benchmark.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+
+    Returns:
+        dict: The results, with the settings and environment they were run in.
+    """
+    data_source = os.path.abspath(args.data_source)
+    anchor_path = os.path.join(data_source, "embeds.npy")
+    anchor_embeds = np.load(anchor_path) if os.path.exists(anchor_path) else None
+    server = start_mock_server(
+        latency=args.latency,
+        token_rate=args.token_rate,
+        completion_tokens=args.completion_tokens,
+        anchor_embeds=anchor_embeds,
+    )
+
+    # The pipeline reads these when it is first imported
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+    os.environ["RGOV_DATA_SOURCE"] = data_source
+    rag = importlib.import_module("b1_all_rag_fns")
+    instrument = importlib.import_module("b11_instrument")
+
+    results = {}
+    n_iter = args.iterations
+
+    results["import_data"] = bench_calls(
+        lambda: rag.import_data(data_source), max(1, n_iter // 100)
+    )
+
+    talk_info, embeds = rag.import_data(data_source)
+    ids = [talk["id0"] for talk in talk_info]
+    talks_by_id = {talk["id0"]: talk for talk in talk_info}
+    embeds = np.asarray(embeds, dtype=np.float32)
+    embeds = embeds / np.linalg.norm(embeds, axis=1, keepdims=True)
+    # A query near a real talk, so limit_docs and the prompt see real documents
+    rng = np.random.default_rng(18)
+    embed_q = embeds[0] + 0.01 * rng.standard_normal(embeds.shape[1], dtype=np.float32)
+    embed_q /= np.linalg.norm(embed_q)
+
+    results["do_sort"] = bench_calls(lambda: rag.do_sort(embed_q, embeds, ids), n_iter)
+    results["do_sort_top_k"] = bench_calls(
+        lambda: rag.do_sort(embed_q, embeds, ids, top_k=args.n_results), n_iter
+    )
+    sorted_vids = rag.do_sort(embed_q, embeds, ids)
+    results["limit_docs"] = bench_calls(
+        lambda: rag.limit_docs(sorted_vids, talks_by_id, args.n_results), n_iter
+    )
+    keep_texts = rag.limit_docs(sorted_vids, talks_by_id, args.n_results)
+    results["make_user_prompt"] = bench_calls(
+        lambda: rag.make_user_prompt("What did the talks say about R?", keep_texts),
+        max(1, n_iter // 10),
+    )
+
+    corpus = rag.get_corpus_store().get()
+    if corpus.lexical is not None:
+        question = "Who used the targets package in government?"
+        results["bm25_score"] = bench_calls(
+            lambda: corpus.lexical.score(question), n_iter
+        )
+        results["rank_talks_hybrid"] = bench_calls(
+            lambda: rag.rank_talks(
+                embed_q, corpus, args.n_results, query_text=question
+            ),
+            n_iter,
+        )
+
+    reads = make_sse_body(args.completion_tokens)
+    stream_summary = bench_calls(
+        lambda: list(rag.parse_1_query_stream(ReplayedResponse(reads))),
+        max(1, n_iter // 10),
+    )
+    stream_summary["per_token_secs"] = stream_summary["mean"] / args.completion_tokens
+    results["parse_1_query_stream"] = stream_summary
+
+    results["do_rag"] = {}
+    for concurrency in args.concurrency:
+        collector = instrument.Collector()
+        instrument.set_instrument(collector)
+
+        def ask(i: int, concurrency=concurrency) -> None:
+            # Distinct questions, so no cache answers them
+            response, _ = rag.do_rag(
+                f"Benchmark question {concurrency}-{i} about R in government",
+                oai_api_key="benchmark",
+                model_name="gpt-4o-mini",
+                stream=True,
+                n_results=args.n_results,
+                use_semantic_cache=False,
+            )
+            for _ in response:
+                pass
+
+        n_requests = args.requests or max(10, 2 * concurrency)
+        level = bench_concurrent(ask, concurrency, n_requests)
+        level["stages"] = collector.summary()
+        results["do_rag"][str(concurrency)] = level
+        instrument.set_instrument(None)
+
+    server.shutdown()
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "n_talks": len(ids),
+            "dim": int(embeds.shape[1]),
+            "settings": {k: v for k, v in vars(args).items() if k != "output"},
+        },
+        "results": results,
+    }
+
+
+def git_commit() -> str | None:
+    """
+    Get the commit the benchmark ran at, if it ran in a git checkout.
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=current_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the RAG pipeline against a mock OpenAI server."
+    )
+    parser.add_argument("--data-source", default=DEFAULT_DATA_SOURCE)
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=list(CONCURRENCY_LEVELS)
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        help="do_rag calls per level (default: twice the level, at least 10)",
+    )
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--n-results", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--token-rate", type=float, default=100.0)
+    parser.add_argument("--completion-tokens", type=int, default=100)
+    parser.add_argument("--output", help="Write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,164 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+# Generate a synthetic corpus in the same layout as data/: rgov_talks.json,
+# embeds.npy plus embeds_meta.json, and optionally embeds.csv.  Rows are
+# written in blocks, so corpora far larger than memory can be made.
+#
+# Embeddings are unit vectors scattered around random cluster centers, which is
+# closer to real text embeddings than uniform noise and gives approximate
+# indexes something to find.  Each row takes 4 * dim bytes in embeds.npy, so
+# 10 million rows at dim 1536 need about 61 GB; use a smaller --dim to go big.
+
+BLOCK_ROWS = 65536
+
+WORDS = (
+    "data analysis government public policy statistics model forecast survey "
+    "census budget health transit housing election open source package shiny "
+    "dashboard map visualization pipeline reproducible report agency city state"
+).split()
+
+
+def make_talk(i: int, rng: np.random.Generator, transcript_words: int) -> dict:
+    """
+    Make one talk record with the same fields as data/rgov_talks.json.
+
+    Args:
+        i (int): The row number.
+        rng (np.random.Generator): The random generator.
+        transcript_words (int): How many words of transcript to write.
+
+    Returns:
+        dict: The talk.
+    """
+    year = 2019 + i % 6
+
+    def text(n_words: int) -> str:
+        return " ".join(WORDS[j] for j in rng.integers(0, len(WORDS), n_words))
+
+    return {
+        "Year": year,
+        "Speaker": f"Speaker {i}",
+        "Title": text(6).title(),
+        "Abstract": text(60),
+        "VideoURL": f"https://youtu.be/synthetic{i:08d}",
+        "id0": f"syn_{i:08d}",
+        "transcript": text(transcript_words),
+    }
+
+
+def make_embeds_block(
+    n_rows: int, centers: np.ndarray, rng: np.random.Generator, spread: float
+) -> np.ndarray:
+    """
+    Make unit-norm embeddings scattered around random cluster centers.
+
+    Args:
+        n_rows (int): The number of rows.
+        centers (np.ndarray): The unit-norm cluster centers.
+        rng (np.random.Generator): The random generator.
+        spread (float): How far rows stray from their center.
+
+    Returns:
+        np.ndarray: The float32 embeddings.
+    """
+    dim = centers.shape[1]
+    which = rng.integers(0, len(centers), n_rows)
+    block = centers[which] + spread / np.sqrt(dim) * rng.standard_normal(
+        (n_rows, dim), dtype=np.float32
+    )
+    block /= np.linalg.norm(block, axis=1, keepdims=True)
+    return block
+
+
+def make_corpus(
+    out_dir: str,
+    n_rows: int,
+    dim: int = 1536,
+    n_clusters: int = 256,
+    spread: float = 1.0,
+    transcript_words: int = 100,
+    write_csv: bool = False,
+    seed: int = 18,
+    model_name: str = "synthetic",
+) -> None:
+    """
+    Write a synthetic corpus to a directory.
+
+    Args:
+        out_dir (str): The directory to write to.
+        n_rows (int): The number of talks.
+        dim (int): The embedding dimension.
+        n_clusters (int): The number of cluster centers.
+        spread (float): How far rows stray from their center.
+        transcript_words (int): The transcript length of each talk, in words.
+        write_csv (bool): Also write embeds.csv, as the older layout had.
+        seed (int): The random seed.
+        model_name (str): The model name recorded in embeds_meta.json.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim), dtype=np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+
+    ids = [f"syn_{i:08d}" for i in range(n_rows)]
+
+    # Stream the talks out rather than building the whole list
+    with open(os.path.join(out_dir, "rgov_talks.json"), "w") as f:
+        f.write("[")
+        for i in range(n_rows):
+            if i:
+                f.write(",\n")
+            f.write(json.dumps(make_talk(i, rng, transcript_words)))
+        f.write("]")
+
+    tmp_npy = os.path.join(out_dir, "embeds.npy.tmp")
+    embeds = np.lib.format.open_memmap(
+        tmp_npy, mode="w+", dtype=np.float32, shape=(n_rows, dim)
+    )
+    csv_file = open(os.path.join(out_dir, "embeds.csv"), "w") if write_csv else None
+    try:
+        for start in range(0, n_rows, BLOCK_ROWS):
+            stop = min(start + BLOCK_ROWS, n_rows)
+            block = make_embeds_block(stop - start, centers, rng, spread)
+            embeds[start:stop] = block
+            if csv_file is not None:
+                np.savetxt(csv_file, block, delimiter=",", fmt="%.16f")
+    finally:
+        if csv_file is not None:
+            csv_file.close()
+    embeds.flush()
+    del embeds
+    os.replace(tmp_npy, os.path.join(out_dir, "embeds.npy"))
+
+    embeds_meta = {"model": model_name, "dim": dim, "dtype": "float32", "ids": ids}
+    with open(os.path.join(out_dir, "embeds_meta.json"), "w") as f:
+        json.dump(embeds_meta, f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic corpus.")
+    parser.add_argument("out_dir")
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--clusters", type=int, default=256)
+    parser.add_argument("--spread", type=float, default=1.0)
+    parser.add_argument("--transcript-words", type=int, default=100)
+    parser.add_argument("--csv", action="store_true", help="Also write embeds.csv")
+    parser.add_argument("--seed", type=int, default=18)
+    args = parser.parse_args()
+
+    make_corpus(
+        args.out_dir,
+        n_rows=args.rows,
+        dim=args.dim,
+        n_clusters=args.clusters,
+        spread=args.spread,
+        transcript_words=args.transcript_words,
+        write_csv=args.csv,
+        seed=args.seed,
+    )
+    print(f"Wrote {args.rows} talks to {args.out_dir}")
@@ -0,0 +1,304 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+# Get the directory of the current script
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Add the pipeline folder to sys.path so it can be imported
+sys.path.append(os.path.join(current_dir, "..", "b1_rag_fns"))
+sys.path.append(current_dir)
+
+from b12_retrievers import (
+    BINARY_RERANK,
+    INT8_RERANK,
+    IVF_NPROBE,
+    BinaryRetriever,
+    ExactRetriever,
+    Int8Retriever,
+    load_or_build_ivf,
+    top_k_indices,
+)
+from b1_all_rag_fns import do_ann_sort, limit_docs
+from b2_corpus_store import Corpus, CorpusStore
+from e2_bench_rag import summarize
+from e3_make_corpus import make_corpus
+
+try:
+    import resource
+except ImportError:  # not on Windows; memory is then not reported
+    resource = None
+
+try:
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+except ImportError:  # plotting is optional
+    plt = None
+
+# How retrieval scales with corpus size.  Each size is generated once with
+# e3_make_corpus, then loaded and queried in a fresh process so its load time
+# and memory are not mixed up with the other sizes'.
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000, 1_000_000)
+
+
+class FullSortRetriever(ExactRetriever):
+    """
+    Exact search that sorts every score before taking the best, for comparison
+    with top-k selection.
+    """
+
+    name = "exact_full_sort"
+
+    def search(self, embed_q: np.ndarray, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        scores = self.embeds @ embed_q
+        best = np.argsort(-scores)[:top_k]
+        return best, scores[best]
+
+
+# Retrieval backends to compare.  Each builds a `Retriever` from the loaded
+# corpus.  A backend that takes a second argument can be named "name@value" to
+# set it: "ivf@32" probes 32 lists, and "int8@8" or "binary@8" re-rank 8
+# candidates per result.  The first run at each size builds the IVF index, so
+# its build_secs covers k-means; later runs only load it.
+BACKENDS = {
+    "exact": lambda corpus: ExactRetriever(corpus.embeds),
+    "exact_full_sort": lambda corpus: FullSortRetriever(corpus.embeds),
+    "ivf": lambda corpus, nprobe=IVF_NPROBE: load_or_build_ivf(
+        corpus.embeds, nprobe=nprobe
+    ),
+    "int8": lambda corpus, rerank=INT8_RERANK: Int8Retriever(
+        corpus.embeds, rerank=rerank
+    ),
+    "binary": lambda corpus, rerank=BINARY_RERANK: BinaryRetriever(
+        corpus.embeds, rerank=rerank
+    ),
+}
+
+
+def register_backend(name: str, build) -> None:
+    """
+    Add a retrieval backend to the benchmark.
+
+    Args:
+        name (str): The name to report it under.
+        build: Called with the `Corpus`, and the value of any "@value" suffix;
+            returns a `Retriever` over the corpus's embeddings.
+    """
+    BACKENDS[name] = build
+
+
+def peak_rss_mb() -> float | None:
+    """
+    Get the peak resident memory of this process, in MB.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def build_backend(name: str, corpus: Corpus):
+    """
+    Build a backend by name, passing on any "@value" suffix as its setting.
+    """
+    base, _, setting = name.partition("@")
+    if setting:
+        return BACKENDS[base](corpus, int(setting))
+    return BACKENDS[base](corpus)
+
+
+def exact_top_ids(corpus: Corpus, queries: np.ndarray, k: int) -> list[set]:
+    """
+    Get the true top-k talks of each query, to measure recall against.
+    """
+    return [
+        set(corpus.row_ids[top_k_indices(corpus.embeds @ embed_q, k)].tolist())
+        for embed_q in queries
+    ]
+
+
+def make_queries(corpus: Corpus, n_queries: int, seed: int = 18) -> np.ndarray:
+    """
+    Make query embeddings near random talks, like questions about them.
+
+    Args:
+        corpus (Corpus): The corpus.
+        n_queries (int): The number of queries.
+        seed (int): The random seed.
+
+    Returns:
+        np.ndarray: The unit-norm queries, one per row.
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(corpus.row_ids), n_queries)
+    queries = np.asarray(corpus.embeds[rows], dtype=np.float32)
+    queries += 0.5 / np.sqrt(corpus.dim) * rng.standard_normal(
+        queries.shape, dtype=np.float32
+    )
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def measure_size(
+    source: str, backends: list[str], n_queries: int, n_results: int
+) -> dict:
+    """
+    Load one corpus and time queries against it with each backend.
+
+    Meant to run in a fresh process.
+
+    Args:
+        source (str): The corpus directory.
+        backends (list[str]): The backends to time.
+        n_queries (int): Queries per backend.
+        n_results (int): Talks to retrieve per query.
+
+    Returns:
+        dict: Load time, peak memory after loading and after each backend, and
+            per backend its query latency, recall@k, and the memory it scans
+            next to the float32 matrix's.
+    """
+    start = time.perf_counter()
+    # Only the embedding search is measured, so skip building the BM25 index
+    corpus = CorpusStore(source, lexical=False).get()
+    result = {
+        "rows": len(corpus.row_ids),
+        "dim": corpus.dim,
+        "load_secs": time.perf_counter() - start,
+        "load_peak_rss_mb": peak_rss_mb(),
+        "embeds_mb": corpus.embeds.nbytes / 1024**2,
+        "backends": {},
+    }
+
+    queries = make_queries(corpus, n_queries)
+    true_ids = exact_top_ids(corpus, queries, n_results)
+    for name in backends:
+        build_start = time.perf_counter()
+        retriever = build_backend(name, corpus)
+        build_secs = time.perf_counter() - build_start
+
+        latencies = []
+        n_found = 0
+        for embed_q, expected in zip(queries, true_ids):
+            query_start = time.perf_counter()
+            sorted_vids = do_ann_sort(embed_q, retriever, corpus.row_ids, n_results)
+            limit_docs(sorted_vids, corpus.talks_by_id, n_results)
+            latencies.append(time.perf_counter() - query_start)
+            n_found += len(expected.intersection(vid["id0"] for vid in sorted_vids))
+
+        result["backends"][name] = {
+            "build_secs": build_secs,
+            "query": summarize(latencies),
+            "recall_at_k": n_found / (n_results * len(queries)),
+            "index_mb": retriever.nbytes / 1024**2,
+            "memory_reduction": corpus.embeds.nbytes / retriever.nbytes,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+    return result
+
+
+def plot_scaling(report: dict, path: str) -> None:
+    """
+    Plot load time, memory and median query latency against corpus size.
+
+    Args:
+        report (dict): The benchmark results.
+        path (str): Where to save the figure.
+    """
+    sizes = report["results"]
+    rows = [size["rows"] for size in sizes]
+    fig, axes = plt.subplots(1, 3, figsize=(15, 4.5))
+
+    axes[0].plot(rows, [size["load_secs"] for size in sizes], marker="o")
+    axes[0].set_ylabel("Load time (s)")
+
+    axes[1].plot(rows, [size["load_peak_rss_mb"] for size in sizes], marker="o")
+    axes[1].set_ylabel("Peak resident memory after load (MB)")
+
+    for name in report["meta"]["backends"]:
+        latencies = [1000 * size["backends"][name]["query"]["p50"] for size in sizes]
+        axes[2].plot(rows, latencies, marker="o", label=name)
+    axes[2].set_ylabel("Median query latency (ms)")
+    axes[2].legend()
+
+    for ax in axes:
+        ax.set_xscale("log")
+        ax.set_yscale("log")
+        ax.set_xlabel("Talks in corpus")
+        ax.grid(True, which="both", alpha=0.3)
+    fig.tight_layout()
+    fig.savefig(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark corpus loading and retrieval against corpus size."
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES))
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=list(BACKENDS),
+        help='Backends to compare; "ivf@N" probes N lists',
+    )
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--n-results", type=int, default=3)
+    parser.add_argument(
+        "--workdir",
+        default=os.path.join(tempfile.gettempdir(), "rgov_scaling"),
+        help="Where the synthetic corpora are kept between runs",
+    )
+    parser.add_argument("--output", help="Write the JSON here instead of stdout")
+    parser.add_argument("--plot", help="Save a plot here (needs matplotlib)")
+    args = parser.parse_args()
+
+    results = []
+    for n_rows in args.sizes:
+        source = os.path.join(args.workdir, f"rows_{n_rows}_dim_{args.dim}")
+        if not os.path.exists(os.path.join(source, "embeds_meta.json")):
+            print(f"Generating {n_rows} talks in {source}", file=sys.stderr)
+            make_corpus(source, n_rows=n_rows, dim=args.dim)
+
+        # A fresh process per size, so peak memory covers this size alone
+        spawn = get_context("spawn")
+        with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+            size_result = pool.submit(
+                measure_size, source, args.backends, args.queries, args.n_results
+            ).result()
+        results.append(size_result)
+        print(
+            f"{n_rows} talks: loaded in {size_result['load_secs']:.2f}s",
+            file=sys.stderr,
+        )
+
+    report = {
+        "meta": {
+            "dim": args.dim,
+            "backends": args.backends,
+            "queries": args.queries,
+            "n_results": args.n_results,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.plot:
+        if plt is None:
+            print("matplotlib is not installed; skipping the plot", file=sys.stderr)
+        else:
+            plot_scaling(report, args.plot)